@@ -0,0 +1,84 @@
+import asyncio
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Awaitable
+
+from . import metrics, ratelimit, session
+
+# httpx is imported on first use, so entry points that stay synchronous don't pay for it at cold start
+if TYPE_CHECKING:
+    import httpx
+
+# connections the shared async client keeps open across all hosts, and keeps alive when idle
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+
+"""
+Function that returns the event loop all async WHOOP/Notion calls run on. It lives in a
+background thread for the whole process, so its pooled connections survive warm invocations.
+"""
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="helpers-aio", daemon=True).start()
+            _loop = loop
+        return _loop
+
+"""
+Function that runs a coroutine on the shared event loop and blocks until it finishes. This is
+the sync wrapper the Cloud Function entry points use.
+"""
+def run(coroutine: Awaitable) -> Any:
+    # the coroutine runs in a task on the loop's thread, so carry the caller's open spans over
+    return asyncio.run_coroutine_threadsafe(metrics.bind(coroutine), get_loop()).result()
+
+"""
+Function that returns the async HTTP client shared by every coroutine on the event loop
+"""
+def get_client() -> "httpx.AsyncClient":
+    global _client
+    if _client is None:
+        import httpx
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+            timeout=session.DEFAULT_TIMEOUT_SECONDS,
+        )
+    return _client
+
+"""
+Async counterpart of session.request, with the same retry, backoff, Retry-After and rate
+limiting behavior (see session.response_retry_delay). Waiting for a rate limiter token happens
+off the event loop. A str or bytes `data` body is sent as is, like session.request does.
+"""
+async def request(method: str, url: str, idempotent: bool=None, max_retries: int=session.DEFAULT_MAX_RETRIES, rate_limiter: ratelimit.TokenBucket=None, priority: int=ratelimit.PRIORITY_INTERACTIVE, **kwargs) -> "httpx.Response":
+    import httpx
+    idempotent = session.is_idempotent(method, idempotent)
+    if isinstance(kwargs.get("data"), (str, bytes)):
+        kwargs["content"] = kwargs.pop("data")
+
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            waited_from = time.perf_counter()
+            await asyncio.get_running_loop().run_in_executor(None, rate_limiter.acquire, priority)
+            metrics.record_wait(time.perf_counter() - waited_from)
+        try:
+            response = await get_client().request(method, url, **kwargs)
+        except httpx.TransportError:
+            metrics.record_call(retry=attempt > 0, error=True)
+            delay = session.error_retry_delay(attempt, idempotent, max_retries)
+            if delay is None:
+                raise
+        else:
+            metrics.record_call(len(response.request.content), len(response.content), retry=attempt > 0, error=response.status_code >= 400)
+            delay = session.response_retry_delay(response, attempt, idempotent, max_retries, rate_limiter)
+            if delay is None:
+                return response
+        attempt += 1
+        await asyncio.sleep(delay)
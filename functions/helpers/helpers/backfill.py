@@ -0,0 +1,211 @@
+import argparse
+import os
+import threading
+import time as clock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple, Union
+
+from . import kvstore, ratelimit, whoop
+from . import store as activity_store
+from .tokens import TokenManager
+
+DEFAULT_SHARD_DAYS = 30
+DEFAULT_WORKERS = 4
+CHECKPOINT_TABLE = "backfill_checkpoints"
+
+"""
+Loads the full history of WHOOP sleeps and workouts into an ActivityStore. The date range is
+split into shards of `shard_days` that are fetched concurrently by `workers` threads, all
+sharing the WHOOP rate limiter at bulk priority. After every page, a shard's next_token is
+checkpointed next to the store, so an interrupted backfill resumes where it stopped when run
+again with the same range and shard size.
+Access tokens expire after an hour, so runs longer than that need `access_token` to be a
+TokenManager or a callable that returns a current token, not a token string.
+"""
+class Backfill:
+    def __init__(self, access_token: Union[whoop.AccessToken, Callable[[], str]], store_path: str, start: datetime, end: datetime=None, collections: Tuple[str, ...]=activity_store.COLLECTIONS, shard_days: int=DEFAULT_SHARD_DAYS, workers: int=DEFAULT_WORKERS):
+        if shard_days < 1:
+            raise ValueError(f"shard_days must be at least 1, got {shard_days}")
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        for collection in collections:
+            if collection not in activity_store.COLLECTIONS:
+                raise ValueError(f"Unknown collection: {collection}")
+        self.access_token = _as_access_token(access_token)
+        self.start = _as_utc(start)
+        # an open-ended range runs to the end of today, which keeps the shards (and so their
+        # checkpoints) the same when an interrupted backfill is resumed later that day
+        self.end = _as_utc(end) if end is not None else datetime.combine(datetime.now(timezone.utc).date() + timedelta(days=1), datetime.min.time(), timezone.utc)
+        if self.start >= self.end:
+            raise ValueError(f"start ({self.start}) must be before end ({self.end})")
+        self.collections = tuple(collections)
+        self.shard_days = shard_days
+        self.workers = workers
+        self.store = activity_store.ActivityStore(store_path)
+        self.checkpoints = kvstore.SQLiteKV(store_path, table=CHECKPOINT_TABLE)
+        self.records = 0
+        self.pages = 0
+        self._lock = threading.Lock()
+        self._started_at = None
+
+    """
+    Returns the (collection, start, end) shards covering the range. Shards are counted from the
+    start of the range and returned newest first, so the recent history the stats read lands in
+    the store before the rest.
+    """
+    def shards(self) -> List[Tuple[str, datetime, datetime]]:
+        shards = []
+        shard_start = self.start
+        while shard_start < self.end:
+            shard_end = min(self.end, shard_start + timedelta(days=self.shard_days))
+            for collection in self.collections:
+                shards.append((collection, shard_start, shard_end))
+            shard_start = shard_end
+        return shards[::-1]
+
+    """
+    Fetches every shard that isn't checkpointed as done. Returns a summary with the number of
+    shards, records and pages fetched and the throughput.
+    """
+    def run(self) -> Dict[str, float]:
+        self._started_at = clock.monotonic()
+        shards = self.shards()
+        pending = [shard for shard in shards if not self._checkpoint(*shard).get("done")]
+        print(f"backfilling {len(pending)} of {len(shards)} shards from {self.start.isoformat()} to {self.end.isoformat()} with {self.workers} workers")
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="whoop-backfill") as executor:
+            futures = [executor.submit(self._run_shard, *shard) for shard in pending]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # stop handing out shards; the ones in flight finish their current page
+                for future in futures:
+                    future.cancel()
+                raise
+
+        self._update_sync_state()
+        summary = self.summary()
+        summary["shards"] = len(pending)
+        print(f"backfill finished: {summary['records']} records in {summary['seconds']:.1f}s ({summary['records_per_second']:.1f} records/s)")
+        return summary
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            seconds = clock.monotonic() - self._started_at if self._started_at is not None else 0.0
+            return {
+                "records": self.records,
+                "pages": self.pages,
+                "seconds": seconds,
+                "records_per_second": self.records / seconds if seconds > 0 else 0.0,
+            }
+
+    def _run_shard(self, collection: str, start: datetime, end: datetime):
+        checkpoint = self._checkpoint(collection, start, end)
+        shard_records = checkpoint.get("records", 0)
+        pages = whoop.iter_collection_pages(
+            self.access_token, whoop.COLLECTION_URLS[collection], start=start, end=end,
+            next_token=checkpoint.get("next_token"), priority=ratelimit.PRIORITY_BULK,
+        )
+        for page_records, next_token in pages:
+            self.store.upsert(collection, page_records)
+            shard_records += len(page_records)
+            self._count_page(page_records)
+            self.checkpoints.set(_checkpoint_key(collection, start, end), {"next_token": next_token, "records": shard_records, "done": not next_token})
+
+        summary = self.summary()
+        print(f"backfilled {collection} {start.date().isoformat()}..{end.date().isoformat()}: {shard_records} records ({summary['records']} total, {summary['records_per_second']:.1f} records/s)")
+
+    def _checkpoint(self, collection: str, start: datetime, end: datetime) -> dict:
+        return self.checkpoints.get(_checkpoint_key(collection, start, end), {})
+
+    def _count_page(self, page_records: list):
+        with self._lock:
+            self.records += len(page_records)
+            self.pages += 1
+
+    """
+    Extends the store's sync state over the backfilled range when it joins up with what was
+    already synced (or reaches the present), so incremental syncs don't fetch it again
+    """
+    def _update_sync_state(self):
+        now = datetime.now(timezone.utc)
+        for collection in self.collections:
+            synced_from, watermark = self.store.get_sync_state(collection)
+            latest = self.store.latest_update(collection)
+            if latest is not None:
+                watermark = latest if watermark is None else max(watermark, latest)
+            if synced_from is not None and synced_from <= self.end:
+                self.store.set_sync_state(collection, min(self.start, synced_from), watermark)
+            elif synced_from is None and self.end >= now - whoop.SYNC_LOOKBACK:
+                self.store.set_sync_state(collection, self.start, watermark)
+
+"""
+Function that backfills a store and returns the run's summary, see Backfill
+"""
+def backfill(access_token: Union[whoop.AccessToken, Callable[[], str]], store_path: str, start: datetime, end: datetime=None, collections: Tuple[str, ...]=activity_store.COLLECTIONS, shard_days: int=DEFAULT_SHARD_DAYS, workers: int=DEFAULT_WORKERS) -> Dict[str, float]:
+    return Backfill(access_token, store_path, start, end, collections, shard_days, workers).run()
+
+"""
+Function that returns what the whoop helpers take for `access_token`: a token string or a
+TokenManager as is, or for a callable a TokenManager that calls it again when WHOOP rejects its
+token
+"""
+def _as_access_token(access_token: Union[whoop.AccessToken, Callable[[], str]]) -> whoop.AccessToken:
+    if isinstance(access_token, (str, TokenManager)):
+        return access_token
+    if callable(access_token):
+        return TokenManager(lambda: (access_token(), None), lambda rejected_token: (access_token(), None))
+    raise ValueError(f"access_token must be a token, a TokenManager or a callable, got {type(access_token).__name__}")
+
+"""
+Function that returns a TokenManager for the command line: it starts from `access_token` (or a
+refresh if there is none) and refreshes with `refresh_token`. WHOOP replaces the refresh token on
+every refresh, so the new one is printed for the next run.
+"""
+def _refreshing_token_manager(access_token: str, refresh_token: str, client_id: str, client_secret: str) -> TokenManager:
+    current_refresh_token = [refresh_token]
+    def refresh(rejected_token: str) -> tuple:
+        response = whoop.request_tokens(current_refresh_token[0], client_id, client_secret)
+        current_refresh_token[0] = response["refresh_token"]
+        print("refreshed the WHOOP access token, the new refresh token is", response["refresh_token"])
+        return response["access_token"], clock.time() + response["expires_in"]
+    def load() -> tuple:
+        return refresh(None) if not access_token else (access_token, None)
+    return TokenManager(load, refresh)
+
+def _checkpoint_key(collection: str, start: datetime, end: datetime) -> str:
+    return f"{collection}:{start.isoformat()}:{end.isoformat()}"
+
+def _as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+def _parse_date(value: str) -> datetime:
+    return _as_utc(datetime.fromisoformat(value))
+
+def main(argv: List[str]=None):
+    parser = argparse.ArgumentParser(prog="python -m helpers.backfill", description="Backfill the WHOOP sleep and workout history into a local activity store")
+    parser.add_argument("--store", required=True, help="path of the SQLite activity store (checkpoints are kept in the same file)")
+    parser.add_argument("--start", required=True, type=_parse_date, help="earliest activity start to load, ie 2021-01-01")
+    parser.add_argument("--end", type=_parse_date, help="latest activity start to load (default: the end of today in UTC, so a resumed run keeps the same shards)")
+    parser.add_argument("--collections", nargs="+", choices=activity_store.COLLECTIONS, default=list(activity_store.COLLECTIONS))
+    parser.add_argument("--shard-days", type=int, default=DEFAULT_SHARD_DAYS)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--access-token", default=os.getenv("TEMP_WHOOP_ACCESS_TOKEN"), help="WHOOP access token (default: $TEMP_WHOOP_ACCESS_TOKEN)")
+    parser.add_argument("--refresh-token", default=os.getenv("TEMP_WHOOP_REFRESH_TOKEN"), help="WHOOP refresh token, to keep runs longer than the access token's hour going (default: $TEMP_WHOOP_REFRESH_TOKEN)")
+    parser.add_argument("--client-id", default=os.getenv("WHOOP_CLIENT_ID"), help="WHOOP client id, needed with --refresh-token (default: $WHOOP_CLIENT_ID)")
+    parser.add_argument("--client-secret", default=os.getenv("WHOOP_CLIENT_SECRET"), help="WHOOP client secret, needed with --refresh-token (default: $WHOOP_CLIENT_SECRET)")
+    args = parser.parse_args(argv)
+    if not args.access_token and not args.refresh_token:
+        parser.error("a WHOOP access or refresh token is required (--access-token or $TEMP_WHOOP_ACCESS_TOKEN)")
+
+    access_token = args.access_token
+    if args.refresh_token:
+        if not args.client_id or not args.client_secret:
+            parser.error("--refresh-token needs --client-id and --client-secret")
+        access_token = _refreshing_token_manager(args.access_token, args.refresh_token, args.client_id, args.client_secret)
+    backfill(access_token, args.store, args.start, args.end, tuple(args.collections), args.shard_days, args.workers)
+
+if __name__ == "__main__":
+    main()
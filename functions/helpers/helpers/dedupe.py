@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+
+# WHOOP gives up retrying a delivery well within a day
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 4096
+
+"""
+Bounded TTL/LRU set of delivery ids (WHOOP trace_ids) that were already handled. Ids are kept
+in memory for this instance and, if a backend with `get`/`set` such as kvstore.SQLiteKV is
+given, also persisted so other instances and restarts see them.
+"""
+class DedupeStore:
+    def __init__(self, max_entries: int=DEFAULT_MAX_ENTRIES, ttl_seconds: float=DEFAULT_TTL_SECONDS, backend=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # id -> expiry time
+        self._lock = threading.Lock()
+
+    def contains(self, key: str) -> bool:
+        now = time.time()
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is not None and expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self._entries.pop(key, None)
+
+        if self.backend is not None and self.backend.get(key) is not None:
+            self._remember(key, now + self.ttl_seconds)
+            with self._lock:
+                self.hits += 1
+            return True
+
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def add(self, key: str):
+        self._remember(key, time.time() + self.ttl_seconds)
+        if self.backend is not None:
+            self.backend.set(key, True, self.ttl_seconds)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _remember(self, key: str, expires_at: float):
+        with self._lock:
+            self._entries[key] = expires_at
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,166 @@
+import threading
+import time
+from datetime import datetime, time as day_time, timezone
+from typing import Any, Dict, Iterable, Optional
+
+# a stat is recomputed if it wasn't computed from (or confirmed by) a sync with WHOOP for this
+# long, which repairs deltas no webhook delivered. callers running on a schedule pick it relative
+# to their period (see main.RECONCILE_MAX_STAT_AGE_SECONDS)
+DEFAULT_MAX_AGE_SECONDS = 24 * 60 * 60
+# the stat windows move at midnight UTC (see whoop.window_start). a stat computed this close to
+# midnight is recomputed, since instance clocks or records scored late around the window edge may
+# have put a record on the wrong side of it
+DEFAULT_BOUNDARY_MARGIN_SECONDS = 60 * 60
+SECONDS_PER_DAY = 24 * 60 * 60
+
+"""
+What is known about one stat: when the data it was last computed from was read (`computed_at`),
+the window start and source watermark (latest `updated_at` in the activity store) it was
+computed with, the value last written to Notion, when its source last changed (`changed_at`),
+and when it was last computed from data synced with WHOOP rather than only from the records of
+webhook events (`synced_at`). A stat is dirty while a change came in after the data of its last
+compute was read.
+"""
+class StatFreshness:
+    def __init__(self, computed_at: float=None, window_start: float=None, watermark: float=None, value: str=None, changed_at: float=None, synced_at: float=None):
+        self.computed_at = computed_at
+        self.window_start = window_start
+        self.watermark = watermark
+        self.value = value
+        self.changed_at = changed_at
+        self.synced_at = synced_at
+
+    @property
+    def dirty(self) -> bool:
+        return self.changed_at is not None and (self.computed_at is None or self.changed_at > self.computed_at)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "computed_at": self.computed_at,
+            "window_start": self.window_start,
+            "watermark": self.watermark,
+            "value": self.value,
+            "changed_at": self.changed_at,
+            "synced_at": self.synced_at,
+        }
+
+    @classmethod
+    def from_dict(cls, values: Dict[str, Any]) -> "StatFreshness":
+        return cls(**values)
+
+    def __repr__(self) -> str:
+        return f"StatFreshness({self.to_dict()})"
+
+"""
+Per-stat freshness for one tenant, so reconcile_stats can leave alone the stats webhooks already
+kept current. Webhook processing marks the stats of a collection changed before computing them
+(mark_changed) and records them once their new values are written (record_compute). Entries are
+always kept in memory; if a backend with `get`/`set` such as kvstore.SQLiteKV is given, they are
+read from and written through to it, so other processes sharing it see them too. Only a shared
+backend like kvstore.GCSKV lets reconcile_stats see the computes of webhook instances.
+"""
+class FreshnessTracker:
+    def __init__(self, max_age_seconds: float=DEFAULT_MAX_AGE_SECONDS, boundary_margin_seconds: float=DEFAULT_BOUNDARY_MARGIN_SECONDS, backend=None, key_prefix: str=""):
+        if max_age_seconds <= 0:
+            raise ValueError(f"max_age_seconds must be positive, got {max_age_seconds}")
+        if boundary_margin_seconds < 0:
+            raise ValueError(f"boundary_margin_seconds can't be negative, got {boundary_margin_seconds}")
+        self.max_age_seconds = max_age_seconds
+        self.boundary_margin_seconds = boundary_margin_seconds
+        self.backend = backend
+        self.key_prefix = key_prefix
+        self._entries = {} # stat -> StatFreshness
+        self._lock = threading.Lock()
+
+    def get(self, stat: str) -> StatFreshness:
+        with self._lock:
+            return self._load(stat)
+
+    """
+    Marks stats whose source records changed (or are about to), ie when a webhook event arrives
+    """
+    def mark_changed(self, stats: Iterable[str], changed_at: float=None):
+        changed_at = time.time() if changed_at is None else changed_at
+        with self._lock:
+            for stat in stats:
+                entry = self._load(stat)
+                entry.changed_at = changed_at if entry.changed_at is None else max(entry.changed_at, changed_at)
+                self._save(stat, entry)
+
+    """
+    Records that `value` was computed from data read at `computed_at` and written. A change marked
+    after `computed_at` keeps the stat dirty, and an older compute finishing late is ignored. Only a
+    compute that `synced` its collection with WHOOP restarts the max age.
+    """
+    def record_compute(self, stat: str, value: str, computed_at: float, window_start: float, watermark: Optional[float], synced: bool=True):
+        with self._lock:
+            entry = self._load(stat)
+            if entry.computed_at is not None and entry.computed_at > computed_at:
+                return
+            entry.computed_at = computed_at
+            if synced:
+                entry.synced_at = computed_at
+            entry.window_start = window_start
+            entry.watermark = watermark
+            entry.value = value
+            self._save(stat, entry)
+
+    """
+    Records that the source of stats was synced with WHOOP at `synced_at` without any change, which
+    confirms the values last computed the same way a synced compute would. Stats that are dirty or
+    were never computed are left alone.
+    """
+    def mark_synced(self, stats: Iterable[str], synced_at: float=None):
+        synced_at = time.time() if synced_at is None else synced_at
+        with self._lock:
+            for stat in stats:
+                entry = self._load(stat)
+                if entry.computed_at is None or entry.dirty:
+                    continue
+                entry.synced_at = synced_at if entry.synced_at is None else max(entry.synced_at, synced_at)
+                self._save(stat, entry)
+
+    """
+    Returns why a stat has to be recomputed given its current window start and source watermark,
+    or None if the value last written is still current
+    """
+    def stale_reason(self, stat: str, window_start: float, watermark: Optional[float], now: float=None) -> Optional[str]:
+        now = time.time() if now is None else now
+        entry = self.get(stat)
+        if entry.computed_at is None:
+            return "never computed"
+        if entry.dirty:
+            return "dirty"
+        if window_start != entry.window_start:
+            return "window moved"
+        if watermark is not None and (entry.watermark is None or watermark > entry.watermark):
+            return "source changed"
+        if entry.synced_at is None or now - entry.synced_at >= self.max_age_seconds:
+            return "max age"
+        if seconds_from_midnight(entry.computed_at) < self.boundary_margin_seconds:
+            return "near window boundary"
+        return None
+
+    def _load(self, stat: str) -> StatFreshness:
+        if self.backend is not None:
+            values = self.backend.get(self._key(stat))
+            if values is not None:
+                self._entries[stat] = StatFreshness.from_dict(values)
+        entry = self._entries.get(stat)
+        return StatFreshness() if entry is None else entry
+
+    def _save(self, stat: str, entry: StatFreshness):
+        self._entries[stat] = entry
+        if self.backend is not None:
+            self.backend.set(self._key(stat), entry.to_dict())
+
+    def _key(self, stat: str) -> str:
+        return f"freshness:{self.key_prefix}{stat}"
+
+"""
+Function that returns how far an epoch timestamp is from the nearest midnight UTC, in seconds
+"""
+def seconds_from_midnight(timestamp: float) -> float:
+    utc = datetime.fromtimestamp(timestamp, timezone.utc)
+    since_midnight = (utc - datetime.combine(utc.date(), day_time.min, timezone.utc)).total_seconds()
+    return min(since_midnight, SECONDS_PER_DAY - since_midnight)
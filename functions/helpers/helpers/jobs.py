@@ -0,0 +1,322 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List
+
+# how long a pulled message stays leased before it is handed out again
+DEFAULT_ACK_DEADLINE_SECONDS = 60
+DEFAULT_MAX_MESSAGES = 100
+# how long a finished recompute is remembered for dropping events it already covered
+COVERED_FOR_SECONDS = 60 * 60
+
+"""
+Function that reduces a WHOOP webhook body to the compact job put on the queue
+"""
+def make_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": payload["type"],
+        "id": payload.get("id"),
+        "trace_id": payload.get("trace_id"),
+        "user_id": payload.get("user_id"),
+    }
+
+"""
+Function that serializes a job into a queue message body
+"""
+def encode_job(job: Dict[str, Any]) -> bytes:
+    return json.dumps(job, separators=(",", ":")).encode("utf-8")
+
+"""
+Function that deserializes a queue message body into a job
+"""
+def decode_job(data: bytes) -> Dict[str, Any]:
+    return json.loads(data.decode("utf-8"))
+
+"""
+A message handed out by `pull`, shaped like a Pub/Sub ReceivedMessage
+"""
+class ReceivedMessage:
+    def __init__(self, ack_id: str, message_id: str, data: bytes, publish_time: float):
+        self.ack_id = ack_id
+        self.message_id = message_id
+        self.data = data
+        self.publish_time = publish_time
+
+"""
+In-process stand-in for a Pub/Sub topic with a single pull subscription. Messages that are
+pulled but not acknowledged before their ack deadline are delivered again.
+"""
+class InMemoryQueue:
+    def __init__(self, ack_deadline_seconds: int=DEFAULT_ACK_DEADLINE_SECONDS):
+        self.ack_deadline_seconds = ack_deadline_seconds
+        self._messages = {} # topic -> {message id: [data, publish time, lease expiry, ack id]}
+        self._lock = threading.Lock()
+
+    def publish(self, topic: str, data: bytes) -> str:
+        message_id = uuid.uuid4().hex
+        with self._lock:
+            self._messages.setdefault(topic, {})[message_id] = [data, time.time(), 0.0, None]
+        return message_id
+
+    def pull(self, topic: str, max_messages: int=DEFAULT_MAX_MESSAGES) -> List[ReceivedMessage]:
+        now = time.time()
+        received = []
+        with self._lock:
+            for message_id, message in self._messages.get(topic, {}).items():
+                if len(received) >= max_messages:
+                    break
+                if message[2] > now:
+                    continue
+                message[2] = now + self.ack_deadline_seconds
+                message[3] = uuid.uuid4().hex
+                received.append(ReceivedMessage(f"{message_id}:{message[3]}", message_id, message[0], message[1]))
+        return received
+
+    def acknowledge(self, topic: str, ack_ids: List[str]):
+        with self._lock:
+            messages = self._messages.get(topic, {})
+            for ack_id in ack_ids:
+                message_id, lease_id = ack_id.split(":")
+                if message_id in messages and messages[message_id][3] == lease_id:
+                    del messages[message_id]
+
+    def modify_ack_deadline(self, topic: str, ack_ids: List[str], ack_deadline_seconds: int):
+        with self._lock:
+            messages = self._messages.get(topic, {})
+            for ack_id in ack_ids:
+                message_id, lease_id = ack_id.split(":")
+                if message_id in messages and messages[message_id][3] == lease_id:
+                    messages[message_id][2] = time.time() + ack_deadline_seconds
+
+"""
+SQLite-backed stand-in for a Pub/Sub topic with a single pull subscription, so queued jobs
+survive restarts and can be shared by separate local processes.
+"""
+class SQLiteQueue:
+    def __init__(self, path: str, ack_deadline_seconds: int=DEFAULT_ACK_DEADLINE_SECONDS):
+        self.ack_deadline_seconds = ack_deadline_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS messages (
+                message_id TEXT PRIMARY KEY,
+                topic TEXT NOT NULL,
+                data BLOB NOT NULL,
+                publish_time REAL NOT NULL,
+                lease_expiry REAL NOT NULL DEFAULT 0,
+                lease_id TEXT
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS messages_by_topic ON messages (topic, publish_time)")
+
+    def publish(self, topic: str, data: bytes) -> str:
+        message_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO messages (message_id, topic, data, publish_time) VALUES (?, ?, ?, ?)",
+                (message_id, topic, data, time.time()),
+            )
+        return message_id
+
+    def pull(self, topic: str, max_messages: int=DEFAULT_MAX_MESSAGES) -> List[ReceivedMessage]:
+        now = time.time()
+        received = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT message_id, data, publish_time FROM messages WHERE topic = ? AND lease_expiry <= ? ORDER BY publish_time LIMIT ?",
+                    (topic, now, max_messages),
+                ).fetchall()
+                for message_id, data, publish_time in rows:
+                    lease_id = uuid.uuid4().hex
+                    self._conn.execute(
+                        "UPDATE messages SET lease_expiry = ?, lease_id = ? WHERE message_id = ?",
+                        (now + self.ack_deadline_seconds, lease_id, message_id),
+                    )
+                    received.append(ReceivedMessage(f"{message_id}:{lease_id}", message_id, bytes(data), publish_time))
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+        return received
+
+    def acknowledge(self, topic: str, ack_ids: List[str]):
+        with self._lock:
+            for ack_id in ack_ids:
+                message_id, lease_id = ack_id.split(":")
+                self._conn.execute(
+                    "DELETE FROM messages WHERE topic = ? AND message_id = ? AND lease_id = ?",
+                    (topic, message_id, lease_id),
+                )
+
+    def modify_ack_deadline(self, topic: str, ack_ids: List[str], ack_deadline_seconds: int):
+        with self._lock:
+            for ack_id in ack_ids:
+                message_id, lease_id = ack_id.split(":")
+                self._conn.execute(
+                    "UPDATE messages SET lease_expiry = ? WHERE topic = ? AND message_id = ? AND lease_id = ?",
+                    (time.time() + ack_deadline_seconds, topic, message_id, lease_id),
+                )
+
+"""
+Function that pulls queued jobs and runs `handler` on each one. Jobs are acknowledged only
+once the handler returns; failed jobs are released for redelivery. Returns the number of jobs
+that were processed successfully.
+"""
+def drain(queue, topic: str, handler: Callable[[Dict[str, Any]], Any], max_messages: int=DEFAULT_MAX_MESSAGES) -> int:
+    processed = 0
+    while True:
+        messages = queue.pull(topic, max_messages)
+        if not messages:
+            return processed
+        failed = []
+        for message in messages:
+            try:
+                handler(decode_job(message.data))
+            except Exception as e:
+                print(f"Job {message.message_id} failed, releasing for redelivery:", e)
+                failed.append(message.ack_id)
+            else:
+                queue.acknowledge(topic, [message.ack_id])
+                processed += 1
+        if failed:
+            queue.modify_ack_deadline(topic, failed, 0)
+            return processed
+
+"""
+Function that returns the recompute a job belongs to. Every sleep event of a user triggers the
+same sleep recompute and every workout event the same workout recompute, whatever record changed.
+"""
+def coalesce_key(job: Dict[str, Any]) -> str:
+    type = job["type"]
+    if "sleep" in type:
+        key = "sleep"
+    elif "workout" in type:
+        key = "workout"
+    else:
+        key = type
+    user_id = job.get("user_id")
+    return key if user_id is None else f"{user_id}:{key}"
+
+"""
+Jobs that were merged into a single recompute. `folded` is the number of events it covers.
+"""
+class CoalescedBatch:
+    def __init__(self, key: str, jobs: List[Dict[str, Any]], ack_ids: List[str]):
+        self.key = key
+        self.jobs = jobs
+        self.ack_ids = ack_ids
+
+    @property
+    def folded(self) -> int:
+        return len(self.jobs)
+
+    @property
+    def latest(self) -> Dict[str, Any]:
+        return self.jobs[-1]
+
+"""
+Debounces bursts of events per recompute key. Events are held until no new event for the same
+key has arrived for `window_seconds`, then released together as one CoalescedBatch. It also
+remembers when recomputes started, so an event published before one started can be dropped
+because the recompute already saw its data. A recompute only covers the records it fetched: the
+records of its own events, or every record of its key if it synced the whole collection.
+"""
+class EventCoalescer:
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self._pending = {} # key -> [jobs, ack ids, time of latest event]
+        self._last_started = {} # (key, record id or None for all records) -> time the latest recompute started
+        self._lock = threading.Lock()
+
+    def offer(self, job: Dict[str, Any], received_at: float, ack_id: str=None):
+        key = coalesce_key(job)
+        with self._lock:
+            pending = self._pending.setdefault(key, [[], [], received_at])
+            pending[0].append(job)
+            if ack_id is not None:
+                pending[1].append(ack_id)
+            pending[2] = max(pending[2], received_at)
+
+    def ready(self, now: float=None, force: bool=False) -> List[CoalescedBatch]:
+        now = time.time() if now is None else now
+        batches = []
+        with self._lock:
+            for key in list(self._pending):
+                jobs, ack_ids, latest = self._pending[key]
+                if force or now - latest >= self.window_seconds:
+                    del self._pending[key]
+                    batches.append(CoalescedBatch(key, jobs, ack_ids))
+        return batches
+
+    def pending(self) -> List[CoalescedBatch]:
+        with self._lock:
+            return [CoalescedBatch(key, jobs, ack_ids) for key, (jobs, ack_ids, _) in self._pending.items()]
+
+    """
+    Records that a recompute of `job_list` started at `started_at` and succeeded. `synced` means it
+    re-read the whole collection rather than only the records of its jobs. Starts older than
+    COVERED_FOR_SECONDS are forgotten; an event that old is just recomputed again.
+    """
+    def mark_started(self, job_list: List[Dict[str, Any]], started_at: float=None, synced: bool=False):
+        started_at = time.time() if started_at is None else started_at
+        with self._lock:
+            for job in job_list:
+                key = coalesce_key(job)
+                if job.get("id") is not None:
+                    self._mark(key, job["id"], started_at)
+                if synced:
+                    self._mark(key, None, started_at)
+            for covered, covered_at in list(self._last_started.items()):
+                if covered_at < started_at - COVERED_FOR_SECONDS:
+                    del self._last_started[covered]
+
+    def already_covered(self, job: Dict[str, Any], published_at: float) -> bool:
+        key = coalesce_key(job)
+        with self._lock:
+            started = [self._last_started.get((key, None))]
+            if job.get("id") is not None:
+                started.append(self._last_started.get((key, job["id"])))
+        return any(started_at is not None and published_at < started_at for started_at in started)
+
+    def _mark(self, key: str, record_id, started_at: float):
+        covered = (key, record_id)
+        self._last_started[covered] = max(started_at, self._last_started.get(covered, started_at))
+
+"""
+Function like `drain` that merges queued jobs per recompute key before running `handler`.
+`handler` receives one CoalescedBatch per recompute and returns whether it synced the whole
+collection rather than only fetching the records of the batch's jobs. Batches that are still inside their
+debounce window are left on the queue until the window has passed, unless `force` is set.
+Returns the batches that were processed successfully.
+"""
+def drain_coalesced(queue, topic: str, handler: Callable[[CoalescedBatch], Any], coalescer: EventCoalescer, max_messages: int=DEFAULT_MAX_MESSAGES, force: bool=False) -> List[CoalescedBatch]:
+    while True:
+        messages = queue.pull(topic, max_messages)
+        for message in messages:
+            coalescer.offer(decode_job(message.data), message.publish_time, message.ack_id)
+        if len(messages) < max_messages:
+            break
+
+    processed = []
+    now = time.time()
+    for batch in coalescer.ready(now, force):
+        try:
+            synced = handler(batch)
+        except Exception as e:
+            print(f"Recompute of {batch.key} failed, releasing {batch.folded} jobs for redelivery:", e)
+            queue.modify_ack_deadline(topic, batch.ack_ids, 0)
+        else:
+            # only a recompute that succeeded covers the events published before it started
+            coalescer.mark_started(batch.jobs, now, bool(synced))
+            queue.acknowledge(topic, batch.ack_ids)
+            processed.append(batch)
+
+    # hand still-debouncing jobs back to the queue once their window has passed
+    for batch in coalescer.ready(force=True):
+        queue.modify_ack_deadline(topic, batch.ack_ids, int(coalescer.window_seconds) + 1)
+    return processed
@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any
+
+"""
+Small persistent key/value store on top of SQLite. Values are stored as JSON and can be given
+a time to live, after which `get` treats them as missing.
+"""
+class SQLiteKV:
+    def __init__(self, path: str, table: str="kv"):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table}")
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+
+    def get(self, key: str, default: Any=None) -> Any:
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return default
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl_seconds: float=None):
+        expires_at = None if ttl_seconds is None else time.time() + ttl_seconds
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at),
+            )
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._conn.execute(f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)).rowcount
+
+"""
+Key/value store on Cloud Storage with the interface of SQLiteKV, for state that every instance
+of every function has to see (a SQLiteKV only lives on one instance's disk). Each key is one JSON
+object under `prefix`. The storage client is created on first use, which keeps it out of cold
+starts.
+"""
+class GCSKV:
+    def __init__(self, bucket: str, prefix: str=""):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any=None) -> Any:
+        from google.api_core import exceptions
+        try:
+            entry = json.loads(self._blob(key).download_as_bytes())
+        except exceptions.NotFound:
+            return default
+        if entry["expires_at"] is not None and entry["expires_at"] <= time.time():
+            return default
+        return entry["value"]
+
+    def set(self, key: str, value: Any, ttl_seconds: float=None):
+        expires_at = None if ttl_seconds is None else time.time() + ttl_seconds
+        self._blob(key).upload_from_string(json.dumps({"value": value, "expires_at": expires_at}), content_type="application/json")
+
+    def delete(self, key: str):
+        from google.api_core import exceptions
+        try:
+            self._blob(key).delete()
+        except exceptions.NotFound:
+            pass
+
+    def _blob(self, key: str):
+        with self._lock:
+            if self._bucket is None:
+                from google.cloud import storage
+                self._bucket = storage.Client().bucket(self.bucket)
+        return self._bucket.blob(f"{self.prefix}/{key}" if self.prefix else key)
+
+"""
+Function that opens the store at a location: "gs://bucket/prefix" for a GCSKV shared by every
+instance (with `table` appended to the prefix), or the path of a SQLite file
+"""
+def open_store(location: str, table: str="kv"):
+    if location.startswith("gs://"):
+        bucket, _, prefix = location[len("gs://"):].partition("/")
+        return GCSKV(bucket, f"{prefix.strip('/')}/{table}" if prefix.strip("/") else table)
+    return SQLiteKV(location, table)
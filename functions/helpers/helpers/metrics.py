@@ -0,0 +1,343 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List
+
+# upper bounds in seconds of the Prometheus span duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# counters every span keeps for the outbound calls made while it was open
+COUNTERS = ("calls", "retries", "errors", "bytes_sent", "bytes_received", "rate_limit_wait_seconds")
+DEFAULT_EXPORT_BATCH_SIZE = 64
+# an unreachable collector must not hold up the invocation whose root span triggered the export
+EXPORT_TIMEOUT_SECONDS = 5
+
+# the spans open in the current thread or task, innermost last
+_open_spans = contextvars.ContextVar("helpers_metrics_open_spans", default=())
+_sinks = []
+_sinks_lock = threading.Lock()
+
+"""
+One timed stage of an invocation (ie "secret_fetch", "whoop_fetch", "notion_write"). Spans
+opened while another one is open become its children and share its trace id. Outbound calls
+count towards every open span, so a parent's counters include its children's.
+"""
+class Span:
+    def __init__(self, name: str, attributes: Dict[str, Any], parent: "Span"=None):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns = None
+        self.duration_seconds = None
+        self.status = "ok"
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @property
+    def is_root(self) -> bool:
+        return self.parent is None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, counter: str, amount: float=1):
+        with self._lock:
+            self.counts[counter] += amount
+
+    def finish(self):
+        self.duration_seconds = time.perf_counter() - self._started
+        self.end_time_ns = self.start_time_ns + int(self.duration_seconds * 1e9)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "span": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent.span_id if self.parent is not None else None,
+            "status": self.status,
+            "duration_ms": round(self.duration_seconds * 1000, 3),
+            **{counter: round(value, 6) for counter, value in self.counts.items()},
+            "attributes": self.attributes,
+        }
+
+"""
+Context manager that times a stage and hands the finished span to every sink, ie
+    with metrics.span("notion_write", stat=stat_string) as span:
+        ...
+        span.set(result="updated")
+An exception leaving the block marks the span as failed and is re-raised.
+"""
+@contextmanager
+def span(name: str, **attributes):
+    open_spans = _open_spans.get()
+    current = Span(name, attributes, open_spans[-1] if open_spans else None)
+    token = _open_spans.set(open_spans + (current,))
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        _open_spans.reset(token)
+        current.finish()
+        _emit(current)
+
+"""
+Decorator that runs a whole function (or coroutine function) in a span
+"""
+def traced(name: str, **attributes):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **attributes):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+"""
+Function that returns the innermost open span, or None
+"""
+def current_span() -> Span:
+    open_spans = _open_spans.get()
+    return open_spans[-1] if open_spans else None
+
+"""
+Function that counts one outbound HTTP attempt towards every open span. session.request and
+aio.request call it for each attempt, so retries show up as extra calls.
+"""
+def record_call(bytes_sent: int=0, bytes_received: int=0, retry: bool=False, error: bool=False):
+    for open_span in _open_spans.get():
+        with open_span._lock:
+            counts = open_span.counts
+            counts["calls"] += 1
+            counts["bytes_sent"] += bytes_sent
+            counts["bytes_received"] += bytes_received
+            if retry:
+                counts["retries"] += 1
+            if error:
+                counts["errors"] += 1
+
+"""
+Function that counts time spent waiting for a rate limiter towards every open span
+"""
+def record_wait(seconds: float):
+    for open_span in _open_spans.get():
+        open_span.add("rate_limit_wait_seconds", seconds)
+
+"""
+Function that wraps `function` to run with the spans open right now, for handing work to a
+thread pool. Each wrapper may only run once at a time, so wrap once per submitted task.
+"""
+def propagate(function: Callable) -> Callable:
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+"""
+Function that wraps a coroutine to run with the spans open right now, for coroutines handed to
+an event loop in another thread (see aio.run)
+"""
+def bind(coroutine: Awaitable) -> Awaitable:
+    open_spans = _open_spans.get()
+
+    async def bound():
+        token = _open_spans.set(open_spans)
+        try:
+            return await coroutine
+        finally:
+            _open_spans.reset(token)
+    return bound()
+
+"""
+Functions that manage where finished spans go. Sinks have a `record(span)` method, see
+JSONLogSink, PrometheusSink and SpanExporter.
+"""
+def add_sink(sink):
+    with _sinks_lock:
+        _sinks.append(sink)
+
+def remove_sink(sink):
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+def set_sinks(sinks: list):
+    with _sinks_lock:
+        _sinks[:] = sinks
+
+def get_sinks() -> list:
+    with _sinks_lock:
+        return list(_sinks)
+
+def _emit(finished: Span):
+    for sink in get_sinks():
+        try:
+            sink.record(finished)
+        except Exception as e:
+            # a broken sink must never fail the invocation it is measuring
+            print(f"metrics sink {type(sink).__name__} failed: {e!r}")
+
+"""
+Prints every span as one JSON line, which Cloud Logging stores as a structured entry
+(jsonPayload) that log-based metrics and queries can use. The spans of one invocation share
+their trace_id.
+"""
+class JSONLogSink:
+    def __init__(self, print_function: Callable[[str], Any]=print):
+        self._print = print_function
+
+    def record(self, finished: Span):
+        entry = finished.to_dict()
+        entry["severity"] = "ERROR" if finished.status == "error" else "INFO"
+        entry["message"] = f"{finished.name} took {entry['duration_ms']:.1f} ms"
+        self._print(json.dumps(entry, default=str))
+
+"""
+Aggregates spans into Prometheus metrics per span name: a duration histogram and a counter for
+each of COUNTERS. `render` returns the text exposition format; with a `path` the text is also
+written there (atomically) whenever a root span finishes, ie for a node_exporter textfile collector.
+"""
+class PrometheusSink:
+    def __init__(self, path: str=None, namespace: str="pipeline", buckets: tuple=DURATION_BUCKETS):
+        self.path = path
+        self.namespace = namespace
+        self.buckets = tuple(sorted(buckets))
+        self._stages = {} # span name -> {"buckets": [...], "sum": s, "count": n, "failed": n, counters...}
+        self._lock = threading.Lock()
+
+    def record(self, finished: Span):
+        with self._lock:
+            stage = self._stages.get(finished.name)
+            if stage is None:
+                stage = self._stages[finished.name] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0, "failed": 0, **dict.fromkeys(COUNTERS, 0)}
+            for number, bound in enumerate(self.buckets):
+                if finished.duration_seconds <= bound:
+                    stage["buckets"][number] += 1
+            stage["sum"] += finished.duration_seconds
+            stage["count"] += 1
+            if finished.status == "error":
+                stage["failed"] += 1
+            for counter in COUNTERS:
+                stage[counter] += finished.counts[counter]
+        if self.path and finished.is_root:
+            self.write(self.path)
+
+    def render(self) -> str:
+        prefix = self.namespace + "_span"
+        with self._lock:
+            stages = {name: dict(stage, buckets=list(stage["buckets"])) for name, stage in sorted(self._stages.items())}
+
+        lines = [
+            f"# HELP {prefix}_duration_seconds Time spent in each pipeline stage.",
+            f"# TYPE {prefix}_duration_seconds histogram",
+        ]
+        for name, stage in stages.items():
+            for bound, count in zip(self.buckets, stage["buckets"]):
+                lines.append(f'{prefix}_duration_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+            lines.append(f'{prefix}_duration_seconds_bucket{{span="{name}",le="+Inf"}} {stage["count"]}')
+            lines.append(f'{prefix}_duration_seconds_sum{{span="{name}"}} {stage["sum"]}')
+            lines.append(f'{prefix}_duration_seconds_count{{span="{name}"}} {stage["count"]}')
+
+        lines.append(f"# HELP {prefix}_failed_total Spans that ended with an exception.")
+        lines.append(f"# TYPE {prefix}_failed_total counter")
+        for name, stage in stages.items():
+            lines.append(f'{prefix}_failed_total{{span="{name}"}} {stage["failed"]}')
+        for counter in COUNTERS:
+            metric = f"{prefix}_{counter}" if counter.endswith("_seconds") else f"{prefix}_{counter}_total"
+            lines.append(f"# HELP {metric} Outbound {counter.replace('_', ' ')} made within each pipeline stage.")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stage in stages.items():
+                lines.append(f'{metric}{{span="{name}"}} {stage[counter]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+"""
+OpenTelemetry-style span exporter: converts spans to OTLP/JSON span objects and hands them to
+`export` in batches, ie to forward them to an OpenTelemetry SDK or collector (see
+otlp_http_export). A batch is sent when it is full and whenever a root span finishes, so each
+invocation's spans leave before the instance may be frozen.
+"""
+class SpanExporter:
+    def __init__(self, export: Callable[[List[Dict[str, Any]]], Any], max_batch_size: int=DEFAULT_EXPORT_BATCH_SIZE):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        self._export = export
+        self.max_batch_size = max_batch_size
+        self._batch = []
+        self._lock = threading.Lock()
+
+    def record(self, finished: Span):
+        with self._lock:
+            self._batch.append(to_otlp_span(finished))
+            full = len(self._batch) >= self.max_batch_size
+        if full or finished.is_root:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self._export(batch)
+
+"""
+Function that converts a finished span to an OTLP/JSON span object
+"""
+def to_otlp_span(finished: Span) -> Dict[str, Any]:
+    attributes = dict(finished.attributes)
+    attributes.update({f"pipeline.{counter}": value for counter, value in finished.counts.items()})
+    return {
+        "traceId": finished.trace_id,
+        "spanId": finished.span_id,
+        "parentSpanId": finished.parent.span_id if finished.parent is not None else "",
+        "name": finished.name,
+        "kind": 1, # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(finished.start_time_ns),
+        "endTimeUnixNano": str(finished.end_time_ns),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()],
+        "status": {"code": 2 if finished.status == "error" else 1},
+    }
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+"""
+Function that returns an `export` callable for SpanExporter which POSTs batches to an OTLP/HTTP
+traces endpoint (ie http://collector:4318/v1/traces) as JSON
+"""
+def otlp_http_export(endpoint: str, service_name: str, headers: Dict[str, str]=None) -> Callable[[List[Dict[str, Any]]], None]:
+    from . import session
+
+    def export(spans: List[Dict[str, Any]]):
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{"scope": {"name": "helpers.metrics"}, "spans": spans}],
+        }]}
+        response = session.post(endpoint, data=json.dumps(body), headers={"Content-Type": "application/json", **(headers or {})}, max_retries=1, timeout=EXPORT_TIMEOUT_SECONDS)
+        response.raise_for_status()
+    return export
@@ -1,10 +1,18 @@
-import requests
+import asyncio
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any
 from enum import Enum
 
+from . import aio, metrics, ratelimit, session
+
 # Notion API constants
-NOTION_PAGES_ENDPOINT = "https://api.notion.com/v1/pages"
+NOTION_API_ENDPOINT = "https://api.notion.com/v1"
+NOTION_PAGES_ENDPOINT = NOTION_API_ENDPOINT + "/pages"
+NOTION_QUERY_PAGE_SIZE = 100 # largest page size Notion accepts
+NOTION_REQUESTS_PER_SECOND = 3 # Notion allows an average of 3 requests per second per integration
+NOTION_MAX_CONCURRENT_WRITES = 3
 SLEEP_STAT_STRING = "Average Sleep (last 10 days)"
 SLEEP_TARGET_STRING = ">7.5 hrs"
 ZONE_2_STAT_STRING = "Zone 2 (last 7 days)"
@@ -16,32 +24,249 @@ class STAT_TYPE(Enum):
     ZONE_2 = 2
     ZONE_5 = 3
 
+"""
+Raised when a page from the stat index no longer exists or was archived
+"""
+class StalePageError(Exception):
+    pass
+
+# database id -> {stat title: page id}, kept across warm invocations
+_page_index = {}
+_page_index_lock = threading.Lock()
+# every Notion request waits for a token, webhook-driven updates ahead of bulk writes. Notion limits
+# each integration separately, so callers writing for several integrations pass their own limiter
+_rate_limiter = ratelimit.TokenBucket(NOTION_REQUESTS_PER_SECOND)
+# page id -> (value, target) last written to it, so unchanged stats can skip their write.
+# an optional backend with get/set (ie kvstore.SQLiteKV) persists them across instances
+_last_written = {}
+_last_written_lock = threading.Lock()
+_last_written_backend = None
+_write_counts = {"written": 0, "skipped": 0}
+_write_executor = ThreadPoolExecutor(max_workers=NOTION_MAX_CONCURRENT_WRITES, thread_name_prefix="notion-write")
+
 """
 Function that updates row on selected Notion Dashboard
 """
-def update_stat(stat_type: STAT_TYPE, stat_value: str, integration_secret: str, database_id: str):
+def update_stat(stat_type: STAT_TYPE, stat_value: str, integration_secret: str, database_id: str, force: bool=False, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None):
+    stat_string, target_string = _get_stat_strings(stat_type)
+    payload = _create_db_entry_payload(stat_string, stat_value, target_string, database_id)
+    page_id = _get_page_id(stat_string, integration_secret, database_id, priority=priority, rate_limiter=rate_limiter)
+    result = _write_stat(stat_string, payload, page_id, integration_secret, database_id, force, priority, rate_limiter)
+    print("Finished updating notion:", result)
+
+"""
+Function that updates several rows on selected Notion Dashboard at once, ie
+update_stats({STAT_TYPE.ZONE_2: "150", STAT_TYPE.ZONE_5: "16"}, ...). The target pages are
+resolved with at most one database query and the writes are sent concurrently, at most
+NOTION_MAX_CONCURRENT_WRITES at a time. Returns each stat's result: "updated", "created",
+"skipped" (value and target unchanged, unless `force` is set), or the exception its write raised.
+Pass priority=ratelimit.PRIORITY_BULK for writes that may wait behind webhook-driven ones, and
+a `rate_limiter` for an integration other than the default one.
+"""
+def update_stats(stat_values: Dict[STAT_TYPE, str], integration_secret: str, database_id: str, force: bool=False, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None) -> Dict[STAT_TYPE, Any]:
+    writes = {}
+    for stat_type, stat_value in stat_values.items():
+        stat_string, target_string = _get_stat_strings(stat_type)
+        payload = _create_db_entry_payload(stat_string, stat_value, target_string, database_id)
+        page_id = _get_page_id(stat_string, integration_secret, database_id, priority=priority, rate_limiter=rate_limiter)
+        writes[stat_type] = (stat_string, payload, page_id)
+
+    futures = {
+        stat_type: _write_executor.submit(metrics.propagate(_write_stat), stat_string, payload, page_id, integration_secret, database_id, force, priority, rate_limiter)
+        for stat_type, (stat_string, payload, page_id) in writes.items()
+    }
+    results = {}
+    for stat_type, future in futures.items():
+        try:
+            results[stat_type] = future.result()
+        except Exception as e:
+            results[stat_type] = e
+    print("Finished updating notion:", {stat_type.name: result for stat_type, result in results.items()})
+    return results
+
+"""
+Async counterpart of update_stats. The writes are pipelined on the event loop instead of the
+write thread pool; the shared rate limiter still paces them.
+"""
+async def update_stats_async(stat_values: Dict[STAT_TYPE, str], integration_secret: str, database_id: str, force: bool=False, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None) -> Dict[STAT_TYPE, Any]:
+    writes = {}
+    for stat_type, stat_value in stat_values.items():
+        stat_string, target_string = _get_stat_strings(stat_type)
+        payload = _create_db_entry_payload(stat_string, stat_value, target_string, database_id)
+        page_id = await _get_page_id_async(stat_string, integration_secret, database_id, priority=priority, rate_limiter=rate_limiter)
+        writes[stat_type] = (stat_string, payload, page_id)
+
+    outcomes = await asyncio.gather(*[
+        _write_stat_async(stat_string, payload, page_id, integration_secret, database_id, force, priority, rate_limiter)
+        for stat_string, payload, page_id in writes.values()
+    ], return_exceptions=True)
+    results = dict(zip(writes, outcomes))
+    print("Finished updating notion:", {stat_type.name: result for stat_type, result in results.items()})
+    return results
+
+"""
+Function that persists the last written values through `backend` (anything with get/set, ie
+kvstore.SQLiteKV), so other instances can skip unchanged writes too
+"""
+def set_value_backend(backend):
+    global _last_written_backend
+    _last_written_backend = backend
+
+"""
+Function that returns how many stat writes were sent and how many were skipped as unchanged
+"""
+def get_write_counts() -> Dict[str, int]:
+    with _last_written_lock:
+        return dict(_write_counts)
+
+"""
+Function that forgets the cached stat -> page mapping of one database, or of all databases
+"""
+def invalidate_page_index(database_id: str=None):
+    with _page_index_lock:
+        if database_id is None:
+            _page_index.clear()
+        else:
+            _page_index.pop(database_id, None)
+
+"""
+Function that writes one stat row: PATCHes the indexed page, or creates the row if there is none.
+A page whose Value and Target were already written is left alone unless `force` is set.
+Returns "updated", "created" or "skipped".
+"""
+def _write_stat(stat_string: str, payload: Dict[str, Any], page_id: str, integration_secret: str, database_id: str, force: bool=False, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None) -> str:
+    values = _get_written_values(payload)
+    if _is_unchanged(page_id, values, force):
+        return "skipped"
+
+    with metrics.span("notion_write", stat=stat_string) as span:
+        result = None
+        if page_id:
+            try:
+                _update_db_entry(page_id, payload, integration_secret, priority, rate_limiter)
+                result = "updated"
+            except StalePageError:
+                _forget_stale_page(stat_string, page_id)
+                page_id = _get_page_id(stat_string, integration_secret, database_id, refresh=True, priority=priority, rate_limiter=rate_limiter)
+                if page_id:
+                    _update_db_entry(page_id, payload, integration_secret, priority, rate_limiter)
+                    result = "updated"
+
+        if result is None:
+            page_id = _create_db_entry(payload, integration_secret, priority, rate_limiter)
+            result = "created"
+        return _finish_write(span, result, stat_string, page_id, values, database_id)
+
+"""
+Async counterpart of _write_stat; the decisions are shared through the helpers below
+"""
+async def _write_stat_async(stat_string: str, payload: Dict[str, Any], page_id: str, integration_secret: str, database_id: str, force: bool=False, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None) -> str:
+    values = _get_written_values(payload)
+    if _is_unchanged(page_id, values, force):
+        return "skipped"
+
+    with metrics.span("notion_write", stat=stat_string) as span:
+        result = None
+        if page_id:
+            try:
+                await _update_db_entry_async(page_id, payload, integration_secret, priority, rate_limiter)
+                result = "updated"
+            except StalePageError:
+                _forget_stale_page(stat_string, page_id)
+                page_id = await _get_page_id_async(stat_string, integration_secret, database_id, refresh=True, priority=priority, rate_limiter=rate_limiter)
+                if page_id:
+                    await _update_db_entry_async(page_id, payload, integration_secret, priority, rate_limiter)
+                    result = "updated"
+
+        if result is None:
+            page_id = await _create_db_entry_async(payload, integration_secret, priority, rate_limiter)
+            result = "created"
+        return _finish_write(span, result, stat_string, page_id, values, database_id)
+
+"""
+Function that returns whether a write can be skipped because `page_id` already shows `values`,
+and counts it as skipped if so
+"""
+def _is_unchanged(page_id: str, values: list, force: bool) -> bool:
+    if not page_id or force or _get_last_written(page_id) != values:
+        return False
+    _count_write("skipped")
+    return True
+
+"""
+Function that forgets a page that turned out to be deleted or archived before it is looked up again
+"""
+def _forget_stale_page(stat_string: str, page_id: str):
+    # the row was deleted or archived since the index was built, so rescan and recreate it if needed
+    print(f"Notion page {page_id} for {stat_string} is gone, rescanning database")
+    _forget_last_written(page_id)
+
+"""
+Function that records a finished write: indexes a created row, remembers the written values
+and counts the write. Returns `result`.
+"""
+def _finish_write(span, result: str, stat_string: str, page_id: str, values: list, database_id: str) -> str:
+    if result == "created":
+        _add_to_page_index(database_id, stat_string, page_id)
+    span.set(result=result)
+    _set_last_written(page_id, values)
+    _count_write("written")
+    return result
+
+"""
+Function that records a newly created row in the page index, if the database is indexed
+"""
+def _add_to_page_index(database_id: str, stat_string: str, page_id: str):
+    with _page_index_lock:
+        if database_id in _page_index:
+            _page_index[database_id][stat_string] = page_id
+
+"""
+Helper methods that track the (Value, Target) last written to each page
+"""
+def _get_written_values(payload: Dict[str, Any]) -> list:
+    properties = payload["properties"]
+    return [properties[name]["rich_text"][0]["text"]["content"] for name in ("Value", "Target")]
+
+def _get_last_written(page_id: str):
+    with _last_written_lock:
+        values = _last_written.get(page_id)
+    if values is None and _last_written_backend is not None:
+        values = _last_written_backend.get(f"notion-page:{page_id}")
+        if values is not None:
+            with _last_written_lock:
+                _last_written[page_id] = values
+    return values
+
+def _set_last_written(page_id: str, values: list):
+    with _last_written_lock:
+        _last_written[page_id] = values
+    if _last_written_backend is not None:
+        _last_written_backend.set(f"notion-page:{page_id}", values)
+
+def _forget_last_written(page_id: str):
+    with _last_written_lock:
+        _last_written.pop(page_id, None)
+    if _last_written_backend is not None:
+        _last_written_backend.delete(f"notion-page:{page_id}")
+
+def _count_write(outcome: str):
+    with _last_written_lock:
+        _write_counts[outcome] += 1
+
+"""
+Function that returns the row title and target shown for a stat type
+"""
+def _get_stat_strings(stat_type: STAT_TYPE) -> tuple[str, str]:
     if stat_type == STAT_TYPE.SLEEP:
-        stat_string = SLEEP_STAT_STRING
-        target_string = SLEEP_TARGET_STRING
+        return SLEEP_STAT_STRING, SLEEP_TARGET_STRING
     elif stat_type == STAT_TYPE.ZONE_2:
-        stat_string = ZONE_2_STAT_STRING
-        target_string = ZONE_2_TARGET_STRING
+        return ZONE_2_STAT_STRING, ZONE_2_TARGET_STRING
     elif stat_type == STAT_TYPE.ZONE_5:
-        stat_string = ZONE_5_STAT_STRING
-        target_string = ZONE_5_TARGET_STRING
+        return ZONE_5_STAT_STRING, ZONE_5_TARGET_STRING
     else:
         raise ValueError(f"Unknown stat_type argument: {stat_type}")
 
-    payload = _create_db_entry_payload(stat_string, stat_value, target_string, database_id)
-    existing_entry = _get_db_entry_by_stat(stat_string, integration_secret, database_id)
-
-    if existing_entry:
-        _update_db_entry(existing_entry["id"], payload, integration_secret)
-    else:
-        _create_db_entry(payload, integration_secret)
-    
-    print("Finished updating notion")
-
 """
 Function that creates the payload to update a specific page within a database
 """
@@ -80,44 +305,157 @@ def _create_db_entry_payload(stat: str, value: str, target :str, database_id: st
     }
 
 """
-Function that searches and returns the db row where "name" column matches `stat`
+Function that returns the page id of the db row where the "Stat" column matches `stat`, or None.
+All rows are indexed with one paginated query the first time a database is used (or on `refresh`).
+"""
+def _get_page_id(stat: str, integration_secret: str, database_id: str, refresh: bool=False, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None):
+    index = _get_cached_page_index(database_id, refresh)
+    if index is None:
+        index = _cache_page_index(database_id, _load_page_index(integration_secret, database_id, priority, rate_limiter))
+    return index.get(stat)
+
+"""
+Function that reads every row of the database and maps its "Stat" title to its page id
+"""
+@metrics.traced("notion_query")
+def _load_page_index(integration_secret: str, database_id: str, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None) -> Dict[str, str]:
+    index = {}
+    body = {"page_size": NOTION_QUERY_PAGE_SIZE}
+    while True:
+        response = session.request(**_query_request(database_id, body, integration_secret, priority, rate_limiter))
+        if not _index_query_response(index, body, response):
+            return index
+
+"""
+Async counterparts of _get_page_id and _load_page_index
+"""
+async def _get_page_id_async(stat: str, integration_secret: str, database_id: str, refresh: bool=False, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None):
+    index = _get_cached_page_index(database_id, refresh)
+    if index is None:
+        index = _cache_page_index(database_id, await _load_page_index_async(integration_secret, database_id, priority, rate_limiter))
+    return index.get(stat)
+
+@metrics.traced("notion_query")
+async def _load_page_index_async(integration_secret: str, database_id: str, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None) -> Dict[str, str]:
+    index = {}
+    body = {"page_size": NOTION_QUERY_PAGE_SIZE}
+    while True:
+        response = await aio.request(**_query_request(database_id, body, integration_secret, priority, rate_limiter))
+        if not _index_query_response(index, body, response):
+            return index
+
+"""
+Helper methods that read and fill the cached stat title -> page id index of a database
+"""
+def _get_cached_page_index(database_id: str, refresh: bool=False) -> Dict[str, str]:
+    with _page_index_lock:
+        return None if refresh else _page_index.get(database_id)
+
+def _cache_page_index(database_id: str, index: Dict[str, str]) -> Dict[str, str]:
+    with _page_index_lock:
+        _page_index[database_id] = index
+    return index
+
+"""
+Function that returns the arguments of a database query request for session.request / aio.request
+"""
+def _query_request(database_id: str, body: Dict[str, Any], integration_secret: str, priority: int, rate_limiter: ratelimit.TokenBucket) -> Dict[str, Any]:
+    return {
+        "method": "POST",
+        "url": _construct_database_endpoint(database_id),
+        "headers": _construct_headers(integration_secret),
+        "data": json.dumps(body),
+        "idempotent": True, # a query only reads
+        "rate_limiter": _get_rate_limiter(rate_limiter),
+        "priority": priority,
+    }
+
+"""
+Function that adds the rows of one database query response to a stat title -> page id index.
+Returns whether there are more rows, after pointing `body` at them.
 """
-def _get_db_entry_by_stat(stat: str, integration_secret: str, database_id: str):
-    body = {"filter": {"property": "Stat", "title": {"equals": stat}}}
-    response = requests.post(
-        _construct_database_endpoint(database_id),
-        headers=_construct_headers(integration_secret),
-        data=json.dumps(body),
-    )
+def _index_query_response(index: Dict[str, str], body: Dict[str, Any], response) -> bool:
     response.raise_for_status()
     response = response.json()
-    results = response["results"]
-    if len(results) > 0:
-        return results[0]
-    else:
-        return None
+    for page in response["results"]:
+        title = "".join(x["plain_text"] for x in page["properties"]["Stat"]["title"])
+        index.setdefault(title, page["id"])
+    if not response.get("has_more"):
+        return False
+    body["start_cursor"] = response["next_cursor"]
+    return True
 
 """
 Function that updates the db row that contains `page_id` as "name" column
 """
-def _update_db_entry(page_id: str, payload: Dict[str, Any], integration_secret:str):
-    response = requests.patch(
-        NOTION_PAGES_ENDPOINT + f"/{page_id}",
-        headers=_construct_headers(integration_secret),
-        data=json.dumps(payload)
-    )
+def _update_db_entry(page_id: str, payload: Dict[str, Any], integration_secret:str, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None):
+    response = session.request(**_update_request(page_id, payload, integration_secret, priority, rate_limiter))
+    _check_update_response(response, page_id)
+
+"""
+Function that creates the db row with the updated stat and returns its page id
+"""
+def _create_db_entry(payload: Dict[str, Any], integration_secret: str, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None) -> str:
+    response = session.request(**_create_request(payload, integration_secret, priority, rate_limiter))
+    return _get_created_page_id(response)
+
+"""
+Async counterparts of _update_db_entry and _create_db_entry
+"""
+async def _update_db_entry_async(page_id: str, payload: Dict[str, Any], integration_secret: str, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None):
+    response = await aio.request(**_update_request(page_id, payload, integration_secret, priority, rate_limiter))
+    _check_update_response(response, page_id)
+
+async def _create_db_entry_async(payload: Dict[str, Any], integration_secret: str, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None) -> str:
+    response = await aio.request(**_create_request(payload, integration_secret, priority, rate_limiter))
+    return _get_created_page_id(response)
+
+"""
+Helper methods that return the arguments of page update and create requests
+"""
+def _update_request(page_id: str, payload: Dict[str, Any], integration_secret: str, priority: int, rate_limiter: ratelimit.TokenBucket) -> Dict[str, Any]:
+    return {
+        "method": "PATCH",
+        "url": NOTION_PAGES_ENDPOINT + f"/{page_id}",
+        "headers": _construct_headers(integration_secret),
+        "data": json.dumps(payload),
+        "idempotent": True, # sets the same properties every time
+        "rate_limiter": _get_rate_limiter(rate_limiter),
+        "priority": priority,
+    }
+
+def _create_request(payload: Dict[str, Any], integration_secret: str, priority: int, rate_limiter: ratelimit.TokenBucket) -> Dict[str, Any]:
+    return {
+        "method": "POST",
+        "url": NOTION_PAGES_ENDPOINT,
+        "headers": _construct_headers(integration_secret),
+        "data": json.dumps(payload),
+        "rate_limiter": _get_rate_limiter(rate_limiter),
+        "priority": priority,
+    }
+
+"""
+Function that raises StalePageError if a page update hit a deleted or archived page
+"""
+def _check_update_response(response, page_id: str):
+    if response.status_code == 404 or (response.status_code == 400 and "archived" in response.text):
+        raise StalePageError(page_id)
     response.raise_for_status()
+    if response.json().get("archived"):
+        raise StalePageError(page_id)
 
 """
-Function that creates the db row with the updated stat
+Function that returns the page id of a created row
 """
-def _create_db_entry(payload: Dict[str, Any], integration_secret: str):
-    response = requests.post(
-        NOTION_PAGES_ENDPOINT,
-        headers=_construct_headers(integration_secret),
-        data=json.dumps(payload)
-    )
+def _get_created_page_id(response) -> str:
     response.raise_for_status()
+    return response.json()["id"]
+
+"""
+Function that returns the limiter a request waits for: the caller's, or the shared default
+"""
+def _get_rate_limiter(rate_limiter: ratelimit.TokenBucket=None) -> ratelimit.TokenBucket:
+    return rate_limiter if rate_limiter is not None else _rate_limiter
 
 """
 Function that generates headers for Notion API requests
@@ -133,4 +471,4 @@ def _construct_headers(integration_secret: str):
 Function that generates endpoint for specific database within Notion API
 """
 def _construct_database_endpoint(database_id: str):
-    return f"https://api.notion.com/v1/databases/{database_id}/query"
+    return f"{NOTION_API_ENDPOINT}/databases/{database_id}/query"
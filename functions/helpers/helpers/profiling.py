@@ -0,0 +1,252 @@
+import argparse
+import base64
+import functools
+import hashlib
+import hmac
+import io
+import marshal
+import os
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Callable, Dict, List
+
+from . import metrics, ratelimit
+
+# cProfile and pstats are imported when a profile is taken, which keeps them out of cold starts
+if TYPE_CHECKING:
+    import cProfile
+
+# what a profile captures: cProfile call stats, tracemalloc allocation stats, or both
+MODE_CPU = "cpu"
+MODE_MEMORY = "memory"
+MODE_ALL = "all"
+MODES = (MODE_CPU, MODE_MEMORY, MODE_ALL)
+
+# headers that ask for one invocation to be profiled, see sign_request
+TIMESTAMP_HEADER = "X-Profile-Timestamp"
+MODE_HEADER = "X-Profile-Mode"
+SIGNATURE_HEADER = "X-Profile-Signature"
+# a signed request is only honored this long after it was signed, so captured headers can't be replayed later
+MAX_REQUEST_AGE_SECONDS = 5 * 60
+
+DEFAULT_MAX_PER_HOUR = 6
+DEFAULT_BURST = 2
+DEFAULT_TOP = 40 # functions and allocation sites listed in a profile's summary
+TRACEMALLOC_FRAMES = 10
+
+"""
+Captures cProfile and/or tracemalloc output for single invocations and hands it to `sink`
+(LocalProfileSink or GCSProfileSink). Invocations are profiled when asked to (by a signed
+request, see verify_request) or picked with probability `sample_rate`, and either way at most
+`max_per_hour` times with bursts of `burst`, so profiling can stay enabled in production.
+Only one invocation per instance is profiled at a time. cProfile sees the invoking thread
+only, so work handed to thread pools or the aio loop shows up as time spent waiting for it.
+"""
+class Profiler:
+    def __init__(self, sink, sample_rate: float=0.0, max_per_hour: float=DEFAULT_MAX_PER_HOUR, burst: int=DEFAULT_BURST, sample_mode: str=MODE_CPU, top: int=DEFAULT_TOP):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"sample_rate must be between 0 and 1, got {sample_rate}")
+        if max_per_hour <= 0:
+            raise ValueError(f"max_per_hour must be positive, got {max_per_hour}")
+        if sample_mode not in MODES:
+            raise ValueError(f"Unknown profile mode: {sample_mode}")
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.sample_mode = sample_mode
+        self.top = top
+        self.profiled_count = 0
+        self.skipped_count = 0 # wanted a profile but the budget was spent or another profile was running
+        self._budget = ratelimit.TokenBucket(max_per_hour / 3600, capacity=burst)
+        self._active = threading.Lock()
+
+    """
+    Returns a context manager that profiles the block in `mode` if it is given (a requested
+    profile) or if the invocation is sampled, and the budget allows it. Otherwise it does nothing.
+    """
+    def maybe_profile(self, name: str, mode: str=None):
+        reason = "requested"
+        if mode is None:
+            if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+                return nullcontext()
+            mode, reason = self.sample_mode, "sampled"
+        if not self._active.acquire(blocking=False):
+            self.skipped_count += 1
+            return nullcontext()
+        if not self._budget.acquire(timeout=0):
+            self._active.release()
+            self.skipped_count += 1
+            print(f"profile of {name} skipped, the profiling budget is spent")
+            return nullcontext()
+        return self._profile(name, mode, reason)
+
+    """
+    Decorator that runs a function under maybe_profile. `requested` gets the call's arguments
+    and returns the mode asked for, or None.
+    """
+    def profiled(self, name: str, requested: Callable[..., str]=None):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                mode = requested(*args, **kwargs) if requested is not None else None
+                with self.maybe_profile(name, mode):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def _profile(self, name: str, mode: str, reason: str):
+        import cProfile
+        profile = cProfile.Profile() if mode in (MODE_CPU, MODE_ALL) else None
+        trace_memory = mode in (MODE_MEMORY, MODE_ALL) and not tracemalloc.is_tracing()
+        started_at = datetime.now(timezone.utc)
+        started = time.perf_counter()
+        try:
+            if trace_memory:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            if profile is not None:
+                profile.enable()
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            snapshot = tracemalloc.take_snapshot() if trace_memory else None
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+            if trace_memory:
+                tracemalloc.stop()
+            duration = time.perf_counter() - started
+            try:
+                self._write(name, mode, reason, started_at, duration, profile, snapshot, peak)
+            except Exception as e:
+                # losing a profile must never fail the invocation it describes
+                print(f"writing profile of {name} failed: {e!r}")
+            finally:
+                self._active.release()
+
+    def _write(self, name: str, mode: str, reason: str, started_at: datetime, duration: float, profile: "cProfile.Profile", snapshot: tracemalloc.Snapshot, peak: int):
+        import pstats
+        base_name = f"{name}/{started_at.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        summary = io.StringIO()
+        summary.write(f"{name} profiled ({reason}, {mode}) at {started_at.isoformat()}, took {duration * 1000:.1f} ms\n")
+        files = {}
+        if profile is not None:
+            profile.create_stats()
+            # loadable with pstats.Stats or snakeviz
+            files[base_name + ".prof"] = marshal.dumps(profile.stats)
+            summary.write(f"\ntop {self.top} functions by cumulative time:\n")
+            pstats.Stats(profile, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        if snapshot is not None:
+            summary.write(f"\npeak traced memory {peak / 1024:.1f} KiB, top {self.top} allocation sites:\n")
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                summary.write(f"{stat}\n")
+        files[base_name + ".txt"] = summary.getvalue().encode("UTF-8")
+
+        location = self.sink.write(files)
+        self.profiled_count += 1
+        print(f"profile of {name} written to {location}")
+        span = metrics.current_span()
+        if span is not None:
+            span.set(profile=location)
+
+"""
+Writes profiles under a local directory, ie /tmp on Cloud Functions or a mounted volume
+"""
+class LocalProfileSink:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def write(self, files: Dict[str, bytes]) -> str:
+        for relative_path, data in files.items():
+            path = os.path.join(self.directory, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        return os.path.join(self.directory, os.path.splitext(next(iter(files)))[0])
+
+"""
+Uploads profiles to a Cloud Storage bucket under `prefix`. The storage client is created on
+first use, which keeps it out of cold starts.
+"""
+class GCSProfileSink:
+    def __init__(self, bucket: str, prefix: str=""):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self._bucket = None
+
+    def write(self, files: Dict[str, bytes]) -> str:
+        if self._bucket is None:
+            from google.cloud import storage
+            self._bucket = storage.Client().bucket(self.bucket)
+        for relative_path, data in files.items():
+            self._bucket.blob(self._object_name(relative_path)).upload_from_string(data)
+        return f"gs://{self.bucket}/{self._object_name(os.path.splitext(next(iter(files)))[0])}"
+
+    def _object_name(self, relative_path: str) -> str:
+        return f"{self.prefix}/{relative_path}" if self.prefix else relative_path
+
+"""
+Function that returns the sink for a destination: "gs://bucket/prefix" or a local directory
+"""
+def sink_for(destination: str):
+    if destination.startswith("gs://"):
+        bucket, _, prefix = destination[len("gs://"):].partition("/")
+        return GCSProfileSink(bucket, prefix)
+    return LocalProfileSink(destination)
+
+"""
+Function that returns the headers asking for a profile of one request, signed with `secret`
+"""
+def sign_request(secret: str, mode: str=MODE_CPU, timestamp: int=None) -> Dict[str, str]:
+    if mode not in MODES:
+        raise ValueError(f"Unknown profile mode: {mode}")
+    timestamp = str(int(time.time()) if timestamp is None else timestamp)
+    return {
+        TIMESTAMP_HEADER: timestamp,
+        MODE_HEADER: mode,
+        SIGNATURE_HEADER: _signature(secret, timestamp, mode),
+    }
+
+"""
+Function that returns the mode a request's profile headers ask for, or None if there are none
+or they are not validly signed with `secret` within MAX_REQUEST_AGE_SECONDS
+"""
+def verify_request(secret: str, headers) -> str:
+    timestamp = headers.get(TIMESTAMP_HEADER)
+    signature = headers.get(SIGNATURE_HEADER)
+    mode = headers.get(MODE_HEADER, MODE_CPU)
+    if not timestamp or not signature or mode not in MODES:
+        return None
+    try:
+        age = time.time() - int(timestamp)
+    except ValueError:
+        return None
+    if abs(age) > MAX_REQUEST_AGE_SECONDS:
+        return None
+    if not hmac.compare_digest(_signature(secret, timestamp, mode), signature):
+        return None
+    return mode
+
+def _signature(secret: str, timestamp: str, mode: str) -> str:
+    digest = hmac.new(secret.encode("utf-8"), f"{timestamp}:{mode}".encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+"""
+Prints the headers that ask for a profile of one request, to send along with ie curl -H
+"""
+def main(argv: List[str]=None):
+    parser = argparse.ArgumentParser(prog="python -m helpers.profiling", description="Print signed headers that ask a Cloud Function to profile one request")
+    parser.add_argument("--mode", choices=MODES, default=MODE_CPU)
+    parser.add_argument("--secret", default=os.getenv("PIPELINE_PROFILE_SECRET"), help="profiling secret (default: $PIPELINE_PROFILE_SECRET)")
+    args = parser.parse_args(argv)
+    if not args.secret:
+        parser.error("the profiling secret is required (--secret or $PIPELINE_PROFILE_SECRET)")
+
+    for header, value in sign_request(args.secret, args.mode).items():
+        print(f"{header}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable
+
+# lower numbers go first: webhook-driven updates ahead of reconcile/backfill writes
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# after a throttle the rate is cut by this factor, then recovers by RECOVERY_STEP of the
+# configured rate per successful request
+THROTTLE_FACTOR = 0.5
+RECOVERY_STEP = 0.1
+
+"""
+Token bucket shared by every caller of one API. Callers queue in `acquire` and are served in
+priority order (then arrival order) as tokens become available. When the API answers 429,
+`throttled` stops all callers until its Retry-After has passed and lowers the rate, which then
+recovers with each successful request. `clock` (time.monotonic by default) is what refills and
+pauses are measured with.
+"""
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float=None, min_rate: float=None, clock: Callable[[], float]=time.monotonic):
+        self.rate = rate # configured tokens per second
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.min_rate = min_rate if min_rate is not None else rate / 10
+        self.current_rate = rate
+        self.throttle_count = 0
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._paused_until = 0.0
+        self._waiters = [] # heap of (priority, arrival number)
+        self._arrivals = itertools.count()
+        self._condition = threading.Condition()
+
+    """
+    Blocks until a token is available for this caller. Returns False if `timeout` seconds passed first.
+    """
+    def acquire(self, priority: int=PRIORITY_INTERACTIVE, timeout: float=None) -> bool:
+        deadline = None if timeout is None else self._clock() + timeout
+        with self._condition:
+            ticket = (priority, next(self._arrivals))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    now = self._clock()
+                    self._refill(now)
+                    wait = None
+                    if self._waiters[0] == ticket:
+                        if now < self._paused_until:
+                            wait = self._paused_until - now
+                        elif self._tokens >= 1:
+                            self._tokens -= 1
+                            return True
+                        else:
+                            wait = (1 - self._tokens) / self.current_rate
+                    if deadline is not None:
+                        if now >= deadline:
+                            return False
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self._condition.wait(wait)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    """
+    Records a 429: pauses every caller for `retry_after` seconds and lowers the rate
+    """
+    def throttled(self, retry_after: float=None):
+        with self._condition:
+            now = self._clock()
+            self._refill(now)
+            self.throttle_count += 1
+            self.current_rate = max(self.min_rate, self.current_rate * THROTTLE_FACTOR)
+            self._tokens = 0
+            pause = retry_after if retry_after is not None else 1 / self.current_rate
+            self._paused_until = max(self._paused_until, now + pause)
+            self._condition.notify_all()
+
+    """
+    Records a successful request, letting a lowered rate recover towards the configured one
+    """
+    def succeeded(self):
+        with self._condition:
+            if self.current_rate < self.rate:
+                self._refill(self._clock())
+                self.current_rate = min(self.rate, self.current_rate + self.rate * RECOVERY_STEP)
+
+    """
+    Returns how many callers are queued in `acquire`
+    """
+    def waiting(self) -> int:
+        with self._condition:
+            return len(self._waiters)
+
+    def _refill(self, now: float):
+        elapsed = now - max(self._updated_at, min(now, self._paused_until))
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.current_rate)
+        self._updated_at = now
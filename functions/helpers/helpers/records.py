@@ -0,0 +1,183 @@
+import json
+import re
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from . import stats
+from . import store as activity_store
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+"""
+Compact copy of a WHOOP record holding only what the stats read: its id, start and updated_at
+as epoch timestamps, and one float per field in FIELDS packed into an array (NaN when the
+record isn't scored or the field is missing). Subclasses say where the fields live in the score.
+"""
+class CompactRecord:
+    __slots__ = ("id", "start", "updated_at", "values")
+    FIELDS: Tuple[str, ...] = ()
+
+    def __init__(self, record_id: str, start: float, updated_at: float, values: array):
+        if len(values) != len(self.FIELDS):
+            raise ValueError(f"Expected {len(self.FIELDS)} values, got {len(values)}")
+        self.id = record_id
+        self.start = start
+        self.updated_at = updated_at
+        self.values = values
+
+    """
+    Builds the compact record from one record of a WHOOP listing
+    """
+    @classmethod
+    def from_dict(cls, record: Dict[str, Any]) -> "CompactRecord":
+        score = record.get("score")
+        if record.get("score_state", "SCORED") != "SCORED" or score is None:
+            values = array("d", [float("nan")]) * len(cls.FIELDS)
+        else:
+            source = cls._score_values(score)
+            try:
+                values = array("d", [source[field] for field in cls.FIELDS])
+            except (KeyError, TypeError):
+                # a field is missing or null
+                values = array("d", [_to_float(source.get(field)) for field in cls.FIELDS])
+        return cls(
+            str(record["id"]),
+            activity_store.parse_time(record["start"]),
+            activity_store.parse_time(record["updated_at"]),
+            values,
+        )
+
+    def get(self, field: str) -> float:
+        return self.values[self.FIELDS.index(field)]
+
+    @staticmethod
+    def _score_values(score: Dict[str, Any]) -> Dict[str, Any]:
+        return score
+
+class SleepRecord(CompactRecord):
+    __slots__ = ("nap",)
+    FIELDS = stats.SLEEP_FIELDS
+
+    def __init__(self, record_id: str, start: float, updated_at: float, values: array, nap: bool=False):
+        super().__init__(record_id, start, updated_at, values)
+        self.nap = nap
+
+    @classmethod
+    def from_dict(cls, record: Dict[str, Any]) -> "SleepRecord":
+        compact = super().from_dict(record)
+        compact.nap = bool(record["nap"])
+        return compact
+
+    @staticmethod
+    def _score_values(score: Dict[str, Any]) -> Dict[str, Any]:
+        return score["stage_summary"]
+
+class WorkoutRecord(CompactRecord):
+    __slots__ = ()
+    FIELDS = stats.WORKOUT_FIELDS
+
+    @staticmethod
+    def _score_values(score: Dict[str, Any]) -> Dict[str, Any]:
+        return {**score["zone_duration"], "strain": score.get("strain")}
+
+RECORD_TYPES = {
+    activity_store.SLEEP_COLLECTION: SleepRecord,
+    activity_store.WORKOUT_COLLECTION: WorkoutRecord,
+}
+
+"""
+Function that parses one page of a WHOOP collection listing straight from the response bytes.
+Records are decoded one at a time and turned into `record_type` right away, so the page's full
+dict tree is never held in memory. Returns the records and the page's `next_token`. Raises
+ValueError if the body isn't a complete listing.
+"""
+def parse_page(body: bytes, record_type: type) -> Tuple[List[CompactRecord], Optional[str]]:
+    text = body.decode("utf-8") if isinstance(body, (bytes, bytearray)) else body
+    records = []
+    next_token = None
+    position = _expect(text, 0, "{")
+    if _peek(text, position) == "}":
+        return records, next_token
+    while True:
+        key, position = _decoder.raw_decode(text, position)
+        position = _expect(text, _skip_whitespace(text, position), ":")
+        if key == "records":
+            position = _parse_records(text, position, record_type, records)
+        else:
+            value, position = _decoder.raw_decode(text, position)
+            if key == "next_token":
+                next_token = value
+        position = _skip_whitespace(text, position)
+        if _peek(text, position) == "}":
+            return records, next_token
+        position = _expect(text, position, ",")
+
+"""
+Function that lays compact sleep records out as stats columns. Naps are left out unless
+`include_naps` is set, like stats.sleep_columns.
+"""
+def sleep_columns(records: Iterable[SleepRecord], include_naps: bool=False) -> stats.ActivityColumns:
+    return _to_columns((record for record in records if include_naps or not record.nap), SleepRecord.FIELDS)
+
+"""
+Function that lays compact workout records out as stats columns, like stats.workout_columns
+"""
+def workout_columns(records: Iterable[WorkoutRecord]) -> stats.ActivityColumns:
+    return _to_columns(records, WorkoutRecord.FIELDS)
+
+"""
+Helper method that decodes the `records` array starting at `position` into `records`, returning
+the position after the array
+"""
+def _parse_records(text: str, position: int, record_type: type, records: List[CompactRecord]) -> int:
+    position = _expect(text, position, "[")
+    if _peek(text, position) == "]":
+        return position + 1
+    while True:
+        record_position = position
+        record, position = _decoder.raw_decode(text, position)
+        try:
+            records.append(record_type.from_dict(record))
+        except (AttributeError, KeyError, TypeError) as e:
+            raise ValueError(f"Malformed WHOOP record at position {record_position}: {e!r}") from e
+        position = _skip_whitespace(text, position)
+        if _peek(text, position) == "]":
+            return position + 1
+        position = _expect(text, position, ",")
+
+"""
+Helper method that checks the next non-whitespace character and returns the position of the
+value following it
+"""
+def _expect(text: str, position: int, character: str) -> int:
+    position = _skip_whitespace(text, position)
+    if position >= len(text) or text[position] != character:
+        raise ValueError(f"Expected {character!r} at position {position} of a WHOOP listing")
+    return _skip_whitespace(text, position + 1)
+
+"""
+Helper method that returns the character at `position`, raising ValueError if the listing ends
+before it (ie a truncated response body)
+"""
+def _peek(text: str, position: int) -> str:
+    if position >= len(text):
+        raise ValueError(f"WHOOP listing ends early at position {position}")
+    return text[position]
+
+def _skip_whitespace(text: str, position: int) -> int:
+    return _WHITESPACE.match(text, position).end()
+
+def _to_float(value: Any) -> float:
+    return float("nan") if value is None else float(value)
+
+def _to_columns(records: Iterable[CompactRecord], fields: Tuple[str, ...]) -> stats.ActivityColumns:
+    start = array("d")
+    values = array("d")
+    for record in records:
+        start.append(record.start)
+        values.extend(record.values)
+    columns = np.asarray(values, dtype=np.float64).reshape(len(start), len(fields)).T
+    return stats.ActivityColumns(fields, np.asarray(start, dtype=np.float64), np.ascontiguousarray(columns))
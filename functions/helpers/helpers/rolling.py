@@ -0,0 +1,95 @@
+import heapq
+import threading
+from typing import Dict, Optional, Tuple
+
+"""
+Running sums and a count over the records whose start time falls inside a trailing window.
+Inserting, updating or deleting one record applies only that record's delta, and moving the
+window start expires the records that fell out of it, so the totals never need a rescan.
+"""
+class RollingWindow:
+    def __init__(self, fields: Tuple[str, ...]):
+        self.fields = fields
+        self.window_start = None # epoch timestamp, records starting before it are excluded
+        self.seeded = False # True once the window was filled from a full listing of its records
+        self.sums = dict.fromkeys(fields, 0)
+        self.count = 0
+        self._records = {} # record id -> (start, values)
+        self._by_start = [] # heap of (start, record id), may hold entries of updated/deleted records
+        self._lock = threading.RLock()
+
+    """
+    Clears the window, ie before seeding it again from a full listing
+    """
+    def reset(self, window_start: float=None):
+        with self._lock:
+            self.window_start = window_start
+            self.seeded = False
+            self.sums = dict.fromkeys(self.fields, 0)
+            self.count = 0
+            self._records = {}
+            self._by_start = []
+
+    def mark_seeded(self):
+        with self._lock:
+            self.seeded = True
+
+    """
+    Takes over the window start, records and totals of `other` in one step, ie of a window that
+    was seeded on the side so readers of this one never see it half filled
+    """
+    def replace(self, other: "RollingWindow"):
+        if other.fields != self.fields:
+            raise ValueError(f"Can't replace a window over {self.fields} with one over {other.fields}")
+        with other._lock:
+            state = (other.window_start, other.seeded, dict(other.sums), other.count, dict(other._records), list(other._by_start))
+        with self._lock:
+            self.window_start, self.seeded, self.sums, self.count, self._records, self._by_start = state
+
+    """
+    Adds or replaces one record. `values` maps each field to the record's contribution; passing
+    None removes the record instead, ie for records that don't count towards the stat.
+    """
+    def upsert(self, record_id, start: float, values: Optional[Dict[str, float]]):
+        with self._lock:
+            self._remove(record_id)
+            if values is None or (self.window_start is not None and start < self.window_start):
+                return
+            self._records[record_id] = (start, values)
+            for field in self.fields:
+                self.sums[field] += values[field]
+            self.count += 1
+            heapq.heappush(self._by_start, (start, record_id))
+
+    def delete(self, record_id) -> bool:
+        with self._lock:
+            return self._remove(record_id)
+
+    """
+    Moves the window start forward and expires records that started before it
+    """
+    def advance(self, window_start: float):
+        with self._lock:
+            if self.window_start is not None and window_start < self.window_start:
+                raise ValueError("A rolling window can only move forward, reset it to move it back")
+            self.window_start = window_start
+            while self._by_start and self._by_start[0][0] < window_start:
+                start, record_id = heapq.heappop(self._by_start)
+                current = self._records.get(record_id)
+                if current is not None and current[0] == start:
+                    self._remove(record_id)
+
+    def __contains__(self, record_id) -> bool:
+        return record_id in self._records
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _remove(self, record_id) -> bool:
+        current = self._records.pop(record_id, None)
+        if current is None:
+            return False
+        for field in self.fields:
+            self.sums[field] -= current[1][field]
+        self.count -= 1
+        return True
@@ -0,0 +1,181 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics, ratelimit
+
+# connections kept alive per host, and per-host overrides keyed by URL prefix
+DEFAULT_POOL_MAXSIZE = 10
+HOST_POOL_MAXSIZE = {
+    "https://api.prod.whoop.com": 10,
+    "https://api.notion.com": 4,
+}
+DEFAULT_TIMEOUT_SECONDS = 30
+DEFAULT_MAX_RETRIES = 3
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 16
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+_session = None
+_session_lock = threading.Lock()
+_pool_maxsize = DEFAULT_POOL_MAXSIZE
+_host_pool_maxsize = dict(HOST_POOL_MAXSIZE)
+
+"""
+Function that changes the connection pool sizes. The shared session is rebuilt on next use.
+"""
+def configure(pool_maxsize: int=None, host_pool_maxsize: dict=None):
+    global _session, _pool_maxsize, _host_pool_maxsize
+    with _session_lock:
+        if pool_maxsize is not None:
+            _pool_maxsize = pool_maxsize
+        if host_pool_maxsize is not None:
+            _host_pool_maxsize = dict(host_pool_maxsize)
+        if _session is not None:
+            _session.close()
+        _session = None
+
+"""
+Function that returns the process-wide session used for WHOOP and Notion calls. It keeps
+connections alive, so warm invocations skip the TCP and TLS handshakes.
+"""
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(_host_pool_maxsize) + 1, pool_maxsize=_pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            for prefix, maxsize in _host_pool_maxsize.items():
+                session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=maxsize))
+            _session = session
+        return _session
+
+"""
+Function that sends a request on the shared session. Idempotent requests (GET/PUT/DELETE by
+default, or anything passed with idempotent=True) are retried on connection errors and on
+RETRY_STATUSES with jittered exponential backoff. A 429 is retried for any method since the
+server did not process it. A `Retry-After` header overrides the backoff delay.
+With a `rate_limiter` (ratelimit.TokenBucket), every attempt first waits for a token at
+`priority`, and a 429 pauses the limiter for everyone instead of only this caller.
+"""
+def request(method: str, url: str, idempotent: bool=None, max_retries: int=DEFAULT_MAX_RETRIES, rate_limiter: ratelimit.TokenBucket=None, priority: int=ratelimit.PRIORITY_INTERACTIVE, **kwargs) -> requests.Response:
+    idempotent = is_idempotent(method, idempotent)
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT_SECONDS)
+
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            waited_from = time.perf_counter()
+            rate_limiter.acquire(priority)
+            metrics.record_wait(time.perf_counter() - waited_from)
+        try:
+            response = get_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            metrics.record_call(retry=attempt > 0, error=True)
+            delay = error_retry_delay(attempt, idempotent, max_retries)
+            if delay is None:
+                raise
+        else:
+            metrics.record_call(_body_size(response.request.body), _response_size(response, kwargs.get("stream", False)), retry=attempt > 0, error=response.status_code >= 400)
+            delay = response_retry_delay(response, attempt, idempotent, max_retries, rate_limiter)
+            if delay is None:
+                return response
+            response.close()
+        attempt += 1
+        time.sleep(delay)
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+def patch(url: str, **kwargs) -> requests.Response:
+    return request("PATCH", url, **kwargs)
+
+"""
+Function that returns whether a request may be retried after a connection error or a 5xx:
+`idempotent` if given, otherwise whether `method` is in IDEMPOTENT_METHODS
+"""
+def is_idempotent(method: str, idempotent: bool=None) -> bool:
+    return method.upper() in IDEMPOTENT_METHODS if idempotent is None else idempotent
+
+"""
+Function that decides what happens after attempt number `attempt` + 1 got a response (a requests
+or httpx response). Reports the outcome to `rate_limiter` and returns the delay before the next
+attempt, or None if the response should be returned. Shared by request and aio.request.
+"""
+def response_retry_delay(response, attempt: int, idempotent: bool, max_retries: int, rate_limiter: ratelimit.TokenBucket=None) -> float:
+    retry_after = retry_after_delay(response)
+    if rate_limiter is not None:
+        if response.status_code == 429:
+            rate_limiter.throttled(retry_after)
+        elif response.status_code < 400:
+            rate_limiter.succeeded()
+    retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUSES)
+    if not retryable or attempt >= max_retries:
+        return None
+    if response.status_code == 429 and rate_limiter is not None:
+        return 0 # the limiter holds every caller back until Retry-After has passed
+    if retry_after is not None:
+        return retry_after
+    return backoff_delay(attempt)
+
+"""
+Function like response_retry_delay for an attempt that failed to connect or timed out. Returns
+None if the error should be raised.
+"""
+def error_retry_delay(attempt: int, idempotent: bool, max_retries: int) -> float:
+    if not idempotent or attempt >= max_retries:
+        return None
+    return backoff_delay(attempt)
+
+"""
+Function that returns the delay before retry number `attempt` + 1, using full jitter
+"""
+def backoff_delay(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+"""
+Function that reads a `Retry-After` header given either in seconds or as an HTTP date
+"""
+def retry_after_delay(response) -> float:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+"""
+Helper methods that return the bytes sent and received by one attempt, for metrics. A streamed
+response body is not read, so its Content-Length is used instead.
+"""
+def _body_size(body) -> int:
+    if body is None or not isinstance(body, (bytes, str)):
+        return 0
+    return len(body)
+
+def _response_size(response: requests.Response, streamed: bool) -> int:
+    if not streamed:
+        return len(response.content)
+    try:
+        return int(response.headers.get("Content-Length", 0))
+    except ValueError:
+        return 0
@@ -0,0 +1,131 @@
+import warnings
+from datetime import datetime, time, timedelta, timezone
+from typing import Any, Dict, Iterable, Tuple
+
+import numpy as np
+
+from . import store as activity_store
+
+DEFAULT_WINDOW_DAYS = (7, 14, 30, 90)
+DEFAULT_PERCENTILES = (10, 25, 75, 90)
+
+# columns extracted from each record. a record that isn't scored yet gets NaN in every column
+SLEEP_FIELDS = (
+    "total_in_bed_time_milli",
+    "total_awake_time_milli",
+    "total_light_sleep_time_milli",
+    "total_slow_wave_sleep_time_milli",
+    "total_rem_sleep_time_milli",
+)
+ZONE_FIELDS = (
+    "zone_zero_milli",
+    "zone_one_milli",
+    "zone_two_milli",
+    "zone_three_milli",
+    "zone_four_milli",
+    "zone_five_milli",
+)
+WORKOUT_FIELDS = ZONE_FIELDS + ("strain",)
+
+"""
+Records of one collection laid out as columns: `start` holds each record's start as an epoch
+timestamp and `values` is a (fields, records) float array, so a stat over any window is a
+mask and a reduction instead of a loop over JSON dicts.
+"""
+class ActivityColumns:
+    def __init__(self, fields: Tuple[str, ...], start: np.ndarray, values: np.ndarray):
+        if values.shape != (len(fields), len(start)):
+            raise ValueError(f"Expected values of shape {(len(fields), len(start))}, got {values.shape}")
+        self.fields = fields
+        self.start = start
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def column(self, field: str) -> np.ndarray:
+        return self.values[self.fields.index(field)]
+
+"""
+Function that turns sleep records into columns. Naps are left out unless `include_naps` is set,
+matching the average sleep stat.
+"""
+def sleep_columns(records: Iterable[Dict[str, Any]], include_naps: bool=False) -> ActivityColumns:
+    return _to_columns(
+        (record for record in records if include_naps or not record["nap"]),
+        SLEEP_FIELDS,
+        lambda score: score["stage_summary"],
+    )
+
+"""
+Function that turns workout records into columns: the time spent in every heart rate zone and the strain
+"""
+def workout_columns(records: Iterable[Dict[str, Any]]) -> ActivityColumns:
+    return _to_columns(records, WORKOUT_FIELDS, lambda score: {**score["zone_duration"], "strain": score.get("strain")})
+
+"""
+Function that returns where each window starts as an epoch timestamp. A window of n days covers
+today and the n - 1 days before it, in UTC days like the stat windows.
+"""
+def window_starts(window_days: Iterable[int]=DEFAULT_WINDOW_DAYS, now: datetime=None) -> np.ndarray:
+    today = datetime.combine((now or datetime.now(timezone.utc)).date(), time.min)
+    return np.array([activity_store.to_timestamp(today - timedelta(days - 1)) for days in window_days], dtype=np.float64)
+
+"""
+Function that computes every stat of every field over every window in one pass. Returns
+{window days: {field: {"count", "sum", "mean", "median", "p<percentile>"...}}}; fields without any
+scored record in a window have a count of 0 and NaN for the rest.
+"""
+def window_stats(columns: ActivityColumns, window_days: Iterable[int]=DEFAULT_WINDOW_DAYS, percentiles: Iterable[float]=DEFAULT_PERCENTILES, now: datetime=None) -> Dict[int, Dict[str, Dict[str, float]]]:
+    window_days = tuple(window_days)
+    percentiles = tuple(percentiles)
+    if not window_days:
+        raise ValueError("At least one window is required")
+
+    # (windows, records) mask of the records inside each window, broadcast against the
+    # (fields, records) values into a (windows, fields, records) array with NaN outside the window
+    in_window = columns.start[np.newaxis, :] >= window_starts(window_days, now)[:, np.newaxis]
+    windowed = np.where(in_window[:, np.newaxis, :], columns.values[np.newaxis, :, :], np.nan)
+
+    scored = ~np.isnan(windowed)
+    counts = scored.sum(axis=2)
+    sums = np.where(scored, windowed, 0).sum(axis=2)
+    with warnings.catch_warnings():
+        # empty windows are expected and come out as NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        means = sums / counts
+        quantiles = np.nanpercentile(windowed, (50,) + percentiles, axis=2) if len(columns) else np.full((len(percentiles) + 1,) + counts.shape, np.nan)
+
+    stats = {}
+    for w, days in enumerate(window_days):
+        stats[days] = {}
+        for f, field in enumerate(columns.fields):
+            field_stats = {
+                "count": int(counts[w, f]),
+                "sum": float(sums[w, f]) if counts[w, f] else np.nan,
+                "mean": float(means[w, f]),
+                "median": float(quantiles[0, w, f]),
+            }
+            for p, percentile in enumerate(percentiles, start=1):
+                field_stats[f"p{percentile:g}"] = float(quantiles[p, w, f])
+            stats[days][field] = field_stats
+    return stats
+
+"""
+Helper method that fills the columns of a collection, reading each field from the part of the
+record's score that `score_values` returns
+"""
+def _to_columns(records: Iterable[Dict[str, Any]], fields: Tuple[str, ...], score_values) -> ActivityColumns:
+    start = []
+    rows = []
+    for record in records:
+        start.append(activity_store.parse_time(record["start"]))
+        score = record.get("score")
+        if record.get("score_state", "SCORED") != "SCORED" or score is None:
+            rows.append((np.nan,) * len(fields))
+            continue
+        values = score_values(score)
+        rows.append(tuple(values.get(field, np.nan) for field in fields))
+
+    values = np.array(rows, dtype=np.float64).reshape(len(rows), len(fields)).T
+    return ActivityColumns(fields, np.array(start, dtype=np.float64), np.ascontiguousarray(values))
@@ -0,0 +1,292 @@
+import json
+import sqlite3
+import threading
+from datetime import date, datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+SLEEP_COLLECTION = "sleep"
+WORKOUT_COLLECTION = "workout"
+COLLECTIONS = (SLEEP_COLLECTION, WORKOUT_COLLECTION)
+
+# per-day totals kept next to the records, in milliseconds except for the counts of scored records.
+# nights and naps are kept apart, like the average sleep stat does
+ZONE_FIELDS = ("zone_zero_milli", "zone_one_milli", "zone_two_milli", "zone_three_milli", "zone_four_milli", "zone_five_milli")
+ROLLUP_FIELDS = ("sleeps", "in_bed_milli", "asleep_milli", "naps", "nap_milli", "workouts") + ZONE_FIELDS
+ASLEEP_FIELDS = ("total_light_sleep_time_milli", "total_slow_wave_sleep_time_milli", "total_rem_sleep_time_milli")
+# stored in PRAGMA user_version, so stores created before the rollups (1) or that may still hold
+# rows of emptied days (2) get them rebuilt once
+ROLLUP_SCHEMA_VERSION = 2
+
+"""
+SQLite-backed copy of WHOOP sleep and workout records, keyed by record id. Alongside the
+records it keeps, per collection, the earliest activity start it has synced (`synced_from`)
+and the latest `updated_at` it has seen (the sync watermark), and per user and calendar day
+(UTC, the same days the stat windows move by, see whoop.window_start) the totals of the day's records (see rollup_totals). The totals are
+updated in the same transaction as the records, so they always match them.
+"""
+class ActivityStore:
+    def __init__(self, path: str=":memory:"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for collection in COLLECTIONS:
+            self._conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {collection} (
+                    id TEXT PRIMARY KEY,
+                    start REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    record TEXT NOT NULL
+                )"""
+            )
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {collection}_by_start ON {collection} (start)")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS sync_state (
+                collection TEXT PRIMARY KEY,
+                synced_from REAL,
+                watermark REAL
+            )"""
+        )
+        rollup_columns = ", ".join(f"{field} INTEGER NOT NULL DEFAULT 0" for field in ROLLUP_FIELDS)
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS daily_rollup (user_id TEXT NOT NULL, day TEXT NOT NULL, {rollup_columns}, PRIMARY KEY (user_id, day))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS daily_rollup_by_day ON daily_rollup (day)")
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < ROLLUP_SCHEMA_VERSION:
+            self.rebuild_rollups()
+            self._conn.execute(f"PRAGMA user_version = {ROLLUP_SCHEMA_VERSION}")
+
+    """
+    Inserts or replaces records that are new or have a newer `updated_at` than the stored copy,
+    calling `on_change` with each of them. Returns the number of records that changed. `records`
+    is read before the transaction starts, so a lazy iterable (ie one that fetches pages) never
+    holds the write lock; pass one page at a time to keep long listings out of memory.
+    """
+    def upsert(self, collection: str, records: Iterable[Dict[str, Any]], on_change: Callable[[Dict[str, Any]], Any]=None) -> int:
+        _check_collection(collection)
+        records = list(records)
+        changed = 0
+        with self._lock:
+            # take the write lock up front, so another connection to the file (ie backfill
+            # checkpoints) can't make this transaction fail when it upgrades from reading
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for record in records:
+                    updated_at = parse_time(record["updated_at"])
+                    row = self._conn.execute(f"SELECT updated_at, record FROM {collection} WHERE id = ?", (str(record["id"]),)).fetchone()
+                    if row is not None and row[0] >= updated_at:
+                        continue
+                    if row is not None:
+                        self._add_to_rollup(collection, json.loads(row[1]), -1)
+                    self._add_to_rollup(collection, record, 1)
+                    self._conn.execute(
+                        f"INSERT OR REPLACE INTO {collection} (id, start, updated_at, record) VALUES (?, ?, ?, ?)",
+                        (str(record["id"]), parse_time(record["start"]), updated_at, json.dumps(record)),
+                    )
+                    changed += 1
+                    if on_change is not None:
+                        on_change(record)
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+        return changed
+
+    def delete(self, collection: str, record_id) -> bool:
+        _check_collection(collection)
+        with self._lock:
+            return self._delete_records(collection, [str(record_id)]) > 0
+
+    """
+    Deletes records starting at or after `start` whose id is not in `keep_ids`. Used after a sync
+    to drop records that no longer exist in WHOOP. Returns the ids that were deleted.
+    """
+    def prune(self, collection: str, start: datetime, keep_ids: Iterable) -> List[str]:
+        _check_collection(collection)
+        keep_ids = {str(x) for x in keep_ids}
+        with self._lock:
+            stored_ids = [row[0] for row in self._conn.execute(f"SELECT id FROM {collection} WHERE start >= ?", (to_timestamp(start),))]
+            stale_ids = [x for x in stored_ids if x not in keep_ids]
+            self._delete_records(collection, stale_ids)
+        return stale_ids
+
+    def get(self, collection: str, record_id) -> Optional[Dict[str, Any]]:
+        _check_collection(collection)
+        with self._lock:
+            row = self._conn.execute(f"SELECT record FROM {collection} WHERE id = ?", (str(record_id),)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    """
+    Yields stored records that started at or after `start` (and before `end`, if given), oldest first
+    """
+    def records_since(self, collection: str, start: datetime, end: datetime=None) -> Iterator[Dict[str, Any]]:
+        _check_collection(collection)
+        end_timestamp = float("inf") if end is None else to_timestamp(end)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT record FROM {collection} WHERE start >= ? AND start < ? ORDER BY start",
+                (to_timestamp(start), end_timestamp),
+            ).fetchall()
+        for row in rows:
+            yield json.loads(row[0])
+
+    """
+    Returns the latest `updated_at` among the stored records of a collection as a UTC datetime,
+    or None if there are none
+    """
+    def latest_update(self, collection: str) -> Optional[datetime]:
+        _check_collection(collection)
+        with self._lock:
+            row = self._conn.execute(f"SELECT MAX(updated_at) FROM {collection}").fetchone()
+        return None if row[0] is None else datetime.fromtimestamp(row[0], timezone.utc)
+
+    """
+    Returns (synced_from, watermark) for a collection as UTC datetimes, or Nones if it was never synced
+    """
+    def get_sync_state(self, collection: str) -> tuple[Optional[datetime], Optional[datetime]]:
+        _check_collection(collection)
+        with self._lock:
+            row = self._conn.execute("SELECT synced_from, watermark FROM sync_state WHERE collection = ?", (collection,)).fetchone()
+        if row is None:
+            return None, None
+        return tuple(None if x is None else datetime.fromtimestamp(x, timezone.utc) for x in row)
+
+    """
+    Returns the totals of every rollup field (see ROLLUP_FIELDS) over the calendar days from
+    `start_day` through `end_day` (the last day stored if not given), for one user or summed over
+    every user in the store. This reads at most one row per user and day, however many records
+    the days hold, which makes windows of any length (ie 7, 10, 30 or 365 days) cheap.
+    """
+    def rollup_totals(self, start_day: date, end_day: date=None, user_id=None) -> Dict[str, int]:
+        query, params = self._rollup_range(start_day, end_day, user_id)
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(f'COALESCE(SUM({field}), 0)' for field in ROLLUP_FIELDS)} FROM daily_rollup WHERE {query}", params).fetchone()
+        return dict(zip(ROLLUP_FIELDS, row))
+
+    """
+    Returns the rollup rows of the days from `start_day` through `end_day`, oldest first, as dicts
+    holding the user_id, the day (an ISO date) and every rollup field. Days without records have no row.
+    """
+    def daily_rollups(self, start_day: date, end_day: date=None, user_id=None) -> List[Dict[str, Any]]:
+        query, params = self._rollup_range(start_day, end_day, user_id)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT user_id, day, {', '.join(ROLLUP_FIELDS)} FROM daily_rollup WHERE {query} ORDER BY day, user_id", params).fetchall()
+        return [dict(zip(("user_id", "day") + ROLLUP_FIELDS, row)) for row in rows]
+
+    """
+    Recomputes every rollup from the stored records
+    """
+    def rebuild_rollups(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM daily_rollup")
+                for collection in COLLECTIONS:
+                    for row in self._conn.execute(f"SELECT record FROM {collection}").fetchall():
+                        self._add_to_rollup(collection, json.loads(row[0]), 1)
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def set_sync_state(self, collection: str, synced_from: datetime, watermark: Optional[datetime]):
+        _check_collection(collection)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_state (collection, synced_from, watermark) VALUES (?, ?, ?)",
+                (collection, to_timestamp(synced_from), None if watermark is None else to_timestamp(watermark)),
+            )
+
+    """
+    Helper method that deletes records along with their share of the rollups in one transaction.
+    The caller holds the lock. Returns the number of records deleted.
+    """
+    def _delete_records(self, collection: str, record_ids: List[str]) -> int:
+        if not record_ids:
+            return 0
+        deleted = 0
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            for record_id in record_ids:
+                row = self._conn.execute(f"SELECT record FROM {collection} WHERE id = ?", (record_id,)).fetchone()
+                if row is None:
+                    continue
+                self._add_to_rollup(collection, json.loads(row[0]), -1)
+                deleted += self._conn.execute(f"DELETE FROM {collection} WHERE id = ?", (record_id,)).rowcount
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+        return deleted
+
+    """
+    Helper method that adds (`sign` 1) or removes (`sign` -1) a record's share of its day's rollup,
+    dropping the day's row once no record counts towards it. The caller holds the lock and runs it
+    in the transaction that writes the record.
+    """
+    def _add_to_rollup(self, collection: str, record: Dict[str, Any], sign: int):
+        values = rollup_values(collection, record)
+        if not values:
+            return
+        fields = list(values)
+        user_id, day = str(record.get("user_id", "")), rollup_day(parse_time(record["start"])).isoformat()
+        self._conn.execute(
+            f"""INSERT INTO daily_rollup (user_id, day, {', '.join(fields)}) VALUES (?, ?{', ?' * len(fields)})
+            ON CONFLICT (user_id, day) DO UPDATE SET {', '.join(f'{field} = {field} + excluded.{field}' for field in fields)}""",
+            (user_id, day, *(sign * values[field] for field in fields)),
+        )
+        if sign < 0:
+            self._conn.execute("DELETE FROM daily_rollup WHERE user_id = ? AND day = ? AND sleeps = 0 AND naps = 0 AND workouts = 0", (user_id, day))
+
+    def _rollup_range(self, start_day: date, end_day: date, user_id) -> tuple[str, tuple]:
+        query, params = "day >= ?", (start_day.isoformat(),)
+        if end_day is not None:
+            query, params = query + " AND day <= ?", params + (end_day.isoformat(),)
+        if user_id is not None:
+            query, params = query + " AND user_id = ?", params + (str(user_id),)
+        return query, params
+
+"""
+Function that returns a record's share of its day's rollup as {rollup field: value}: one night,
+nap or workout and its times. Records that aren't scored yet add nothing.
+"""
+def rollup_values(collection: str, record: Dict[str, Any]) -> Dict[str, int]:
+    _check_collection(collection)
+    score = record.get("score")
+    if record.get("score_state", "SCORED") != "SCORED" or score is None:
+        return {}
+    if collection == SLEEP_COLLECTION:
+        stage_summary = score.get("stage_summary") or {}
+        in_bed = _milli(stage_summary.get("total_in_bed_time_milli"))
+        if record["nap"]:
+            return {"naps": 1, "nap_milli": in_bed}
+        return {"sleeps": 1, "in_bed_milli": in_bed, "asleep_milli": sum(_milli(stage_summary.get(field)) for field in ASLEEP_FIELDS)}
+    zone_duration = score.get("zone_duration") or {}
+    return {"workouts": 1, **{field: _milli(zone_duration.get(field)) for field in ZONE_FIELDS}}
+
+"""
+Function that returns the calendar day (UTC) an activity starting at an epoch timestamp is rolled up into
+"""
+def rollup_day(timestamp: float) -> date:
+    return datetime.fromtimestamp(timestamp, timezone.utc).date()
+
+"""
+Function that parses a WHOOP timestamp (ie "2022-04-24T02:25:44.774Z") into a UTC epoch timestamp
+"""
+def parse_time(value: str) -> float:
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+"""
+Function that converts a datetime to an epoch timestamp, treating naive datetimes as UTC
+"""
+def to_timestamp(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def _milli(value) -> int:
+    return 0 if value is None else int(round(value))
+
+"""
+Helper method that guards the table names interpolated into queries
+"""
+def _check_collection(collection: str):
+    if collection not in COLLECTIONS:
+        raise ValueError(f"Unknown collection: {collection}")
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from . import metrics, ratelimit, whoop
+from .freshness import FreshnessTracker
+from . import store as activity_store
+from .tokens import TokenManager
+
+DEFAULT_NOTION_REQUESTS_PER_SECOND = 3 # Notion's average limit per integration
+DEFAULT_MAX_WORKERS = 4
+
+"""
+One WHOOP member whose stats go to their own Notion database. Their WHOOP tokens, Notion
+integration secret and Notion database id are kept in Secret Manager under the names given here,
+which default to the single-user names suffixed with the WHOOP user id (ie WHOOP_ACCESS_TOKEN_10129).
+The WHOOP app (client id and secret) is shared by every member.
+"""
+class Tenant:
+    def __init__(self, user_id, whoop_access_token_secret: str, whoop_refresh_token_secret: str, notion_integration_secret: str, notion_database_id_secret: str, notion_requests_per_second: float=DEFAULT_NOTION_REQUESTS_PER_SECOND):
+        if notion_requests_per_second <= 0:
+            raise ValueError(f"notion_requests_per_second must be positive, got {notion_requests_per_second}")
+        self.user_id = None if user_id is None else str(user_id)
+        self.whoop_access_token_secret = whoop_access_token_secret
+        self.whoop_refresh_token_secret = whoop_refresh_token_secret
+        self.notion_integration_secret = notion_integration_secret
+        self.notion_database_id_secret = notion_database_id_secret
+        self.notion_requests_per_second = notion_requests_per_second
+
+    """
+    Builds a tenant from a registry entry, ie {"user_id": 10129} or with any of the secret names
+    and notion_requests_per_second set explicitly. `base_names` holds the single-user secret names
+    the defaults are derived from, keyed like the constructor arguments.
+    """
+    @classmethod
+    def from_dict(cls, entry: Dict[str, Any], base_names: Dict[str, str]) -> "Tenant":
+        if entry.get("user_id") is None:
+            raise ValueError(f"Tenant entry without a user_id: {entry}")
+        unknown = set(entry) - set(base_names) - {"user_id", "notion_requests_per_second"}
+        if unknown:
+            raise ValueError(f"Unknown tenant settings for user {entry['user_id']}: {sorted(unknown)}")
+        names = {key: entry.get(key, f"{base_name}_{entry['user_id']}") for key, base_name in base_names.items()}
+        return cls(entry["user_id"], notion_requests_per_second=entry.get("notion_requests_per_second", DEFAULT_NOTION_REQUESTS_PER_SECOND), **names)
+
+    def __repr__(self) -> str:
+        return f"Tenant({self.user_id})"
+
+"""
+Maps WHOOP user ids to tenants. A registry with a `fallback` routes unknown user ids to it, which
+is how the single-user setup keeps working without a registry.
+"""
+class TenantRegistry:
+    def __init__(self, tenants: List[Tenant], fallback: Tenant=None):
+        self._tenants = {}
+        for tenant in tenants:
+            if tenant.user_id in self._tenants:
+                raise ValueError(f"Duplicate tenant for WHOOP user {tenant.user_id}")
+            self._tenants[tenant.user_id] = tenant
+        self.fallback = fallback
+
+    """
+    Builds a registry from JSON holding a list of tenant entries (see Tenant.from_dict), or an
+    object with them under "tenants"
+    """
+    @classmethod
+    def from_json(cls, text: str, base_names: Dict[str, str]) -> "TenantRegistry":
+        entries = json.loads(text)
+        if isinstance(entries, dict):
+            entries = entries.get("tenants", [])
+        return cls([Tenant.from_dict(entry, base_names) for entry in entries])
+
+    """
+    Returns the tenant of a WHOOP user id, the fallback if there is none, or None
+    """
+    def get(self, user_id) -> Tenant:
+        tenant = self._tenants.get(None if user_id is None else str(user_id))
+        return tenant if tenant is not None else self.fallback
+
+    """
+    Returns every tenant, ie for reconcile_stats to fan out over
+    """
+    def all(self) -> List[Tenant]:
+        if not self._tenants and self.fallback is not None:
+            return [self.fallback]
+        return list(self._tenants.values())
+
+    def __len__(self) -> int:
+        return len(self.all())
+
+"""
+What one instance keeps per tenant across warm invocations: the token manager, the running
+totals behind the stats, the local activity store, the freshness of each stat and the Notion
+rate limiter (Notion limits each integration separately, while the WHOOP limit is shared by
+the whole app).
+"""
+class TenantState:
+    def __init__(self, tenant: Tenant, token_manager: TokenManager, activity_store_path: str=None, freshness: FreshnessTracker=None):
+        self.tenant = tenant
+        self.token_manager = token_manager
+        self.freshness = freshness if freshness is not None else FreshnessTracker()
+        self.sleep_window = whoop.new_sleep_window()
+        self.workout_window = whoop.new_workout_window()
+        self.windows_current_at = {} # collection -> time up to which its window reflects every change marked in `freshness`
+        self.notion_rate_limiter = ratelimit.TokenBucket(tenant.notion_requests_per_second)
+        self.activity_store_path = activity_store_path
+        self._activity_store = None
+        self._lock = threading.Lock()
+
+    """
+    Returns the tenant's local activity store, or None if disabled
+    """
+    def get_activity_store(self) -> activity_store.ActivityStore:
+        with self._lock:
+            if self._activity_store is None and self.activity_store_path:
+                self._activity_store = activity_store.ActivityStore(self.activity_store_path)
+            return self._activity_store
+
+"""
+Function that returns where a tenant's activity store lives: `base_path` for the fallback tenant
+(user_id None), or `base_path` with the user id before its extension, ie
+/tmp/whoop_activity.10129.sqlite3. An empty `base_path` disables the stores.
+"""
+def activity_store_path(base_path: str, user_id: str) -> str:
+    if not base_path or user_id is None:
+        return base_path
+    root, extension = os.path.splitext(base_path)
+    return f"{root}.{user_id}{extension}"
+
+"""
+Function that runs `work` for every tenant on at most `max_workers` threads. A tenant's failure
+doesn't stop the others: its exception is returned in its place. Prints how many tenants were
+done per minute and returns {user id: work result or exception}.
+"""
+def fan_out(name: str, tenants: List[Tenant], work: Callable[[Tenant], Any], max_workers: int=DEFAULT_MAX_WORKERS) -> Dict[str, Any]:
+    if max_workers < 1:
+        raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+    started = time.perf_counter()
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, max(1, len(tenants))), thread_name_prefix=f"{name}-tenant") as executor:
+        futures = {tenant.user_id: executor.submit(metrics.propagate(work), tenant) for tenant in tenants}
+        for user_id, future in futures.items():
+            try:
+                results[user_id] = future.result()
+            except Exception as e:
+                print(f"{name} failed for WHOOP user {user_id}: {e!r}")
+                results[user_id] = e
+
+    elapsed = time.perf_counter() - started
+    failed = sum(isinstance(result, Exception) for result in results.values())
+    per_minute = len(tenants) / elapsed * 60 if elapsed > 0 else 0.0
+    print(f"{name}: {len(tenants)} tenants in {elapsed:.1f}s ({per_minute:.1f} tenants/min) with {max_workers} workers, {failed} failed")
+    span = metrics.current_span()
+    if span is not None:
+        span.set(tenants=len(tenants), tenants_failed=failed, tenants_per_minute=round(per_minute, 1))
+    return results
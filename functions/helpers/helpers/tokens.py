@@ -0,0 +1,84 @@
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+# tokens are refreshed this many seconds before they expire, so requests in flight don't hit the expiry
+REFRESH_SKEW_SECONDS = 5 * 60
+
+"""
+Hands out a WHOOP access token and refreshes it on demand. The token is loaded lazily with
+`load`, and `refresh` is called with the token it replaces shortly before that one expires or
+when WHOOP rejects it. Both return (access token, expiry as an epoch timestamp or None if
+unknown); a token with an unknown expiry is used until WHOOP rejects it.
+Refreshes are single-flight: concurrent callers that need a new token wait for the one
+refresh in progress and then share its result.
+"""
+class TokenManager:
+    def __init__(self, load: Callable[[], Tuple[str, Optional[float]]], refresh: Callable[[Optional[str]], Tuple[str, Optional[float]]], skew_seconds: float=REFRESH_SKEW_SECONDS):
+        self._load = load
+        self._refresh = refresh
+        self.skew_seconds = skew_seconds
+        self.refresh_count = 0
+        self._token = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def expires_at(self) -> Optional[float]:
+        return self._expires_at
+
+    """
+    Returns a token that stays valid for at least `min_validity` seconds (the refresh skew by
+    default), refreshing it first if needed
+    """
+    def get_token(self, min_validity: float=None) -> str:
+        min_validity = self.skew_seconds if min_validity is None else min_validity
+        token = self._token
+        if token is not None and not self._expires_soon(min_validity):
+            return token
+
+        with self._lock:
+            if self._token is None:
+                self._token, self._expires_at = self._load()
+            # a caller that held the lock before us may have refreshed already
+            if self._expires_soon(min_validity):
+                self._do_refresh()
+            return self._token
+
+    """
+    Called when WHOOP answered 401 to a request made with `rejected_token`. Refreshes the token
+    unless another caller already replaced it, and returns the token to retry with.
+    """
+    def token_rejected(self, rejected_token: str) -> str:
+        with self._lock:
+            if self._token is None or self._token == rejected_token:
+                self._do_refresh()
+            return self._token
+
+    """
+    Refreshes the token if it expires within `min_validity` seconds or its expiry is unknown.
+    Returns True if it was refreshed.
+    """
+    def ensure_valid(self, min_validity: float) -> bool:
+        with self._lock:
+            if self._token is None:
+                self._token, self._expires_at = self._load()
+            if self._expires_at is not None and not self._expires_soon(min_validity):
+                return False
+            self._do_refresh()
+            return True
+
+    """
+    Drops the in-memory token, ie after it was rotated elsewhere
+    """
+    def reset(self):
+        with self._lock:
+            self._token = None
+            self._expires_at = None
+
+    def _expires_soon(self, min_validity: float) -> bool:
+        return self._expires_at is not None and time.time() + min_validity >= self._expires_at
+
+    def _do_refresh(self):
+        self._token, self._expires_at = self._refresh(self._token)
+        self.refresh_count += 1
@@ -1,9 +1,17 @@
 import requests
+import asyncio
 import base64
 import hmac
 import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, time, timedelta
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Union
+
+from . import aio, metrics, ratelimit, session
+from . import store as activity_store
+from .rolling import RollingWindow
+from .tokens import TokenManager
 
 SCOPES = "offline read:sleep read:recovery read:workout"
 WHOOP_TOKEN_URL = "https://api.prod.whoop.com/oauth/oauth2/token"
@@ -11,77 +19,308 @@ AUTHORIZATION_URL = "https://api.prod.whoop.com/oauth/oauth2/auth"
 WHOOP_API_ENDPOINT = "https://api.prod.whoop.com/developer"
 SLEEP_URL = "/v1/activity/sleep"
 WORKOUT_URL = "/v1/activity/workout"
+CYCLE_URL = "/v1/cycle"
+RECOVERY_URL = "/v1/recovery"
 SLEEP_DAYS_FOR_AVERAGE = 10
 WORKOUT_DAYS_FOR_TOTAL = 7
+ROLLUP_WINDOW_DAYS = (7, 10, 30, 365)
+MAX_PAGE_SIZE = 25 # largest `limit` the WHOOP collection endpoints accept
+WHOOP_REQUESTS_PER_MINUTE = 100 # default WHOOP API rate limit per app
+WHOOP_BURST = 10
+# WHOOP filters collections by activity start, not by updated_at, so incremental syncs re-read
+# activities that started this long before the watermark to pick up rescored records
+SYNC_LOOKBACK = timedelta(days=2)
+COLLECTION_URLS = {
+    activity_store.SLEEP_COLLECTION: SLEEP_URL,
+    activity_store.WORKOUT_COLLECTION: WORKOUT_URL,
+}
+
+# functions that call the WHOOP API take either an access token or a TokenManager that keeps one fresh
+AccessToken = Union[str, TokenManager]
+
+# fields summed by the rolling windows behind the stats
+SLEEP_WINDOW_FIELDS = ("total_in_bed_time_milli",)
+WORKOUT_WINDOW_FIELDS = ("zone_two_milli", "zone_five_milli")
+
+# shared by every WHOOP API call in the process, so backfills yield to webhook-driven fetches
+_rate_limiter = ratelimit.TokenBucket(WHOOP_REQUESTS_PER_MINUTE / 60, capacity=WHOOP_BURST)
+
+# fetches the next page of a collection while the current one is being consumed
+_prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="whoop-prefetch")
 
 """
 Function that gets and calculates zone 2 and zone 5 total mins over the last week
 """
-def calculate_workout_stats(access_token: str) -> tuple[str, str]:
+def calculate_workout_stats(access_token: AccessToken, store: activity_store.ActivityStore=None, window: RollingWindow=None, sync: bool=True) -> tuple[str, str]:
     try:
-        # the last week's worth of data
-        start_date_utc = datetime.combine(datetime.now(), time.min) - timedelta(WORKOUT_DAYS_FOR_TOTAL)
-        start_date_z = start_date_utc.isoformat() + 'Z'
-        workout_query_params = {
-            "limit": "25",
-            "start": start_date_z
-        }
-
-        # get workout data
-        workouts_endpoint = _add_params_to_url(WHOOP_API_ENDPOINT + WORKOUT_URL, workout_query_params)
-        response = requests.get(workouts_endpoint, headers=_get_request_header(access_token))
-        response.raise_for_status()
-        data = response.json()
-
-        # calculate total zone 2 minutes
-        zone_2_millis = [x["score"]["zone_duration"]["zone_two_milli"] for x in data["records"]]
-        total_zone_2_mins = sum(zone_2_millis) / 1000 / 60
-        total_zone_2_rounded = str(int(round(total_zone_2_mins, 0)))
+        # running totals over the window, seeded once and then kept current with per-record deltas
+        with metrics.span("whoop_fetch", collection=activity_store.WORKOUT_COLLECTION, listing=True):
+            window = _update_window(access_token, activity_store.WORKOUT_COLLECTION, _workout_window_start(), store, window if window is not None else new_workout_window(), sync)
+        with metrics.span("stat_compute", collection=activity_store.WORKOUT_COLLECTION):
+            return _workout_stats_from_window(window)
+    except:
+        return ("Error", "Error")
 
-        # calculate total zone 5 minutes
-        zone_5_millis = [x["score"]["zone_duration"]["zone_five_milli"] for x in data["records"]]
-        total_zone_5_mins = sum(zone_5_millis) / 1000 / 60
-        total_zone_5_rounded = str(int(round(total_zone_5_mins, 0)))
+"""
+Function that gets and calculates sleep average over the last ten days
+"""
+def calculate_sleep_stats(access_token: AccessToken, store: activity_store.ActivityStore=None, window: RollingWindow=None, sync: bool=True) -> str:
+    try:
+        # running time in bed over the window excluding naps, seeded once and then kept current with per-record deltas
+        with metrics.span("whoop_fetch", collection=activity_store.SLEEP_COLLECTION, listing=True):
+            window = _update_window(access_token, activity_store.SLEEP_COLLECTION, _sleep_window_start(), store, window if window is not None else new_sleep_window(), sync)
+        with metrics.span("stat_compute", collection=activity_store.SLEEP_COLLECTION):
+            return _sleep_stat_from_window(window)
+    except:
+        return "Error"
 
-        print("total zone 2 mins over last 7 days:", total_zone_2_rounded)
-        print("total zone 5 mins over last 7 days:", total_zone_5_rounded)
+"""
+Async counterpart of calculate_workout_stats. It always lists the whole window (reseeding
+`window` if given) and records the listing in `store` if one is given.
+"""
+async def calculate_workout_stats_async(access_token: AccessToken, store: activity_store.ActivityStore=None, window: RollingWindow=None) -> tuple[str, str]:
+    try:
+        with metrics.span("whoop_fetch", collection=activity_store.WORKOUT_COLLECTION, listing=True):
+            window = await _seed_window_async(access_token, activity_store.WORKOUT_COLLECTION, _workout_window_start(), store, window if window is not None else new_workout_window())
+        with metrics.span("stat_compute", collection=activity_store.WORKOUT_COLLECTION):
+            return _workout_stats_from_window(window)
     except:
-        total_zone_2_rounded = "Error"
-        total_zone_5_rounded = "Error"
-    return (total_zone_2_rounded, total_zone_5_rounded)
+        return ("Error", "Error")
 
 """
-Function that gets and calculates sleep average over the last ten days
+Async counterpart of calculate_sleep_stats, see calculate_workout_stats_async
 """
-def calculate_sleep_stats(access_token: str) -> str:
+async def calculate_sleep_stats_async(access_token: AccessToken, store: activity_store.ActivityStore=None, window: RollingWindow=None) -> str:
     try:
-        # last 10 nights of sleep
-        start_date_utc = datetime.combine(datetime.now(), time.min) - timedelta(SLEEP_DAYS_FOR_AVERAGE - 1)
-        start_date_z = start_date_utc.isoformat() + 'Z'
-        sleep_query_params = {
-            "limit": "25",
-            "start": start_date_z
+        with metrics.span("whoop_fetch", collection=activity_store.SLEEP_COLLECTION, listing=True):
+            window = await _seed_window_async(access_token, activity_store.SLEEP_COLLECTION, _sleep_window_start(), store, window if window is not None else new_sleep_window())
+        with metrics.span("stat_compute", collection=activity_store.SLEEP_COLLECTION):
+            return _sleep_stat_from_window(window)
+    except:
+        return "Error"
+
+"""
+Function that computes the dashboard stats for several windows at once: every sleep stage and
+heart rate zone plus strain, each as count, sum, mean, median and percentiles (see
+stats.window_stats). Both collections are fetched once for the longest window, from `store`
+after syncing it if one is given, or otherwise parsed straight into compact records.
+"""
+def calculate_activity_stats(access_token: AccessToken, store: activity_store.ActivityStore=None, window_days: tuple=None, percentiles: tuple=None) -> Dict[str, Dict]:
+    # numpy is only imported by the invocations that need it, which keeps it out of cold starts
+    from . import records as compact_records, stats
+    window_days = stats.DEFAULT_WINDOW_DAYS if window_days is None else window_days
+    percentiles = stats.DEFAULT_PERCENTILES if percentiles is None else percentiles
+    start = stats.window_starts((max(window_days),))[0]
+    start = datetime.fromtimestamp(start, timezone.utc)
+    with metrics.span("whoop_fetch", collection="all", listing=True):
+        if store is None:
+            sleeps = compact_records.sleep_columns(iter_collection(access_token, SLEEP_URL, start=start, record_type=compact_records.SleepRecord))
+            workouts = compact_records.workout_columns(iter_collection(access_token, WORKOUT_URL, start=start, record_type=compact_records.WorkoutRecord))
+        else:
+            sleeps = stats.sleep_columns(_get_records(access_token, activity_store.SLEEP_COLLECTION, start, store))
+            workouts = stats.workout_columns(_get_records(access_token, activity_store.WORKOUT_COLLECTION, start, store))
+    with metrics.span("stat_compute", collection="all", records=len(sleeps) + len(workouts)):
+        return {
+            activity_store.SLEEP_COLLECTION: stats.window_stats(sleeps, window_days, percentiles),
+            activity_store.WORKOUT_COLLECTION: stats.window_stats(workouts, window_days, percentiles),
         }
 
-        # get sleep data
-        sleeps_endpoint = _add_params_to_url(WHOOP_API_ENDPOINT + SLEEP_URL, sleep_query_params)
-        response = requests.get(sleeps_endpoint, headers=_get_request_header(access_token))
+"""
+Function that returns the totals of the store's per-day rollups (see ActivityStore.rollup_totals)
+over windows of `window_days` days, each covering today and the days before it, ie
+{10: {"sleeps": 10, "in_bed_milli": ..., "zone_two_milli": ...}}. Unless `sync` is off, the
+store is first synced back to the start of the longest window. Each window is then a read of
+one row per day instead of a fetch and scan of its records.
+"""
+def calculate_rollup_totals(access_token: AccessToken, store: activity_store.ActivityStore, window_days: tuple=ROLLUP_WINDOW_DAYS, sync: bool=True, user_id=None) -> Dict[int, Dict[str, int]]:
+    if not window_days:
+        raise ValueError("At least one window is required")
+    today = datetime.now(timezone.utc).date()
+    if sync:
+        start = datetime.combine(today - timedelta(max(window_days) - 1), time.min)
+        with metrics.span("whoop_fetch", collection="all", listing=True):
+            for collection in activity_store.COLLECTIONS:
+                sync_collection(access_token, store, collection, start)
+    with metrics.span("stat_compute", collection="all", windows=len(window_days)):
+        return {days: store.rollup_totals(today - timedelta(days - 1), today, user_id) for days in window_days}
+
+"""
+Function that fills `window` again from a full listing of a collection's current window, ie when it
+may have missed changes another instance applied, and replaces the store's copy of the window
+with the listing if a store is given
+"""
+def reseed_window(access_token: AccessToken, collection: str, store: activity_store.ActivityStore, window: RollingWindow) -> RollingWindow:
+    with metrics.span("whoop_fetch", collection=collection, listing=True):
+        return aio.run(_seed_window_async(access_token, collection, window_start(collection), store, window))
+
+"""
+Function that creates the rolling window behind calculate_sleep_stats. Keep one per user to
+let later calls apply only the records that changed.
+"""
+def new_sleep_window() -> RollingWindow:
+    return RollingWindow(SLEEP_WINDOW_FIELDS)
+
+"""
+Function that creates the rolling window behind calculate_workout_stats
+"""
+def new_workout_window() -> RollingWindow:
+    return RollingWindow(WORKOUT_WINDOW_FIELDS)
+
+"""
+Function that applies one new or changed WHOOP record to a rolling window
+"""
+def apply_record(window: RollingWindow, collection: str, record: Dict[str, Any]):
+    window.upsert(str(record["id"]), activity_store.parse_time(record["start"]), _WINDOW_VALUES[collection](record))
+
+"""
+Function that returns the collection ("sleep" or "workout") a webhook event type refers to,
+or None for events that don't affect any stat
+"""
+def event_collection(event_type: str) -> str:
+    if "sleep" in event_type:
+        return activity_store.SLEEP_COLLECTION
+    elif "workout" in event_type:
+        return activity_store.WORKOUT_COLLECTION
+    return None
+
+"""
+Function that gets a single sleep or workout by id. Returns None if WHOOP no longer has it.
+"""
+def get_record(access_token: AccessToken, collection: str, record_id) -> Dict[str, Any]:
+    endpoint = WHOOP_API_ENDPOINT + COLLECTION_URLS[collection] + "/" + requests.utils.quote(str(record_id), safe="")
+    with metrics.span("whoop_fetch", collection=collection, listing=False):
+        response = _authorized_get(access_token, endpoint)
+        if response.status_code == 404:
+            return None
         response.raise_for_status()
-        data = response.json()
+        return response.json()
+
+"""
+Function that applies one webhook event (ie sleep.updated for record `record_id`) to the local
+store and rolling window. Updates fetch just that record, deletions need no fetch at all.
+Returns True if the window now reflects the event, or False if the window isn't seeded yet
+(nothing is fetched then, as the next stat calculation lists the whole window anyway).
+"""
+def apply_event(access_token: AccessToken, event_type: str, record_id, store: activity_store.ActivityStore=None, window: RollingWindow=None) -> bool:
+    collection = event_collection(event_type)
+    if collection is None:
+        raise ValueError(f"Unknown event type: {event_type}")
+    if window is None or not window.seeded:
+        return False
 
-        # calculate average sleep excluding naps
-        sleep_times = [x["score"]["stage_summary"]["total_in_bed_time_milli"] for x in data["records"] if not x["nap"]]
-        if SLEEP_DAYS_FOR_AVERAGE != len(sleep_times):
-            raise ValueError(f"Processing a list of {len(sleep_times)} sleeps")
+    record = None
+    if not event_type.endswith(".deleted"):
+        record = get_record(access_token, collection, record_id)
 
-        total_sleep_hrs = sum(sleep_times) / 1000 / 60 / 60
-        avg_sleep = total_sleep_hrs / SLEEP_DAYS_FOR_AVERAGE
-        avg_sleep_rounded = str(round(avg_sleep, 2))
+    if record is None:
+        window.delete(str(record_id))
+        if store is not None:
+            store.delete(collection, record_id)
+    else:
+        apply_record(window, collection, record)
+        if store is not None:
+            store.upsert(collection, [record])
+    return True
 
-        print(f"avg sleep over the last {SLEEP_DAYS_FOR_AVERAGE} days:", avg_sleep_rounded)
-    except:
-        avg_sleep_rounded = "Error"
-    return avg_sleep_rounded
+"""
+Generator that yields every record of a WHOOP collection endpoint (ie SLEEP_URL, WORKOUT_URL,
+CYCLE_URL, RECOVERY_URL), following `next_token` across pages. Records are yielded lazily and
+the next page is requested while the current one is being consumed. With a `record_type`
+(records.SleepRecord or records.WorkoutRecord) each page is parsed straight into compact records
+instead of dicts.
+"""
+def iter_collection(access_token: AccessToken, collection_url: str, start: datetime=None, end: datetime=None, page_size: int=MAX_PAGE_SIZE, prefetch: bool=True, record_type: type=None) -> Iterator[Any]:
+    query_params = _get_collection_params(start, end, page_size)
+    page_records, next_token = _get_collection_page(access_token, collection_url, query_params, record_type)
+    while True:
+        next_page = None
+        if next_token:
+            next_params = dict(query_params, nextToken=next_token)
+            if prefetch:
+                next_page = _prefetch_executor.submit(metrics.propagate(_get_collection_page), access_token, collection_url, next_params, record_type)
+
+        yield from page_records
+
+        if not next_token:
+            return
+        page_records, next_token = next_page.result() if prefetch else _get_collection_page(access_token, collection_url, next_params, record_type)
+
+"""
+Generator that yields the pages of a WHOOP collection endpoint as (records, next_token), one
+request at a time. Passing the `next_token` of a page resumes the listing after it, which lets
+long listings be checkpointed. Requests wait for the WHOOP rate limiter at `priority`.
+"""
+def iter_collection_pages(access_token: AccessToken, collection_url: str, start: datetime=None, end: datetime=None, page_size: int=MAX_PAGE_SIZE, next_token: str=None, priority: int=ratelimit.PRIORITY_INTERACTIVE, record_type: type=None) -> Iterator[tuple[list, str]]:
+    query_params = _get_collection_params(start, end, page_size)
+    while True:
+        params = query_params if next_token is None else dict(query_params, nextToken=next_token)
+        page_records, next_token = _get_collection_page(access_token, collection_url, params, record_type, priority)
+        yield page_records, next_token
+        if not next_token:
+            return
+
+"""
+Async counterpart of iter_collection. The next page is requested as a task on the event loop
+while the current one is being consumed. Pass priority=ratelimit.PRIORITY_BULK for listings that
+may wait behind webhook-driven requests.
+"""
+async def iter_collection_async(access_token: AccessToken, collection_url: str, start: datetime=None, end: datetime=None, page_size: int=MAX_PAGE_SIZE, priority: int=ratelimit.PRIORITY_INTERACTIVE) -> AsyncIterator[Dict[str, Any]]:
+    query_params = _get_collection_params(start, end, page_size)
+    page = await _get_collection_page_async(access_token, collection_url, query_params, priority)
+    while True:
+        next_token = page.get("next_token")
+        next_page = None
+        if next_token:
+            next_page = asyncio.ensure_future(_get_collection_page_async(access_token, collection_url, dict(query_params, nextToken=next_token), priority))
+
+        try:
+            for record in page["records"]:
+                yield record
+        except GeneratorExit:
+            if next_page is not None:
+                next_page.cancel()
+            raise
+
+        if not next_token:
+            return
+        page = await next_page
+
+"""
+Function that brings a local ActivityStore up to date for activities starting at or after `start`.
+Only activities that started after the last sync's watermark (minus SYNC_LOOKBACK) are requested,
+and only records whose `updated_at` moved are written. `on_change` and `on_delete` are called for
+each changed record and deleted record id. Returns the number of records that changed.
+"""
+def sync_collection(access_token: AccessToken, store: activity_store.ActivityStore, collection: str, start: datetime, on_change: Callable[[Dict[str, Any]], Any]=None, on_delete: Callable[[str], Any]=None) -> int:
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    synced_from, watermark = store.get_sync_state(collection)
+
+    # only re-request what may have changed, unless the store doesn't reach back to `start` yet
+    fetch_start = start
+    if synced_from is not None and synced_from <= start and watermark is not None:
+        fetch_start = max(start, watermark - SYNC_LOOKBACK)
+
+    seen_ids = []
+    changed = 0
+    # each page is written in its own short transaction once it was fetched, so the store isn't
+    # locked while pages are requested (with their retries and rate limiter waits)
+    for page_records, _ in iter_collection_pages(access_token, COLLECTION_URLS[collection], start=fetch_start):
+        for record in page_records:
+            seen_ids.append(record["id"])
+            updated_at = datetime.fromtimestamp(activity_store.parse_time(record["updated_at"]), timezone.utc)
+            if watermark is None or updated_at > watermark:
+                watermark = updated_at
+        changed += store.upsert(collection, page_records, on_change)
+    # everything from fetch_start on was just listed, so anything else there was deleted in WHOOP
+    deleted_ids = store.prune(collection, fetch_start, seen_ids)
+    if on_delete is not None:
+        for record_id in deleted_ids:
+            on_delete(record_id)
+    changed += len(deleted_ids)
+    store.set_sync_state(collection, start if synced_from is None else min(start, synced_from), watermark)
+    print(f"synced {collection}: {len(seen_ids)} fetched since {fetch_start.isoformat()}, {changed} changed")
+    return changed
 
 """
 Function that validates the headers to the webhook. Help blocks non-Whoop callers to webhook.
@@ -100,6 +339,14 @@ def verify_headers(client_secret: str, signature: str, timestamp: str, body: byt
 Calls Whoop's token API to refresh access tokens
 """
 def refresh_tokens(refresh_token: str, client_id: str, client_secret: str) -> tuple[str, str]:
+    response = request_tokens(refresh_token, client_id, client_secret)
+    return response["refresh_token"], response["access_token"]
+
+"""
+Calls Whoop's token API to refresh access tokens and returns its whole response, which also
+holds the access token's lifetime in seconds (`expires_in`)
+"""
+def request_tokens(refresh_token: str, client_id: str, client_secret: str) -> Dict[str, Any]:
     # construct payload to request new access token
     payload_dict = {
         "grant_type": "refresh_token",
@@ -112,14 +359,199 @@ def refresh_tokens(refresh_token: str, client_id: str, client_secret: str) -> tu
     # prepare & send request for new access & refresh tokens
     payload = {key:requests.utils.quote(value, safe="") for (key,value) in payload_dict.items()}
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    r = requests.post(
+    r = session.post(
         WHOOP_TOKEN_URL,
         headers=headers,
         data=payload,
     )
     r.raise_for_status()
-    response = r.json()
-    return response["refresh_token"], response["access_token"]
+    return r.json()
+
+"""
+Helper method that brings a rolling window up to `start`. An unseeded window is filled from a
+full listing of the window's records (read from the store as it is if one is given and `sync`
+is off); a seeded one only takes the records that changed since (when a store is given to find
+them and `sync` is set) and expires the ones that fell out of the window.
+"""
+def _update_window(access_token: AccessToken, collection: str, start: datetime, store: activity_store.ActivityStore, window: RollingWindow, sync: bool=True) -> RollingWindow:
+    window_start = activity_store.to_timestamp(start)
+    if window.seeded and window_start >= window.window_start:
+        if store is not None and sync:
+            sync_collection(access_token, store, collection, start,
+                on_change=lambda record: apply_record(window, collection, record),
+                on_delete=lambda record_id: window.delete(str(record_id)))
+        window.advance(window_start)
+        return window
+
+    # seed a fresh window and swap it in once it's complete, so concurrent readers of the shared
+    # one keep seeing its previous totals meanwhile
+    seeded = RollingWindow(window.fields)
+    seeded.reset(window_start)
+    for record in _get_records(access_token, collection, start, store, sync):
+        apply_record(seeded, collection, record)
+    seeded.mark_seeded()
+    window.replace(seeded)
+    return window
+
+"""
+Helper method that fills a rolling window from a full listing fetched on the event loop. With a
+store, the listing also replaces the store's copy of the window.
+"""
+async def _seed_window_async(access_token: AccessToken, collection: str, start: datetime, store: activity_store.ActivityStore, window: RollingWindow) -> RollingWindow:
+    # the listing is awaited, so other coroutines and threads read the shared window meanwhile;
+    # it is filled on the side and swapped in once complete
+    seeded = RollingWindow(window.fields)
+    seeded.reset(activity_store.to_timestamp(start))
+    records = []
+    async for record in iter_collection_async(access_token, COLLECTION_URLS[collection], start=start):
+        apply_record(seeded, collection, record)
+        if store is not None:
+            records.append(record)
+    seeded.mark_seeded()
+    window.replace(seeded)
+
+    if store is not None:
+        start = start if start.tzinfo is not None else start.replace(tzinfo=timezone.utc)
+        synced_from, watermark = store.get_sync_state(collection)
+        for record in records:
+            updated_at = datetime.fromtimestamp(activity_store.parse_time(record["updated_at"]), timezone.utc)
+            if watermark is None or updated_at > watermark:
+                watermark = updated_at
+        store.upsert(collection, records)
+        store.prune(collection, start, [record["id"] for record in records])
+        store.set_sync_state(collection, start if synced_from is None else min(start, synced_from), watermark)
+    return window
+
+"""
+Helper methods that turn the rolling windows into the stats shown in Notion
+"""
+def _workout_stats_from_window(window: RollingWindow) -> tuple[str, str]:
+    # calculate total zone 2 minutes
+    total_zone_2_mins = window.sums["zone_two_milli"] / 1000 / 60
+    total_zone_2_rounded = str(int(round(total_zone_2_mins, 0)))
+
+    # calculate total zone 5 minutes
+    total_zone_5_mins = window.sums["zone_five_milli"] / 1000 / 60
+    total_zone_5_rounded = str(int(round(total_zone_5_mins, 0)))
+
+    print("total zone 2 mins over last 7 days:", total_zone_2_rounded)
+    print("total zone 5 mins over last 7 days:", total_zone_5_rounded)
+    return (total_zone_2_rounded, total_zone_5_rounded)
+
+def _sleep_stat_from_window(window: RollingWindow) -> str:
+    if SLEEP_DAYS_FOR_AVERAGE != window.count:
+        raise ValueError(f"Processing a list of {window.count} sleeps")
+
+    total_sleep_hrs = window.sums["total_in_bed_time_milli"] / 1000 / 60 / 60
+    avg_sleep = total_sleep_hrs / SLEEP_DAYS_FOR_AVERAGE
+    avg_sleep_rounded = str(round(avg_sleep, 2))
+
+    print(f"avg sleep over the last {SLEEP_DAYS_FOR_AVERAGE} days:", avg_sleep_rounded)
+    return avg_sleep_rounded
+
+"""
+Function that returns where the window behind a collection's stats starts now, as a naive UTC
+datetime like the other times sent to WHOOP. Days are UTC days everywhere: the windows move at
+midnight UTC, which is also where the activity store cuts its per-day rollups.
+"""
+def window_start(collection: str) -> datetime:
+    return _WINDOW_STARTS[collection]()
+
+"""
+Helper methods that return where the stat windows start: the last week's worth of workouts and
+the last 10 nights of sleep
+"""
+def _workout_window_start() -> datetime:
+    return datetime.combine(datetime.now(timezone.utc).date(), time.min) - timedelta(WORKOUT_DAYS_FOR_TOTAL)
+
+def _sleep_window_start() -> datetime:
+    return datetime.combine(datetime.now(timezone.utc).date(), time.min) - timedelta(SLEEP_DAYS_FOR_AVERAGE - 1)
+
+_WINDOW_STARTS = {
+    activity_store.SLEEP_COLLECTION: _sleep_window_start,
+    activity_store.WORKOUT_COLLECTION: _workout_window_start,
+}
+
+"""
+Helper method that yields the records of a collection starting at or after `start`, either
+straight from the WHOOP API or from a local store that is synced first (unless `sync` is off,
+ie because the caller just synced it)
+"""
+def _get_records(access_token: AccessToken, collection: str, start: datetime, store: activity_store.ActivityStore=None, sync: bool=True) -> Iterator[Dict[str, Any]]:
+    if store is None:
+        return iter_collection(access_token, COLLECTION_URLS[collection], start=start)
+    if sync:
+        sync_collection(access_token, store, collection, start)
+    return store.records_since(collection, start)
+
+"""
+Helper methods that return a record's contribution to the sleep/workout windows, or None
+for records that don't count (naps, and records that aren't scored yet or can't be scored,
+which have no score, like activity_store.rollup_values skips them)
+"""
+def _sleep_window_values(record: Dict[str, Any]) -> Dict[str, Any]:
+    if record["nap"] or not _is_scored(record):
+        return None
+    return {"total_in_bed_time_milli": record["score"]["stage_summary"]["total_in_bed_time_milli"]}
+
+def _workout_window_values(record: Dict[str, Any]) -> Dict[str, Any]:
+    if not _is_scored(record):
+        return None
+    zone_duration = record["score"]["zone_duration"]
+    return {"zone_two_milli": zone_duration["zone_two_milli"], "zone_five_milli": zone_duration["zone_five_milli"]}
+
+def _is_scored(record: Dict[str, Any]) -> bool:
+    return record.get("score_state", "SCORED") == "SCORED" and record.get("score") is not None
+
+_WINDOW_VALUES = {
+    activity_store.SLEEP_COLLECTION: _sleep_window_values,
+    activity_store.WORKOUT_COLLECTION: _workout_window_values,
+}
+
+"""
+Helper method that requests one page of a WHOOP collection endpoint and returns its records
+(dicts, or compact records of `record_type`) and its `next_token`
+"""
+def _get_collection_page(access_token: AccessToken, collection_url: str, params: dict, record_type: type=None, priority: int=ratelimit.PRIORITY_INTERACTIVE) -> tuple[list, str]:
+    endpoint = _add_params_to_url(WHOOP_API_ENDPOINT + collection_url, params)
+    response = _authorized_get(access_token, endpoint, priority=priority)
+    response.raise_for_status()
+    if record_type is not None:
+        from . import records as compact_records
+        return compact_records.parse_page(response.content, record_type)
+    page = response.json()
+    return page["records"], page.get("next_token")
+
+"""
+Async counterpart of _get_collection_page
+"""
+async def _get_collection_page_async(access_token: AccessToken, collection_url: str, params: dict, priority: int=ratelimit.PRIORITY_INTERACTIVE) -> Dict[str, Any]:
+    endpoint = _add_params_to_url(WHOOP_API_ENDPOINT + collection_url, params)
+    response = await _authorized_get_async(access_token, endpoint, priority)
+    response.raise_for_status()
+    return response.json()
+
+"""
+Helper method that builds the query parameters of a collection listing
+"""
+def _get_collection_params(start: datetime, end: datetime, page_size: int) -> dict:
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {MAX_PAGE_SIZE}, got {page_size}")
+
+    query_params = {"limit": str(page_size)}
+    if start is not None:
+        query_params["start"] = _format_time(start)
+    if end is not None:
+        query_params["end"] = _format_time(end)
+    return query_params
+
+"""
+Helper method that formats a naive UTC datetime the way the WHOOP API expects
+"""
+def _format_time(value: datetime) -> str:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat() + 'Z'
 
 """
 Helper method to URL encode args to an HTTP endpoing
@@ -138,6 +570,41 @@ def _add_params_to_url(url: str, params: dict=None) -> str:
     formatted_payload = url_payload[:-1]
     return url + "?" + formatted_payload
 
+"""
+Helper method that sends a GET request to the WHOOP API. With a TokenManager, the token is
+taken from it and a 401 refreshes the token once and retries the request.
+"""
+def _authorized_get(access_token: AccessToken, endpoint: str, priority: int=ratelimit.PRIORITY_INTERACTIVE) -> requests.Response:
+    token = access_token.get_token() if isinstance(access_token, TokenManager) else access_token
+    response = session.request(**_get_request(endpoint, token, priority))
+    if _token_rejected(access_token, response):
+        response.close()
+        token = access_token.token_rejected(token)
+        response = session.request(**_get_request(endpoint, token, priority))
+    return response
+
+"""
+Async counterpart of _authorized_get. Getting or refreshing a token happens off the event loop.
+"""
+async def _authorized_get_async(access_token: AccessToken, endpoint: str, priority: int=ratelimit.PRIORITY_INTERACTIVE) -> Any:
+    loop = asyncio.get_running_loop()
+    token = await loop.run_in_executor(None, access_token.get_token) if isinstance(access_token, TokenManager) else access_token
+    response = await aio.request(**_get_request(endpoint, token, priority))
+    if _token_rejected(access_token, response):
+        token = await loop.run_in_executor(None, access_token.token_rejected, token)
+        response = await aio.request(**_get_request(endpoint, token, priority))
+    return response
+
+"""
+Helper methods shared by _authorized_get and _authorized_get_async: the arguments of a GET
+request, and whether a response means the token of a TokenManager should be refreshed
+"""
+def _get_request(endpoint: str, token: str, priority: int) -> Dict[str, Any]:
+    return {"method": "GET", "url": endpoint, "headers": _get_request_header(token), "rate_limiter": _rate_limiter, "priority": priority}
+
+def _token_rejected(access_token: AccessToken, response) -> bool:
+    return response.status_code == 401 and isinstance(access_token, TokenManager)
+
 """
 Helper method that creates the header for GET requests to the WHOOP API
 """
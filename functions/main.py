@@ -1,12 +1,12 @@
-import requests
+import asyncio
 import json
+import os
+import time
+import threading
 
-from firebase_functions import https_fn, scheduler_fn
-from google.cloud import secretmanager
+from firebase_functions import https_fn, scheduler_fn, pubsub_fn
 
-from firebase_admin import initialize_app
-
-from helpers import whoop, notion
+from helpers import whoop, notion, jobs, dedupe, kvstore, store, ratelimit, aio, tokens, metrics, profiling, tenants, freshness
 
 PROJECT_ID = "whoop-sleep-data"
 WHOOP_CLIENT_ID_SECRET_NAME = "WHOOP_CLIENT_ID"
@@ -15,122 +15,751 @@ WHOOP_ACCESS_TOKEN_SECRET_NAME = "WHOOP_ACCESS_TOKEN"
 WHOOP_REFRESH_TOKEN_SECRET_NAME = "WHOOP_REFRESH_TOKEN"
 NOTION_INTEGRATION_SECRET_SECRET_NAME = "NOTION_INTEGRATION_SECRET"
 NOTION_DATABASE_ID_SECRET_NAME = "NOTION_DATABASE_ID"
+PROFILE_SECRET_SECRET_NAME = "PIPELINE_PROFILE_SECRET"
+
+# seconds a secret value is served from memory before it is read again from Secret Manager.
+# the WHOOP tokens are always read fresh: the access token is held by the token manager, which
+# knows when it expires, and the refresh token is single use
+DEFAULT_SECRET_TTL_SECONDS = 60 * 60
+SECRET_TTL_SECONDS = {
+    WHOOP_ACCESS_TOKEN_SECRET_NAME: 0,
+    WHOOP_REFRESH_TOKEN_SECRET_NAME: 0,
+}
+# WHOOP users this deployment serves. unset serves a single user with the secrets above; "secret"
+# reads a JSON list of tenants (see helpers.tenants) from the PIPELINE_TENANTS secret, and anything
+# else is the path of a JSON file holding one. a tenant's secrets are named like the ones above with
+# its WHOOP user id appended, ie WHOOP_ACCESS_TOKEN_10129
+TENANT_REGISTRY_SOURCE = os.environ.get("PIPELINE_TENANT_REGISTRY", "")
+TENANTS_SECRET_NAME = "PIPELINE_TENANTS"
+TENANT_SECRET_BASE_NAMES = {
+    "whoop_access_token_secret": WHOOP_ACCESS_TOKEN_SECRET_NAME,
+    "whoop_refresh_token_secret": WHOOP_REFRESH_TOKEN_SECRET_NAME,
+    "notion_integration_secret": NOTION_INTEGRATION_SECRET_SECRET_NAME,
+    "notion_database_id_secret": NOTION_DATABASE_ID_SECRET_NAME,
+}
+# tenants a scheduled run works on at the same time
+TENANT_MAX_WORKERS = int(os.environ.get("PIPELINE_TENANT_WORKERS", str(tenants.DEFAULT_MAX_WORKERS)))
+# the scheduled refresh_tokens run only rotates tokens that nobody refreshed on demand, ie after
+# a quiet period, so the refresh token keeps getting used
+SCHEDULED_REFRESH_MIN_VALIDITY_SECONDS = tokens.REFRESH_SKEW_SECONDS
+
+# "inline" computes stats before responding to WHOOP, "queue" only enqueues a job and responds
+# right away, leaving the work to process_whoop_job (one recompute per event) / drain_whoop_jobs.
+# "debounce" enqueues on a topic without push delivery, drained every minute by
+# drain_debounced_jobs, so bursts of events are merged into one recompute
+WEBHOOK_MODE = os.environ.get("WHOOP_WEBHOOK_MODE", "inline")
+# where queued jobs go: "pubsub" in production, "sqlite" or "memory" when running locally
+WEBHOOK_QUEUE_BACKEND = os.environ.get("WHOOP_WEBHOOK_QUEUE_BACKEND", "pubsub")
+WEBHOOK_QUEUE_SQLITE_PATH = os.environ.get("WHOOP_WEBHOOK_QUEUE_SQLITE_PATH", "whoop_jobs.sqlite3")
+WEBHOOK_JOBS_TOPIC = "whoop-webhook-jobs"
+# needs a pull subscription of the same name
+WEBHOOK_DEBOUNCED_JOBS_TOPIC = "whoop-webhook-jobs-debounced"
+# how long one scheduled drain_debounced_jobs run keeps pulling, within its minute
+DEBOUNCE_DRAIN_SECONDS = float(os.environ.get("WHOOP_DEBOUNCE_DRAIN_SECONDS", "50"))
+# how long a pull waits for messages on an empty subscription
+PUBSUB_PULL_TIMEOUT_SECONDS = 10
+# sleep/workout events arriving within this many seconds of each other are merged into one recompute
+COALESCE_WINDOW_SECONDS = float(os.environ.get("WHOOP_COALESCE_WINDOW_SECONDS", "5"))
+# handled trace_ids are always remembered in memory; set a path to also persist them in SQLite
+DEDUPE_SQLITE_PATH = os.environ.get("WHOOP_DEDUPE_SQLITE_PATH")
+# local copy of WHOOP records that is synced incrementally; /tmp survives across warm invocations.
+# each tenant gets its own file next to this path. set to an empty string to always compute stats
+# from a full WHOOP fetch
+ACTIVITY_STORE_PATH = os.environ.get("WHOOP_ACTIVITY_STORE_PATH", "/tmp/whoop_activity.sqlite3")
+# values last written to Notion are always remembered in memory; set a path to also persist them
+NOTION_VALUE_CACHE_SQLITE_PATH = os.environ.get("NOTION_VALUE_CACHE_SQLITE_PATH")
+# the Notion stats computed from each collection
+COLLECTION_STATS = {
+    store.SLEEP_COLLECTION: (notion.STAT_TYPE.SLEEP,),
+    store.WORKOUT_COLLECTION: (notion.STAT_TYPE.ZONE_2, notion.STAT_TYPE.ZONE_5),
+}
+# reconcile_stats only recomputes the stats that are stale (see helpers.freshness): never computed,
+# changed since they were last written, their window moved, newer records reached the activity
+# store, not synced with WHOOP for PIPELINE_RECONCILE_MAX_STAT_AGE_SECONDS or close to midnight UTC.
+# set PIPELINE_RECONCILE_FULL=1 to recompute and rewrite every stat on every run
+RECONCILE_FULL = os.environ.get("PIPELINE_RECONCILE_FULL", "0") == "1"
+# reconcile_stats runs once a day, in UTC like the stat windows: soon after they moved at midnight,
+# but past the boundary margin so its own computes don't count as near the window boundary
+RECONCILE_SCHEDULE = "every day 01:37"
+RECONCILE_PERIOD_SECONDS = 24 * 60 * 60
+RECONCILE_BOUNDARY_MARGIN_SECONDS = freshness.DEFAULT_BOUNDARY_MARGIN_SECONDS
+# every run syncs the activity stores, which confirms unchanged stats (see _sync_sources), so this
+# only catches stats no run could sync: a little under two periods, so one missed or late run
+# doesn't already force every stat to be listed again
+RECONCILE_MAX_STAT_AGE_SECONDS = float(os.environ.get("PIPELINE_RECONCILE_MAX_STAT_AGE_SECONDS", str(2 * RECONCILE_PERIOD_SECONDS - RECONCILE_BOUNDARY_MARGIN_SECONDS)))
+# stat freshness is always tracked in memory; set "gs://bucket/prefix" to share it between the
+# webhook and reconcile functions and all their instances, or a path to persist it in SQLite on
+# this instance only. PIPELINE_FRESHNESS_SQLITE_PATH is the older name of the latter
+FRESHNESS_STORE = os.environ.get("PIPELINE_FRESHNESS_STORE", os.environ.get("PIPELINE_FRESHNESS_SQLITE_PATH"))
+# each stage of an invocation is timed as a span, logged as one JSON line unless disabled. spans
+# can also be aggregated into a Prometheus textfile and/or exported to an OTLP/HTTP collector
+METRICS_LOG_SPANS = os.environ.get("PIPELINE_METRICS_LOG_SPANS", "1") != "0"
+METRICS_PROMETHEUS_PATH = os.environ.get("PIPELINE_METRICS_PROMETHEUS_PATH")
+METRICS_OTLP_ENDPOINT = os.environ.get("PIPELINE_METRICS_OTLP_ENDPOINT")
+METRICS_SERVICE_NAME = "whoop-notion-functions"
+# invocations are profiled (cProfile and/or tracemalloc) when sampled at PIPELINE_PROFILE_SAMPLE_RATE,
+# or when a request carries profile headers signed with the PIPELINE_PROFILE_SECRET secret (see
+# helpers.profiling). either way at most PIPELINE_PROFILE_MAX_PER_HOUR per instance, written to a
+# local directory or to gs://bucket/prefix
+PROFILE_SAMPLE_RATE = float(os.environ.get("PIPELINE_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SAMPLE_MODE = os.environ.get("PIPELINE_PROFILE_SAMPLE_MODE", profiling.MODE_CPU)
+PROFILE_MAX_PER_HOUR = float(os.environ.get("PIPELINE_PROFILE_MAX_PER_HOUR", str(profiling.DEFAULT_MAX_PER_HOUR)))
+PROFILE_DESTINATION = os.environ.get("PIPELINE_PROFILE_DESTINATION", "/tmp/whoop_profiles")
+
+# process-wide state reused across warm invocations of the same instance
+_secret_client = None
+_secret_cache = {} # secret name -> (value, version name, time fetched)
+_secret_cache_lock = threading.Lock()
+_job_queue = None
+_coalescer = jobs.EventCoalescer(COALESCE_WINDOW_SECONDS)
+_dedupe_store = None
+_freshness_backend = None
+# the single user served without a registry, and the fallback for WHOOP user ids it doesn't know
+_default_tenant = tenants.Tenant(None, WHOOP_ACCESS_TOKEN_SECRET_NAME, WHOOP_REFRESH_TOKEN_SECRET_NAME, NOTION_INTEGRATION_SECRET_SECRET_NAME, NOTION_DATABASE_ID_SECRET_NAME)
+_tenant_registry = None # (registry source text, registry)
+# per-tenant token manager, running totals behind the stats, activity store and stat freshness, kept across warm invocations
+_tenant_states = {}
+_tenant_states_lock = threading.Lock()
+_profiler = profiling.Profiler(profiling.sink_for(PROFILE_DESTINATION), PROFILE_SAMPLE_RATE, PROFILE_MAX_PER_HOUR, sample_mode=PROFILE_SAMPLE_MODE)
+if NOTION_VALUE_CACHE_SQLITE_PATH:
+    notion.set_value_backend(kvstore.SQLiteKV(NOTION_VALUE_CACHE_SQLITE_PATH, "notion_values"))
+if METRICS_LOG_SPANS:
+    metrics.add_sink(metrics.JSONLogSink())
+if METRICS_PROMETHEUS_PATH:
+    metrics.add_sink(metrics.PrometheusSink(METRICS_PROMETHEUS_PATH))
+if METRICS_OTLP_ENDPOINT:
+    metrics.add_sink(metrics.SpanExporter(metrics.otlp_http_export(METRICS_OTLP_ENDPOINT, METRICS_SERVICE_NAME)))
+
+"""
+Returns the Secret Manager client shared by every invocation on this instance. The client
+library is imported on first use to keep it out of cold starts.
+"""
+def _get_secret_client():
+    global _secret_client
+    if _secret_client is None:
+        from google.cloud import secretmanager
+        _secret_client = secretmanager.SecretManagerServiceClient()
+    return _secret_client
+
+"""
+Returns (value, version name) of the latest version of a secret. Values are served from
+the in-memory cache until their TTL runs out, unless `use_cache` is False.
+"""
+def _get_secret_version(secret_name: str, use_cache: bool=True) -> tuple[str, str]:
+    ttl = SECRET_TTL_SECONDS.get(secret_name, DEFAULT_SECRET_TTL_SECONDS)
+    if use_cache and ttl > 0:
+        with _secret_cache_lock:
+            cached = _secret_cache.get(secret_name)
+        if cached is not None and time.monotonic() - cached[2] < ttl:
+            return cached[0], cached[1]
+
+    with metrics.span("secret_fetch", secret=secret_name):
+        client = _get_secret_client()
+        resource_name = client.secret_path(PROJECT_ID, secret_name) + "/versions/latest"
+        response = client.access_secret_version(request={"name": resource_name})
+        # Secret Manager is called over gRPC rather than the shared session, so count the call here
+        metrics.record_call(bytes_received=len(response.payload.data))
+    value = response.payload.data.decode("UTF-8")
+    _cache_secret(secret_name, value, response.name)
+    return value, response.name
+
+"""
+Returns the value of the latest version of a secret, see _get_secret_version
+"""
+def _get_secret(secret_name: str, use_cache: bool=True) -> str:
+    return _get_secret_version(secret_name, use_cache)[0]
+
+"""
+Stores a secret value in the in-memory cache, ie right after writing a new version
+"""
+def _cache_secret(secret_name: str, value: str, version_name: str):
+    with _secret_cache_lock:
+        _secret_cache[secret_name] = (value, version_name, time.monotonic())
+
+"""
+Returns (access token, expiry as an epoch timestamp, version name) of a tenant's stored WHOOP
+access token. The secret holds JSON with the token and its expiry; a bare token (ie one set by
+hand with the firebase CLI) has an unknown expiry.
+"""
+def _read_whoop_access_token(tenant: tenants.Tenant) -> tuple[str, float, str]:
+    value, version_name = _get_secret_version(tenant.whoop_access_token_secret, use_cache=False)
+    try:
+        stored = json.loads(value)
+    except ValueError:
+        stored = None
+    if not isinstance(stored, dict):
+        return value, None, version_name
+    return stored["access_token"], stored.get("expires_at"), version_name
+
+def _load_whoop_access_token(tenant: tenants.Tenant) -> tuple[str, float]:
+    access_token, expires_at, _ = _read_whoop_access_token(tenant)
+    return access_token, expires_at
+
+"""
+Rotates a tenant's WHOOP tokens for its token manager. Another instance may have rotated them since
+`current_token` was loaded, in which case the stored token is used instead of refreshing again
+(the refresh token is single use). New secret versions are added before the old ones are
+destroyed, so a concurrent read of the latest version never finds a destroyed one.
+"""
+@metrics.traced("token_refresh")
+def _refresh_whoop_access_token(tenant: tenants.Tenant, current_token: str) -> tuple[str, float]:
+    stored_token, expires_at, prior_access_token_version_name = _read_whoop_access_token(tenant)
+    if stored_token != current_token and expires_at is not None and expires_at - time.time() > tokens.REFRESH_SKEW_SECONDS:
+        print("using WHOOP access token rotated by another instance")
+        return stored_token, expires_at
 
-initialize_app()
+    client = _get_secret_client()
+    whoop_client_id = _get_secret(WHOOP_CLIENT_ID_SECRET_NAME)
+    whoop_client_secret = _get_secret(WHOOP_CLIENT_SECRET_SECRET_NAME)
+    whoop_refresh_token, prior_refresh_token_version_name = _get_secret_version(tenant.whoop_refresh_token_secret, use_cache=False)
+
+    # get new refresh/access tokens
+    response = whoop.request_tokens(whoop_refresh_token, whoop_client_id, whoop_client_secret)
+    expires_at = time.time() + response["expires_in"]
+
+    # save the refresh token and the access token with its expiry to secrets manager
+    stored_access_token = json.dumps({"access_token": response["access_token"], "expires_at": expires_at})
+    with metrics.span("secret_write"):
+        latest_refresh_token_version = client.add_secret_version(request={"parent": client.secret_path(PROJECT_ID, tenant.whoop_refresh_token_secret), "payload": {"data": response["refresh_token"].encode("UTF-8")}})
+        latest_access_token_version = client.add_secret_version(request={"parent": client.secret_path(PROJECT_ID, tenant.whoop_access_token_secret), "payload": {"data": stored_access_token.encode("UTF-8")}})
+        metrics.record_call(bytes_sent=len(response["refresh_token"]) + len(stored_access_token))
+        metrics.record_call()
+    print("saved new refresh token in", latest_refresh_token_version.name)
+    print("saved new access token in", latest_access_token_version.name)
+    _cache_secret(tenant.whoop_refresh_token_secret, response["refresh_token"], latest_refresh_token_version.name)
+    _cache_secret(tenant.whoop_access_token_secret, stored_access_token, latest_access_token_version.name)
+
+    # destroy previous secret versions to avoid billing cost
+    with metrics.span("secret_write"):
+        for version_name in (prior_refresh_token_version_name, prior_access_token_version_name):
+            print("destroying", version_name)
+            client.destroy_secret_version(request={"name": version_name})
+            metrics.record_call()
+    return response["access_token"], expires_at
+
+"""
+Returns the profile mode an invocation's request asks for with signed profile headers, or None.
+Scheduled and Pub/Sub invocations carry no headers and are only ever sampled.
+"""
+def _requested_profile(request=None, *args, **kwargs) -> str:
+    headers = getattr(request, "headers", None)
+    if headers is None or profiling.SIGNATURE_HEADER not in headers:
+        return None
+    try:
+        profile_secret = _get_secret(PROFILE_SECRET_SECRET_NAME)
+    except Exception as e:
+        print(f"ignoring profile headers, {PROFILE_SECRET_SECRET_NAME} could not be read: {e!r}")
+        return None
+    mode = profiling.verify_request(profile_secret, headers)
+    if mode is None:
+        print("ignoring profile headers with an invalid or expired signature")
+    return mode
+
+"""
+Publishes queue messages to Google Cloud Pub/Sub, which delivers them to process_whoop_job, and
+pulls them from a topic's pull subscription (named like the topic) for drain_debounced_jobs
+"""
+class _PubSubQueue:
+    def __init__(self):
+        from google.cloud import pubsub_v1
+        self._publisher = pubsub_v1.PublisherClient()
+        self._subscriber = None
+
+    def publish(self, topic: str, data: bytes) -> str:
+        topic_path = self._publisher.topic_path(PROJECT_ID, topic)
+        return self._publisher.publish(topic_path, data).result()
+
+    def pull(self, topic: str, max_messages: int=jobs.DEFAULT_MAX_MESSAGES) -> list:
+        from google.api_core import exceptions
+        try:
+            response = self._get_subscriber().pull(request={"subscription": self._subscription_path(topic), "max_messages": max_messages}, timeout=PUBSUB_PULL_TIMEOUT_SECONDS)
+        except exceptions.DeadlineExceeded:
+            return []
+        return [
+            jobs.ReceivedMessage(received.ack_id, received.message.message_id, received.message.data, received.message.publish_time.timestamp())
+            for received in response.received_messages
+        ]
+
+    def acknowledge(self, topic: str, ack_ids: list):
+        if ack_ids:
+            self._get_subscriber().acknowledge(request={"subscription": self._subscription_path(topic), "ack_ids": ack_ids})
+
+    def modify_ack_deadline(self, topic: str, ack_ids: list, ack_deadline_seconds: int):
+        if ack_ids:
+            self._get_subscriber().modify_ack_deadline(request={"subscription": self._subscription_path(topic), "ack_ids": ack_ids, "ack_deadline_seconds": ack_deadline_seconds})
+
+    def _get_subscriber(self):
+        if self._subscriber is None:
+            from google.cloud import pubsub_v1
+            self._subscriber = pubsub_v1.SubscriberClient()
+        return self._subscriber
+
+    def _subscription_path(self, topic: str) -> str:
+        return self._get_subscriber().subscription_path(PROJECT_ID, topic)
+
+"""
+Returns the job queue shared by every invocation on this instance
+"""
+def _get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        if WEBHOOK_QUEUE_BACKEND == "pubsub":
+            _job_queue = _PubSubQueue()
+        elif WEBHOOK_QUEUE_BACKEND == "sqlite":
+            _job_queue = jobs.SQLiteQueue(WEBHOOK_QUEUE_SQLITE_PATH)
+        elif WEBHOOK_QUEUE_BACKEND == "memory":
+            _job_queue = jobs.InMemoryQueue()
+        else:
+            raise ValueError(f"Unknown webhook queue backend: {WEBHOOK_QUEUE_BACKEND}")
+    return _job_queue
+
+"""
+Returns the topic the webhook queues jobs on in the current WEBHOOK_MODE
+"""
+def _get_jobs_topic() -> str:
+    return WEBHOOK_DEBOUNCED_JOBS_TOPIC if WEBHOOK_MODE == "debounce" else WEBHOOK_JOBS_TOPIC
+
+"""
+Returns the tenant registry. A registry kept in Secret Manager is re-read when its cached value
+expires, so tenants can be added without a deploy.
+"""
+def _get_tenant_registry() -> tenants.TenantRegistry:
+    global _tenant_registry
+    if not TENANT_REGISTRY_SOURCE:
+        return tenants.TenantRegistry([], fallback=_default_tenant)
+    if TENANT_REGISTRY_SOURCE == "secret":
+        source = _get_secret(TENANTS_SECRET_NAME)
+    else:
+        with open(TENANT_REGISTRY_SOURCE) as f:
+            source = f.read()
+    if _tenant_registry is None or _tenant_registry[0] != source:
+        registry = tenants.TenantRegistry.from_json(source, TENANT_SECRET_BASE_NAMES)
+        print(f"loaded {len(registry)} tenants")
+        _tenant_registry = (source, registry)
+    return _tenant_registry[1]
+
+"""
+Returns the state this instance keeps for a tenant, creating it on first use
+"""
+def _get_tenant_state(tenant: tenants.Tenant) -> tenants.TenantState:
+    with _tenant_states_lock:
+        state = _tenant_states.get(tenant.user_id)
+        if state is None or state.tenant is not tenant:
+            token_manager = tokens.TokenManager(lambda: _load_whoop_access_token(tenant), lambda token: _refresh_whoop_access_token(tenant, token))
+            tracker = freshness.FreshnessTracker(RECONCILE_MAX_STAT_AGE_SECONDS, RECONCILE_BOUNDARY_MARGIN_SECONDS, backend=_get_freshness_backend(), key_prefix="" if tenant.user_id is None else f"{tenant.user_id}:")
+            state = tenants.TenantState(tenant, token_manager, tenants.activity_store_path(ACTIVITY_STORE_PATH, tenant.user_id), tracker)
+            _tenant_states[tenant.user_id] = state
+        return state
+
+"""
+Returns the backend stat freshness is persisted in, or None if it is only kept in memory
+"""
+def _get_freshness_backend():
+    global _freshness_backend
+    if _freshness_backend is None and FRESHNESS_STORE:
+        _freshness_backend = kvstore.open_store(FRESHNESS_STORE, "freshness")
+    return _freshness_backend
+
+"""
+Returns the store of handled webhook trace_ids shared by every invocation on this instance
+"""
+def _get_dedupe_store() -> dedupe.DedupeStore:
+    global _dedupe_store
+    if _dedupe_store is None:
+        _dedupe_store = dedupe.DedupeStore(backend=kvstore.SQLiteKV(DEDUPE_SQLITE_PATH, "dedupe") if DEDUPE_SQLITE_PATH else None)
+    return _dedupe_store
+
+"""
+Returns the state of the tenant a job's WHOOP user belongs to, or None if no tenant serves them
+"""
+def _get_job_tenant_state(job: dict) -> tenants.TenantState:
+    tenant = _get_tenant_registry().get(job.get("user_id"))
+    if tenant is None:
+        print(f"no tenant for WHOOP user {job.get('user_id')}, ignoring {job['type']} event")
+        return None
+    return _get_tenant_state(tenant)
+
+"""
+Applies one tenant's webhook jobs to its local activity state and recalculates the affected stats
+in its Notion database. Each changed record is fetched by id, so a burst of jobs costs one small
+GET per record. Returns whether a collection had to be synced in full instead.
+"""
+def _process_jobs(job_list: list, state: tenants.TenantState) -> bool:
+    whoop_access_token = state.token_manager
+    notion_integration_secret = _get_secret(state.tenant.notion_integration_secret)
+    notion_database_id = _get_secret(state.tenant.notion_database_id_secret)
+    activity_store = state.get_activity_store()
+    windows = {store.SLEEP_COLLECTION: state.sleep_window, store.WORKOUT_COLLECTION: state.workout_window}
+
+    # other instances mark the changes they apply on the (shared) freshness entries too. a window
+    # last brought up to date before such a change missed it, so it is listed again in full rather
+    # than written to Notion without the other instance's records
+    collections = {whoop.event_collection(job["type"]) for job in job_list} - {None}
+    missed_changes = {collection for collection in collections if _window_missed_changes(state, collection, windows[collection])}
+
+    # mark the affected stats as changed first, so they stay dirty for reconcile_stats unless the
+    # recompute below gets written
+    marked_at = time.time()
+    state.freshness.mark_changed((stat_type.name for collection in collections for stat_type in COLLECTION_STATS[collection]), marked_at)
+    computed_at = time.time()
+    window_starts = {collection: whoop.window_start(collection) for collection in collections}
+
+    listed = set()
+    for collection in missed_changes:
+        print(f"{collection} window of {state.tenant} missed changes applied elsewhere, listing it again")
+        whoop.reseed_window(whoop_access_token, collection, activity_store, windows[collection])
+        listed.add(collection)
+
+    # merge the changed records into the running totals; if every event of a collection was
+    # applied (or the collection was just listed) there is no need to sync it before calculating
+    needs_sync = dict.fromkeys(listed, False)
+    for job in job_list:
+        collection = whoop.event_collection(job["type"])
+        if collection is None or collection in listed:
+            continue
+        applied = job["id"] is not None and whoop.apply_event(whoop_access_token, job["type"], job["id"], activity_store, windows[collection])
+        needs_sync[collection] = needs_sync.get(collection, False) or not applied
+
+    # calculate stats and update them in Notion with one batch of concurrent writes
+    stat_values = {}
+    if store.SLEEP_COLLECTION in needs_sync:
+        avg_sleep_stat = whoop.calculate_sleep_stats(whoop_access_token, activity_store, state.sleep_window, sync=needs_sync[store.SLEEP_COLLECTION])
+        stat_values[notion.STAT_TYPE.SLEEP] = str(avg_sleep_stat)
+    if store.WORKOUT_COLLECTION in needs_sync:
+        zone_2_stat, zone_5_stat = whoop.calculate_workout_stats(whoop_access_token, activity_store, state.workout_window, sync=needs_sync[store.WORKOUT_COLLECTION])
+        stat_values[notion.STAT_TYPE.ZONE_2] = str(zone_2_stat)
+        stat_values[notion.STAT_TYPE.ZONE_5] = str(zone_5_stat)
+    synced = {collection: needs_sync[collection] or collection in listed for collection in needs_sync}
+    for collection in needs_sync:
+        state.windows_current_at[collection] = marked_at
+    if stat_values:
+        results = _update_notion_stats(stat_values, notion_integration_secret, notion_database_id, rate_limiter=state.notion_rate_limiter)
+        for collection in needs_sync:
+            _record_fresh_stats(state, collection, stat_values, results, computed_at, window_starts[collection], synced[collection])
+    return any(synced.values())
+
+"""
+Returns whether a seeded window of this instance missed a change of its collection that was marked
+after the window was last brought up to date, ie by another instance sharing the freshness backend.
+Windows that aren't seeded are listed in full anyway.
+"""
+def _window_missed_changes(state: tenants.TenantState, collection: str, window) -> bool:
+    if not window.seeded:
+        return False
+    changes = [state.freshness.get(stat_type.name).changed_at for stat_type in COLLECTION_STATS[collection]]
+    changed_at = max((x for x in changes if x is not None), default=None)
+    current_at = state.windows_current_at.get(collection)
+    return changed_at is not None and (current_at is None or changed_at > current_at)
+
+"""
+Writes a batch of stats to Notion and raises the first failed write, so the invocation fails
+(and gets retried) like it did when stats were written one at a time. Returns the write results.
+"""
+def _update_notion_stats(stat_values: dict, notion_integration_secret: str, notion_database_id: str, force: bool=False, priority: int=ratelimit.PRIORITY_INTERACTIVE, rate_limiter: ratelimit.TokenBucket=None) -> dict:
+    results = notion.update_stats(stat_values, notion_integration_secret, notion_database_id, force, priority, rate_limiter)
+    _raise_failed_writes(results)
+    return results
+
+"""
+Records the stats of a collection that were computed from data read at `computed_at` and written
+to Notion as fresh. Stats that failed to compute ("Error") or to be written stay stale. `synced`
+tells whether the collection was synced with WHOOP for the compute, see FreshnessTracker.
+"""
+def _record_fresh_stats(state: tenants.TenantState, collection: str, stat_values: dict, results: dict, computed_at: float, window_start, synced: bool=True):
+    watermark = _source_watermark(state.get_activity_store(), collection)
+    for stat_type in COLLECTION_STATS[collection]:
+        value = stat_values.get(stat_type)
+        if value is None or value == "Error" or isinstance(results.get(stat_type), Exception):
+            continue
+        state.freshness.record_compute(stat_type.name, value, computed_at, store.to_timestamp(window_start), watermark, synced)
+
+"""
+Returns the latest `updated_at` in a collection of the activity store as an epoch timestamp, or
+None if there is no store or it is empty
+"""
+def _source_watermark(activity_store: store.ActivityStore, collection: str) -> float:
+    if activity_store is None:
+        return None
+    latest_update = activity_store.latest_update(collection)
+    return None if latest_update is None else latest_update.timestamp()
+
+"""
+Raises the first exception among Notion write results. The instance's running write counts are
+attached to the current span instead of being logged on every batch.
+"""
+def _raise_failed_writes(results: dict):
+    span = metrics.current_span()
+    if span is not None:
+        counts = notion.get_write_counts()
+        span.set(notion_written_total=counts["written"], notion_skipped_total=counts["skipped"])
+    for result in results.values():
+        if isinstance(result, Exception):
+            raise result
+
+"""
+Raises once every tenant was worked on if any of them failed, so the scheduler sees the failure
+"""
+def _raise_failed_tenants(name: str, results: dict):
+    failed = [user_id for user_id, result in results.items() if isinstance(result, Exception)]
+    if failed:
+        raise RuntimeError(f"{name} failed for {len(failed)} of {len(results)} tenants: {failed}")
 
 """
 This function receives Whoop webhook updates (ie sleep updated, workout updated).
 Whoop's API will continually ping this webhook unless a 200 response is sent back quickly, so
-this function triggers a pubsub job that triggers the other functions
+in "queue" mode this function only enqueues a job and the work happens in process_whoop_job
 """
-# Future TODO: retry in case of race condition with secrets being updated
-# Future potential TODO: If this function takes too long, Whoop may retry this webhook. Solution: Delegate work via pubsub
 @https_fn.on_request()
+@_profiler.profiled("whoop_webhook", _requested_profile)
+@metrics.traced("whoop_webhook")
 def whoop_webhook(req: https_fn.Request) -> https_fn.Response:
-    # get relevant secrets
-    client = secretmanager.SecretManagerServiceClient()
-    whoop_access_token_resource_name = client.secret_path(PROJECT_ID, WHOOP_ACCESS_TOKEN_SECRET_NAME) + "/versions/latest"
-    whoop_client_secret_resource_name = client.secret_path(PROJECT_ID, WHOOP_CLIENT_SECRET_SECRET_NAME) + "/versions/latest"
-    notion_integration_secret_resource_name = client.secret_path(PROJECT_ID, NOTION_INTEGRATION_SECRET_SECRET_NAME) + "/versions/latest"
-    notion_database_id_resource_name = client.secret_path(PROJECT_ID, NOTION_DATABASE_ID_SECRET_NAME) + "/versions/latest"
-
-    whoop_access_token = client.access_secret_version(request={"name": whoop_access_token_resource_name}).payload.data.decode("UTF-8")
-    whoop_client_secret = client.access_secret_version(request={"name": whoop_client_secret_resource_name}).payload.data.decode("UTF-8")
-    notion_integration_secret = client.access_secret_version(request={"name": notion_integration_secret_resource_name}).payload.data.decode("UTF-8")
-    notion_database_id = client.access_secret_version(request={"name": notion_database_id_resource_name}).payload.data.decode("UTF-8")
+    # get relevant secrets (served from memory on warm instances)
+    whoop_client_secret = _get_secret(WHOOP_CLIENT_SECRET_SECRET_NAME)
 
     # check if client sent correct headers - otherwise, it's not Whoop
     signature = req.headers["x-whoop-signature"]
     timestamp = req.headers["x-whoop-signature-timestamp"]
-    print("whoop webhook incoming signature")
-    print(signature)
-    print("whoop webhook incoming signature timestamp")
-    print(timestamp)
-    print("raw request body")
-    print(req.get_data())
-    if not whoop.verify_headers(whoop_client_secret, signature, timestamp, req.get_data()):
+    with metrics.span("signature_check", body_bytes=req.content_length or 0) as span:
+        verified = whoop.verify_headers(whoop_client_secret, signature, timestamp, req.get_data())
+        span.set(verified=verified)
+    if not verified:
         print("Whoop webhook headers incorrect, ignoring request.")
         return
 
-    # calculate and update stat in Notion
-    type = req.json["type"]
-    if "sleep" in type:
-        avg_sleep_stat = whoop.calculate_sleep_stats(whoop_access_token)
-        notion.update_stat(notion.STAT_TYPE.SLEEP, str(avg_sleep_stat), notion_integration_secret, notion_database_id)
-    elif "workout" in type:
-        zone_2_stat, zone_5_stat = whoop.calculate_workout_stats(whoop_access_token)
-        notion.update_stat(notion.STAT_TYPE.ZONE_2, str(zone_2_stat), notion_integration_secret, notion_database_id)
-        notion.update_stat(notion.STAT_TYPE.ZONE_5, str(zone_5_stat), notion_integration_secret, notion_database_id)
+    # WHOOP retries deliveries with the same trace_id, only the first one does any work
+    job = jobs.make_job(req.json)
+    trace_id = job["trace_id"]
+    metrics.current_span().set(event_type=job["type"], whoop_trace_id=trace_id, mode=WEBHOOK_MODE)
+    dedupe_store = _get_dedupe_store()
+    if trace_id and dedupe_store.contains(trace_id):
+        print("duplicate delivery of trace", trace_id, dedupe_store.stats())
+        return https_fn.Response("Duplicate")
 
-    return https_fn.Response("Successful")
+    # WHOOP would keep retrying an error, so events of users no tenant serves are acknowledged and dropped
+    state = _get_job_tenant_state(job)
+    if state is None:
+        return https_fn.Response("Unknown user")
 
-# Future TODO: retry in case of race condition with secrets being updated
-@https_fn.on_request()
-@scheduler_fn.on_schedule(schedule="every day 23:37")
-def reconcile_stats(event: scheduler_fn.ScheduledEvent) -> None:
-    # get relevant secrets
-    client = secretmanager.SecretManagerServiceClient()
-    whoop_access_token_resource_name = client.secret_path(PROJECT_ID, WHOOP_ACCESS_TOKEN_SECRET_NAME) + "/versions/latest"
-    notion_integration_secret_resource_name = client.secret_path(PROJECT_ID, NOTION_INTEGRATION_SECRET_SECRET_NAME) + "/versions/latest"
-    notion_database_id_resource_name = client.secret_path(PROJECT_ID, NOTION_DATABASE_ID_SECRET_NAME) + "/versions/latest"
+    if WEBHOOK_MODE in ("queue", "debounce"):
+        message_id = _get_job_queue().publish(_get_jobs_topic(), jobs.encode_job(job))
+        print("queued job", message_id, "for trace", trace_id)
+        response = https_fn.Response("Queued")
+    else:
+        _process_jobs([job], state)
+        response = https_fn.Response("Successful")
+
+    if trace_id:
+        dedupe_store.add(trace_id)
+    return response
+
+"""
+Worker that processes webhook jobs delivered by Pub/Sub one at a time. Only events already
+covered by a recompute on the same instance are dropped; use the "debounce" WEBHOOK_MODE to
+merge bursts.
+"""
+@pubsub_fn.on_message_published(topic=WEBHOOK_JOBS_TOPIC)
+@_profiler.profiled("process_whoop_job")
+@metrics.traced("process_whoop_job")
+def process_whoop_job(event: pubsub_fn.CloudEvent[pubsub_fn.MessagePublishedData]) -> None:
+    job = event.data.message.json
 
-    whoop_access_token = client.access_secret_version(request={"name": whoop_access_token_resource_name}).payload.data.decode("UTF-8")
-    notion_integration_secret = client.access_secret_version(request={"name": notion_integration_secret_resource_name}).payload.data.decode("UTF-8")
-    notion_database_id = client.access_secret_version(request={"name": notion_database_id_resource_name}).payload.data.decode("UTF-8")
+    # a recompute that started on this instance after the event was published and fetched its
+    # record (or synced the whole collection) already saw its data
+    if _coalescer.already_covered(job, event.time.timestamp()):
+        print(f"{job['type']} event for trace {job['trace_id']} folded into an earlier recompute")
+        return
 
-    # calculate and update sleep stats in Notion
-    avg_sleep_stat = whoop.calculate_sleep_stats(whoop_access_token)
-    notion.update_stat(notion.STAT_TYPE.SLEEP, str(avg_sleep_stat))
+    state = _get_job_tenant_state(job)
+    if state is None:
+        return
 
-    # calculate and update zone2/zone5 stats in Notion
-    zone_2_stat, zone_5_stat = whoop.calculate_workout_stats(whoop_access_token)
-    notion.update_stat(notion.STAT_TYPE.ZONE_2, str(zone_2_stat), notion_integration_secret, notion_database_id)
-    notion.update_stat(notion.STAT_TYPE.ZONE_5, str(zone_5_stat), notion_integration_secret, notion_database_id)
+    # the start is only remembered once the recompute succeeded, otherwise Pub/Sub's redelivery of
+    # this same message would look covered and be dropped
+    started_at = time.time()
+    synced = _process_jobs([job], state)
+    _coalescer.mark_started([job], started_at, synced)
 
 """
-This function refreshes the whoop access and refres tokens
-using the refresh token stored in the secrets manager
+Worker that drains the job queue, merging bursts of events into one recompute per stat type.
+Runs locally on the "sqlite" or "memory" queue, and on the Pub/Sub pull subscription through
+drain_debounced_jobs. Returns the number of jobs processed.
 """
-@scheduler_fn.on_schedule(schedule="every 45 minutes")
-def refresh_tokens(event: scheduler_fn.ScheduledEvent) -> None:
-    
-    client = secretmanager.SecretManagerServiceClient()
+@_profiler.profiled("drain_whoop_jobs")
+@metrics.traced("drain_whoop_jobs")
+def drain_whoop_jobs(force: bool=False) -> int:
+    def process_batch(batch: jobs.CoalescedBatch):
+        print(f"folded {batch.folded} {batch.key} events into one recompute")
+        # batches are keyed by user, so every job in one belongs to the same tenant
+        state = _get_job_tenant_state(batch.latest)
+        return state is not None and _process_jobs(batch.jobs, state)
 
-    # build resource names for secrets. 
-    whoop_client_id_resource_name = client.secret_path(PROJECT_ID, WHOOP_CLIENT_ID_SECRET_NAME) + "/versions/latest"
-    whoop_client_secret_resource_name = client.secret_path(PROJECT_ID, WHOOP_CLIENT_SECRET_SECRET_NAME) + "/versions/latest"
-    whoop_refresh_token_resource_name = client.secret_path(PROJECT_ID, WHOOP_REFRESH_TOKEN_SECRET_NAME) + "/versions/latest"
-    whoop_access_token_resource_name = client.secret_path(PROJECT_ID, WHOOP_ACCESS_TOKEN_SECRET_NAME) + "/versions/latest"
+    batches = jobs.drain_coalesced(_get_job_queue(), _get_jobs_topic(), process_batch, _coalescer, force=force)
+    return sum(batch.folded for batch in batches)
 
-    # access necessary secrets
-    whoop_client_id = client.access_secret_version(request={"name": whoop_client_id_resource_name}).payload.data.decode("UTF-8")
+"""
+Scheduled worker for the "debounce" WEBHOOK_MODE. Cloud Scheduler runs it at most once a minute,
+so it keeps draining for DEBOUNCE_DRAIN_SECONDS; batches still inside their debounce window at
+the end go back on the subscription for the next run.
+"""
+@scheduler_fn.on_schedule(schedule="every 1 minutes")
+@metrics.traced("drain_debounced_jobs")
+def drain_debounced_jobs(event: scheduler_fn.ScheduledEvent) -> None:
+    if WEBHOOK_MODE != "debounce":
+        return
+    deadline = time.time() + DEBOUNCE_DRAIN_SECONDS
+    processed = drain_whoop_jobs()
+    while time.time() + COALESCE_WINDOW_SECONDS < deadline:
+        time.sleep(COALESCE_WINDOW_SECONDS)
+        processed += drain_whoop_jobs()
+    print(f"drained {processed} debounced jobs")
 
-    whoop_client_secret = client.access_secret_version(request={"name": whoop_client_secret_resource_name}).payload.data.decode("UTF-8")
+@https_fn.on_request()
+@_profiler.profiled("reconcile_stats", _requested_profile)
+@scheduler_fn.on_schedule(schedule=RECONCILE_SCHEDULE, timezone=scheduler_fn.Timezone("Etc/UTC"))
+@metrics.traced("reconcile_stats")
+def reconcile_stats(event: scheduler_fn.ScheduledEvent) -> None:
+    _reconcile_tenants(RECONCILE_FULL)
 
-    whoop_refresh_token_response = client.access_secret_version(request={"name": whoop_refresh_token_resource_name})
-    whoop_refresh_token = whoop_refresh_token_response.payload.data.decode("UTF-8")
-    prior_whoop_refresh_token_version_name = whoop_refresh_token_response.name # will destroy this secret later
+"""
+Reconciles the stats of every tenant: only the stale ones, or all of them if `full` is set
+"""
+def _reconcile_tenants(full: bool=False):
+    def reconcile_tenant(tenant: tenants.Tenant):
+        state = _get_tenant_state(tenant)
+        # a full pass lists every collection from scratch instead
+        synced_at = None if full else _sync_sources(state)
+        stale = _stale_stats(state, full)
+        if not stale:
+            print(f"stats of {tenant} are up to date, nothing to reconcile")
+            return
+        print(f"reconciling stats of {tenant}:", {stat_type.name: reason for stat_type, reason in stale.items()})
+        # get relevant secrets (served from memory on warm instances). the WHOOP token is refreshed on demand
+        notion_integration_secret = _get_secret(tenant.notion_integration_secret)
+        notion_database_id = _get_secret(tenant.notion_database_id_secret)
+        _raise_failed_writes(aio.run(_reconcile_async(state, notion_integration_secret, notion_database_id, stale, synced_at)))
 
-    whoop_access_token_response = client.access_secret_version(request={"name": whoop_access_token_resource_name})
-    prior_whoop_access_token_version_name = whoop_access_token_response.name # will destroy this secret later
+    # tenants share the WHOOP rate limit, so more workers only help while Notion writes are the bottleneck
+    results = tenants.fan_out("reconcile_stats", _get_tenant_registry().all(), reconcile_tenant, TENANT_MAX_WORKERS)
+    _raise_failed_tenants("reconcile_stats", results)
 
-    # get new refresh/access tokens
-    new_refresh_token, new_access_token = whoop.refresh_tokens(whoop_refresh_token, whoop_client_id, whoop_client_secret)
+"""
+Syncs a tenant's activity store with the records that changed in WHOOP since its watermark (a
+small delta listing). Collections where a record changed that no webhook delivered get their stats
+marked changed, so _stale_stats sees them as dirty; collections without changes confirm their
+stats as synced. Returns when the sync started, or None if the tenant has no activity store.
+"""
+def _sync_sources(state: tenants.TenantState) -> float:
+    activity_store = state.get_activity_store()
+    if activity_store is None:
+        return None
+    synced_at = time.time()
+    for collection, stat_types in COLLECTION_STATS.items():
+        with metrics.span("whoop_fetch", collection=collection, listing=True):
+            changed = whoop.sync_collection(state.token_manager, activity_store, collection, whoop.window_start(collection))
+        if changed:
+            state.freshness.mark_changed((stat_type.name for stat_type in stat_types), synced_at)
+        else:
+            state.freshness.mark_synced((stat_type.name for stat_type in stat_types), synced_at)
+    return synced_at
 
-    # destroy previous secret versions to avoid billing cost
-    print("destroying", prior_whoop_refresh_token_version_name)
-    client.destroy_secret_version(request={"name": prior_whoop_refresh_token_version_name})
-    print("destroying", prior_whoop_access_token_version_name)
-    client.destroy_secret_version(request={"name": prior_whoop_access_token_version_name})
+"""
+Returns the stats of a tenant that have to be recomputed, with the reason for each
+"""
+def _stale_stats(state: tenants.TenantState, full: bool=False) -> dict:
+    activity_store = state.get_activity_store()
+    stale = {}
+    for collection, stat_types in COLLECTION_STATS.items():
+        window_start = store.to_timestamp(whoop.window_start(collection))
+        watermark = _source_watermark(activity_store, collection)
+        for stat_type in stat_types:
+            reason = "full pass" if full else state.freshness.stale_reason(stat_type.name, window_start, watermark)
+            if reason is not None:
+                stale[stat_type] = reason
+    return stale
+
+"""
+Recomputes the collections behind the `stale` stats concurrently and writes each stat to Notion as
+soon as it is ready. If the activity store was just synced (at `synced_at`), the rolling windows
+are rebuilt from it; otherwise each collection is listed in full. Stale stats are written even if
+unchanged (which repairs rows edited by hand).
+"""
+async def _reconcile_async(state: tenants.TenantState, notion_integration_secret: str, notion_database_id: str, stale: dict, synced_at: float=None) -> dict:
+    whoop_access_token = state.token_manager
+    activity_store = state.get_activity_store()
 
-    # save access token and refresh token to secrets manager
-    encoded_refresh_token = new_refresh_token.encode("UTF-8")
-    encoded_access_token = new_access_token.encode("UTF-8")
+    async def update_sleep_stats():
+        computed_at, window_start = synced_at or time.time(), whoop.window_start(store.SLEEP_COLLECTION)
+        if synced_at is not None:
+            # filled on the side and swapped in, see whoop._update_window
+            window = whoop.new_sleep_window()
+            avg_sleep_stat = whoop.calculate_sleep_stats(whoop_access_token, activity_store, window, sync=False)
+            state.sleep_window.replace(window)
+        else:
+            avg_sleep_stat = await whoop.calculate_sleep_stats_async(whoop_access_token, activity_store, state.sleep_window)
+        state.windows_current_at[store.SLEEP_COLLECTION] = computed_at
+        stat_values = {
+            notion.STAT_TYPE.SLEEP: str(avg_sleep_stat),
+        }
+        results = await _write_reconciled_stats(state, stat_values, stale, notion_integration_secret, notion_database_id)
+        _record_fresh_stats(state, store.SLEEP_COLLECTION, stat_values, results, computed_at, window_start)
+        return results
 
-    whoop_refresh_token_secret_name = client.secret_path(PROJECT_ID, WHOOP_REFRESH_TOKEN_SECRET_NAME)
-    whoop_access_token_secret_name = client.secret_path(PROJECT_ID, WHOOP_ACCESS_TOKEN_SECRET_NAME)
+    async def update_workout_stats():
+        computed_at, window_start = synced_at or time.time(), whoop.window_start(store.WORKOUT_COLLECTION)
+        if synced_at is not None:
+            window = whoop.new_workout_window()
+            zone_2_stat, zone_5_stat = whoop.calculate_workout_stats(whoop_access_token, activity_store, window, sync=False)
+            state.workout_window.replace(window)
+        else:
+            zone_2_stat, zone_5_stat = await whoop.calculate_workout_stats_async(whoop_access_token, activity_store, state.workout_window)
+        state.windows_current_at[store.WORKOUT_COLLECTION] = computed_at
+        stat_values = {
+            notion.STAT_TYPE.ZONE_2: str(zone_2_stat),
+            notion.STAT_TYPE.ZONE_5: str(zone_5_stat),
+        }
+        results = await _write_reconciled_stats(state, stat_values, stale, notion_integration_secret, notion_database_id)
+        _record_fresh_stats(state, store.WORKOUT_COLLECTION, stat_values, results, computed_at, window_start)
+        return results
 
-    latest_refresh_token_version = client.add_secret_version( request={"parent": whoop_refresh_token_secret_name, "payload": {"data": encoded_refresh_token}})
-    latest_access_token_version = client.add_secret_version( request={"parent": whoop_access_token_secret_name, "payload": {"data": encoded_access_token}})
-    print("saved new refresh token in", latest_refresh_token_version.name)
-    print("saved new access token in", latest_access_token_version.name)
+    updates = {store.SLEEP_COLLECTION: update_sleep_stats, store.WORKOUT_COLLECTION: update_workout_stats}
+    stale_collections = [collection for collection, stat_types in COLLECTION_STATS.items() if any(stat_type in stale for stat_type in stat_types)]
+    results = {}
+    for collection_results in await asyncio.gather(*(updates[collection]() for collection in stale_collections)):
+        results.update(collection_results)
+    return results
+
+"""
+Writes reconciled stats to Notion: the stale ones even if unchanged, the others (which were only
+recomputed along with a stale stat of the same collection) only if their value changed
+"""
+async def _write_reconciled_stats(state: tenants.TenantState, stat_values: dict, stale: dict, notion_integration_secret: str, notion_database_id: str) -> dict:
+    writes = []
+    for force in (True, False):
+        values = {stat_type: value for stat_type, value in stat_values.items() if (stat_type in stale) == force}
+        if values:
+            writes.append(notion.update_stats_async(values, notion_integration_secret, notion_database_id, force=force, priority=ratelimit.PRIORITY_BULK, rate_limiter=state.notion_rate_limiter))
+    results = {}
+    for write_results in await asyncio.gather(*writes):
+        results.update(write_results)
+    return results
+
+"""
+Safety net for the on-demand token refreshes: rotates the WHOOP tokens if the stored access
+token expired or its expiry is unknown, which keeps the refresh token in use when no webhook
+or reconcile needed a token for a while
+"""
+@scheduler_fn.on_schedule(schedule="every 6 hours")
+@_profiler.profiled("refresh_tokens")
+@metrics.traced("refresh_tokens")
+def refresh_tokens(event: scheduler_fn.ScheduledEvent) -> None:
+    def refresh_tenant(tenant: tenants.Tenant):
+        token_manager = _get_tenant_state(tenant).token_manager
+        # look at the stored token rather than this instance's copy, another instance may have rotated it
+        token_manager.reset()
+        if token_manager.ensure_valid(SCHEDULED_REFRESH_MIN_VALIDITY_SECONDS):
+            print(f"refreshed WHOOP tokens of {tenant}")
+        else:
+            print(f"WHOOP access token of {tenant} still valid until", token_manager.expires_at)
+
+    results = tenants.fan_out("refresh_tokens", _get_tenant_registry().all(), refresh_tenant, TENANT_MAX_WORKERS)
+    _raise_failed_tenants("refresh_tokens", results)
@@ -0,0 +1,388 @@
+"""
+This script benchmarks the Cloud Functions end to end against the local WHOOP and Notion
+stand-ins in fake_servers.py, with an in-memory stand-in for Google Secret Manager, so it
+needs no credentials or network access. It drives:
+
+- whoop_webhook: signed sleep/workout update deliveries for records rescored on the fake
+- reconcile_stats: the daily recompute, which skips the stats that are still fresh unless
+  --full-reconcile is given
+- refresh_tokens: the scheduled safety net, with the stored token expired before every run
+  so each call rotates the tokens
+
+For each function it reports p50/p95/p99 latency, throughput, the outbound calls made per
+invocation (WHOOP, Notion and Secret Manager, by route) and where the time went, from the spans
+helpers.metrics records for each stage. Results can be saved as JSON and
+compared with an earlier run to spot regressions.
+
+With --tenants N the functions serve N tenants from a registry file, each with its own account
+on the WHOOP fake and its own Notion database. Webhook deliveries are spread over them and the
+scheduled functions fan out over all of them, which shows how many tenants a run gets through
+per minute.
+
+Run it from the root directory of the project inside the functions virtual environment:
+    python testing/benchmark_pipeline.py --iterations 50 --latency-ms 20 --save results.json
+    python testing/benchmark_pipeline.py --iterations 50 --latency-ms 20 --compare results.json
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(TESTING_DIR, "..", "functions")
+sys.path.insert(0, FUNCTIONS_DIR)
+
+import fake_servers
+from flask import Flask, Request
+
+WHOOP_CLIENT_ID = "benchmark-client-id"
+WHOOP_CLIENT_SECRET = "benchmark-client-secret"
+NOTION_INTEGRATION_SECRET = "benchmark-notion-secret"
+NOTION_DATABASE_ID = "benchmark-database"
+FUNCTIONS = ("whoop_webhook", "reconcile_stats", "refresh_tokens")
+
+_app = Flask(__name__)
+
+"""
+Metrics sink that keeps every finished span, so each function's spans can be broken down by stage
+"""
+class SpanCollector:
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def record(self, finished):
+        with self._lock:
+            self._spans.append(finished)
+
+    def reset(self) -> list:
+        with self._lock:
+            spans, self._spans = self._spans, []
+        return spans
+
+_span_collector = SpanCollector()
+
+"""
+In-memory stand-in for the parts of the Secret Manager client main.py uses. Calls are counted
+like the fake servers count theirs.
+"""
+class LocalSecretManager:
+    def __init__(self, secrets: dict):
+        self._versions = {name: [value.encode("UTF-8")] for name, value in secrets.items()}
+        self._destroyed = set()
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def secret_path(self, project: str, secret: str) -> str:
+        return f"projects/{project}/secrets/{secret}"
+
+    def access_secret_version(self, request: dict):
+        self._count("secret access")
+        _, project, _, secret, _, version = request["name"].split("/")
+        with self._lock:
+            versions = self._versions[secret]
+            number = len(versions) - 1 if version == "latest" else int(version)
+            if (secret, number) in self._destroyed:
+                raise RuntimeError(f"secret version {request['name']} is destroyed")
+            return _Version(f"projects/{project}/secrets/{secret}/versions/{number}", versions[number])
+
+    def add_secret_version(self, request: dict):
+        self._count("secret add")
+        secret = request["parent"].rsplit("/", 1)[1]
+        with self._lock:
+            self._versions[secret].append(request["payload"]["data"])
+            return _Version(f"{request['parent']}/versions/{len(self._versions[secret]) - 1}", request["payload"]["data"])
+
+    def destroy_secret_version(self, request: dict):
+        self._count("secret destroy")
+        parts = request["name"].split("/")
+        with self._lock:
+            self._destroyed.add((parts[3], int(parts[5])))
+
+    def latest(self, secret: str) -> str:
+        with self._lock:
+            return self._versions[secret][-1].decode("UTF-8")
+
+    def set_latest(self, secret: str, value: str):
+        with self._lock:
+            self._versions.setdefault(secret, []).append(value.encode("UTF-8"))
+
+    def reset_counts(self) -> dict:
+        with self._lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def _count(self, route: str):
+        with self._lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+class _Version:
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.payload = type("Payload", (), {"data": data})()
+
+"""
+Starts the fakes and points the helpers and main.py at them. Returns (main module, whoop
+fake, notion fake, secret manager stand-in).
+"""
+def set_up(args) -> tuple:
+    faults = fake_servers.Faults(args.latency_ms, args.jitter_ms, args.error_rate, args.throttle_rate, args.retry_after, seed=args.seed)
+    fake_whoop, fake_notion = fake_servers.start(faults, faults, args.days)
+
+    # main.py reads its configuration at import
+    os.environ["WHOOP_WEBHOOK_MODE"] = "inline"
+    os.environ["PIPELINE_METRICS_LOG_SPANS"] = "0"
+    os.environ["PIPELINE_RECONCILE_FULL"] = "1" if args.full_reconcile else "0"
+    work_dir = tempfile.mkdtemp(prefix="whoop-benchmark-")
+    os.environ["WHOOP_ACTIVITY_STORE_PATH"] = os.path.join(work_dir, "activity.sqlite3") if args.activity_store else ""
+    notion_requests_per_second = None if args.real_rate_limits else 10000
+    if args.tenants:
+        os.environ["PIPELINE_TENANT_REGISTRY"] = write_registry(work_dir, args.tenants, notion_requests_per_second)
+        os.environ["PIPELINE_TENANT_WORKERS"] = str(args.tenant_workers)
+    import main
+    from helpers import metrics, notion, ratelimit, whoop
+    metrics.add_sink(_span_collector)
+
+    whoop.WHOOP_API_ENDPOINT = fake_whoop.api_url
+    whoop.WHOOP_TOKEN_URL = fake_whoop.token_url
+    notion.NOTION_API_ENDPOINT = fake_notion.api_url
+    notion.NOTION_PAGES_ENDPOINT = fake_notion.api_url + "/pages"
+    if not args.real_rate_limits:
+        whoop._rate_limiter = ratelimit.TokenBucket(10000)
+        notion._rate_limiter = ratelimit.TokenBucket(10000)
+        # tenant states are created on first use, so this reaches the default tenant's Notion limiter
+        main._default_tenant.notion_requests_per_second = notion_requests_per_second
+
+    secrets = LocalSecretManager({
+        main.WHOOP_CLIENT_ID_SECRET_NAME: WHOOP_CLIENT_ID,
+        main.WHOOP_CLIENT_SECRET_SECRET_NAME: WHOOP_CLIENT_SECRET,
+        main.WHOOP_ACCESS_TOKEN_SECRET_NAME: "whoop-access-0",
+        main.WHOOP_REFRESH_TOKEN_SECRET_NAME: "whoop-refresh-0",
+        main.NOTION_INTEGRATION_SECRET_SECRET_NAME: NOTION_INTEGRATION_SECRET,
+        main.NOTION_DATABASE_ID_SECRET_NAME: NOTION_DATABASE_ID,
+    })
+    for user_id in tenant_ids(args.tenants):
+        access_token, refresh_token = f"whoop-access-0-{user_id}", f"whoop-refresh-0-{user_id}"
+        fake_whoop.add_account(access_token, refresh_token)
+        secrets.set_latest(f"{main.WHOOP_ACCESS_TOKEN_SECRET_NAME}_{user_id}", access_token)
+        secrets.set_latest(f"{main.WHOOP_REFRESH_TOKEN_SECRET_NAME}_{user_id}", refresh_token)
+        secrets.set_latest(f"{main.NOTION_DATABASE_ID_SECRET_NAME}_{user_id}", tenant_database_id(user_id))
+    main._secret_client = secrets
+    return main, fake_whoop, fake_notion, secrets
+
+def tenant_ids(count: int) -> list:
+    return list(range(1, count + 1))
+
+def tenant_database_id(user_id: int) -> str:
+    return f"{NOTION_DATABASE_ID}-{user_id}"
+
+"""
+Writes a registry of `count` tenants that share the Notion integration secret. Returns its path.
+"""
+def write_registry(work_dir: str, count: int, notion_requests_per_second: float=None) -> str:
+    entries = []
+    for user_id in tenant_ids(count):
+        entry = {"user_id": user_id, "notion_integration_secret": "NOTION_INTEGRATION_SECRET"}
+        if notion_requests_per_second is not None:
+            entry["notion_requests_per_second"] = notion_requests_per_second
+        entries.append(entry)
+    path = os.path.join(work_dir, "tenants.json")
+    with open(path, "w") as f:
+        json.dump(entries, f)
+    return path
+
+def make_request(body: bytes=b"", headers: dict=None):
+    from werkzeug.test import EnvironBuilder
+    return Request(EnvironBuilder(method="POST", data=body, headers=headers or {}, content_type="application/json").get_environ())
+
+def webhook_request(fake_whoop, number: int, tenants: int=0):
+    collection = ("sleep", "workout")[number % 2]
+    record_id = fake_whoop.touch(collection)
+    user_id = number // 2 % tenants + 1 if tenants else 1
+    body = json.dumps({"user_id": user_id, "id": record_id, "type": f"{collection}.updated", "trace_id": str(uuid.uuid4())}).encode()
+    timestamp = str(int(time.time() * 1000))
+    signature = base64.b64encode(hmac.new(WHOOP_CLIENT_SECRET.encode(), timestamp.encode() + body, hashlib.sha256).digest()).decode()
+    return make_request(body, {"X-WHOOP-Signature": signature, "X-WHOOP-Signature-Timestamp": timestamp})
+
+def token_secret_names(main, tenants: int) -> list:
+    if not tenants:
+        return [main.WHOOP_ACCESS_TOKEN_SECRET_NAME]
+    return [f"{main.WHOOP_ACCESS_TOKEN_SECRET_NAME}_{user_id}" for user_id in tenant_ids(tenants)]
+
+def expire_stored_token(secrets: LocalSecretManager, secret_name: str):
+    value = secrets.latest(secret_name)
+    access_token = json.loads(value)["access_token"] if value.startswith("{") else value
+    secrets.set_latest(secret_name, json.dumps({"access_token": access_token, "expires_at": 0}))
+
+"""
+Calls one function `iterations` times and returns its latency stats and outbound calls
+"""
+def run_function(name: str, iterations: int, main, fake_whoop, fake_notion, secrets, tenants: int=0) -> dict:
+    for counted in (fake_whoop, fake_notion, secrets):
+        counted.reset_counts()
+    _span_collector.reset()
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for number in range(iterations):
+        if name == "whoop_webhook":
+            request = webhook_request(fake_whoop, number, tenants)
+        else:
+            request = make_request()
+        if name == "refresh_tokens":
+            # expire the stored tokens so the safety net rotates them
+            for secret_name in token_secret_names(main, tenants):
+                expire_stored_token(secrets, secret_name)
+
+        call_started = time.perf_counter()
+        try:
+            # the scheduler wrappers build their responses with flask.make_response
+            with _app.app_context():
+                response = getattr(main, name)(request)
+            if response is not None and getattr(response, "status_code", 200) >= 400:
+                errors += 1
+        except Exception as e:
+            print(f"{name} failed: {e!r}")
+            errors += 1
+        latencies.append((time.perf_counter() - call_started) * 1000)
+    elapsed = time.perf_counter() - started
+
+    calls = {}
+    for counted in (fake_whoop, fake_notion, secrets):
+        calls.update(counted.reset_counts())
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "throughput_per_second": iterations / elapsed,
+        "latency_ms": summarize(latencies),
+        "calls_per_invocation": {route: count / iterations for route, count in sorted(calls.items())},
+        "stages": summarize_stages(_span_collector.reset(), name, iterations),
+    }
+
+"""
+Sums the spans of each stage (below the function's own span) per invocation: time spent,
+how often it ran, and its outbound calls, retries and bytes
+"""
+def summarize_stages(spans: list, function_name: str, iterations: int) -> dict:
+    stages = {}
+    for finished in spans:
+        if finished.name == function_name and finished.is_root:
+            continue
+        stage = stages.setdefault(finished.name, {"ms": 0.0, "count": 0, "calls": 0, "retries": 0, "bytes_received": 0})
+        stage["ms"] += finished.duration_seconds * 1000
+        stage["count"] += 1
+        for counter in ("calls", "retries", "bytes_received"):
+            stage[counter] += finished.counts[counter]
+    return {
+        name: {key: value / iterations for key, value in stage.items()}
+        for name, stage in sorted(stages.items(), key=lambda item: item[1]["ms"], reverse=True)
+    }
+
+def summarize(latencies: list) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "p50": percentile(ordered, 50),
+        "p95": percentile(ordered, 95),
+        "p99": percentile(ordered, 99),
+        "mean": statistics.fmean(ordered),
+        "max": ordered[-1],
+    }
+
+"""
+Nearest-rank percentile of a sorted list
+"""
+def percentile(ordered: list, percent: float) -> float:
+    rank = max(1, int(round(percent / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def print_results(results: dict):
+    for name, result in results["functions"].items():
+        latency = result["latency_ms"]
+        print(f"\n{name}: {result['iterations']} calls, {result['errors']} errors, {result['throughput_per_second']:.1f} calls/s")
+        print(f"  latency ms  p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  p99 {latency['p99']:.1f}  mean {latency['mean']:.1f}  max {latency['max']:.1f}")
+        print("  outbound calls per invocation:")
+        for route, count in result["calls_per_invocation"].items():
+            print(f"    {count:>7.2f}  {route}")
+        print("  stages per invocation (spans can nest, so times overlap):")
+        for stage_name, stage in result["stages"].items():
+            print(f"    {stage['ms']:>8.1f} ms  {stage['count']:>5.2f}x  {stage['calls']:>5.2f} calls  {stage['retries']:>5.2f} retries  {stage['bytes_received'] / 1024:>7.1f} KiB  {stage_name}")
+
+def compare(previous: dict, current: dict):
+    print(f"\ncompared with {previous['measured_at']}:")
+    for name, result in current["functions"].items():
+        before = previous["functions"].get(name)
+        if before is None:
+            continue
+        changes = "  ".join(
+            f"{key} {before['latency_ms'][key]:.1f} -> {result['latency_ms'][key]:.1f} ({_change(before['latency_ms'][key], result['latency_ms'][key])})"
+            for key in ("p50", "p95", "p99")
+        )
+        print(f"  {name}: {changes}")
+        calls_before = sum(count for route, count in before["calls_per_invocation"].items() if not route[-3:].isdigit())
+        calls_after = sum(count for route, count in result["calls_per_invocation"].items() if not route[-3:].isdigit())
+        print(f"    outbound calls per invocation {calls_before:.2f} -> {calls_after:.2f}")
+
+def _change(before: float, after: float) -> str:
+    return f"{(after - before) / before * 100:+.0f}%" if before else "n/a"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--functions", nargs="+", choices=FUNCTIONS, default=list(FUNCTIONS))
+    parser.add_argument("--iterations", type=int, default=20, help="calls per function")
+    parser.add_argument("--days", type=int, default=30, help="days of generated WHOOP history")
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency added to every fake API response")
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0, help="share of fake API responses that are 500s")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="share of fake API responses that are 429s")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-activity-store", dest="activity_store", action="store_false", help="compute stats from full WHOOP fetches")
+    parser.add_argument("--full-reconcile", action="store_true", help="recompute and rewrite every stat on every reconcile_stats call")
+    parser.add_argument("--tenants", type=int, default=0, help="serve this many tenants from a registry (default: the single-user setup)")
+    parser.add_argument("--tenant-workers", type=int, default=4, help="tenants a scheduled run works on at the same time")
+    parser.add_argument("--real-rate-limits", action="store_true", help="keep the WHOOP and Notion client-side rate limits (slow)")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against results saved earlier with --save")
+    args = parser.parse_args()
+
+    main_module, fake_whoop, fake_notion, secrets = set_up(args)
+    results = {
+        "measured_at": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "config": {key: value for key, value in vars(args).items() if key not in ("save", "compare")},
+        "functions": {},
+    }
+    try:
+        for name in args.functions:
+            results["functions"][name] = run_function(name, args.iterations, main_module, fake_whoop, fake_notion, secrets, args.tenants)
+    finally:
+        fake_whoop.stop()
+        fake_notion.stop()
+
+    print_results(results)
+    if args.tenants:
+        for user_id in tenant_ids(args.tenants):
+            print(f"\nnotion rows of tenant {user_id}: {fake_notion.values(tenant_database_id(user_id))}")
+    else:
+        print(f"\nnotion rows: {fake_notion.values(NOTION_DATABASE_ID)}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\nsaved results to {args.save}")
+
+if __name__ == "__main__":
+    main()
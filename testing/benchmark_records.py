@@ -0,0 +1,167 @@
+"""
+This script compares the memory use and parse throughput of keeping WHOOP records as the
+dicts returned by `response.json()` against the compact records in helpers/records.py,
+which are parsed straight from the response bytes. It runs on generated pages shaped like
+the WHOOP v1 sleep and workout listings, so no credentials are needed.
+
+Run it from the root directory of the project with the helpers package installed:
+    python testing/benchmark_records.py --records 50000
+"""
+
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from helpers import records, stats
+
+PAGE_SIZE = 25
+
+def sleep_record(i: int, start: datetime) -> dict:
+    return {
+        "id": 93845 + i,
+        "user_id": 10129,
+        "created_at": (start + timedelta(hours=9)).isoformat() + "Z",
+        "updated_at": (start + timedelta(hours=9)).isoformat() + "Z",
+        "start": start.isoformat() + "Z",
+        "end": (start + timedelta(hours=8)).isoformat() + "Z",
+        "timezone_offset": "-05:00",
+        "nap": i % 7 == 0,
+        "score_state": "SCORED",
+        "score": {
+            "stage_summary": {
+                "total_in_bed_time_milli": 30272735 + i,
+                "total_awake_time_milli": 1403507,
+                "total_no_data_time_milli": 0,
+                "total_light_sleep_time_milli": 14905851,
+                "total_slow_wave_sleep_time_milli": 6630370,
+                "total_rem_sleep_time_milli": 5879573,
+                "sleep_cycle_count": 3,
+                "disturbance_count": 12,
+            },
+            "sleep_needed": {
+                "baseline_milli": 27395716,
+                "need_from_sleep_debt_milli": 352230,
+                "need_from_recent_strain_milli": 208595,
+                "need_from_recent_nap_milli": -12312,
+            },
+            "respiratory_rate": 16.11328125,
+            "sleep_performance_percentage": 98,
+            "sleep_consistency_percentage": 90,
+            "sleep_efficiency_percentage": 91.69533848,
+        },
+    }
+
+def workout_record(i: int, start: datetime) -> dict:
+    return {
+        "id": 1043 + i,
+        "user_id": 9012,
+        "created_at": (start + timedelta(hours=2)).isoformat() + "Z",
+        "updated_at": (start + timedelta(hours=2)).isoformat() + "Z",
+        "start": start.isoformat() + "Z",
+        "end": (start + timedelta(hours=1)).isoformat() + "Z",
+        "timezone_offset": "-05:00",
+        "sport_id": 1,
+        "score_state": "SCORED",
+        "score": {
+            "strain": 8.2463,
+            "average_heart_rate": 123,
+            "max_heart_rate": 146,
+            "kilojoule": 1569.34033203125,
+            "percent_recorded": 100,
+            "distance_meter": 1772.77035916,
+            "altitude_gain_meter": 46.64384460449,
+            "altitude_change_meter": -0.781372010707855,
+            "zone_duration": {
+                "zone_zero_milli": 13458,
+                "zone_one_milli": 389370,
+                "zone_two_milli": 388367 + i,
+                "zone_three_milli": 71137,
+                "zone_four_milli": 0,
+                "zone_five_milli": 0,
+            },
+        },
+    }
+
+def make_pages(make_record, count: int) -> list:
+    start = datetime(2020, 1, 1)
+    pages = []
+    for page_start in range(0, count, PAGE_SIZE):
+        page_records = [make_record(i, start + timedelta(days=i)) for i in range(page_start, min(count, page_start + PAGE_SIZE))]
+        pages.append(json.dumps({"records": page_records, "next_token": f"token-{page_start}"}).encode())
+    return pages
+
+# how each approach lays its records out as stats columns
+TO_COLUMNS = {
+    ("dicts", records.SleepRecord): stats.sleep_columns,
+    ("dicts", records.WorkoutRecord): stats.workout_columns,
+    ("compact", records.SleepRecord): records.sleep_columns,
+    ("compact", records.WorkoutRecord): records.workout_columns,
+}
+
+def parse_dicts(pages: list, record_type: type) -> list:
+    kept = []
+    for body in pages:
+        kept.extend(json.loads(body)["records"])
+    return kept
+
+def parse_compact(pages: list, record_type: type) -> list:
+    kept = []
+    for body in pages:
+        page_records, _ = records.parse_page(body, record_type)
+        kept.extend(page_records)
+    return kept
+
+"""
+Returns (bytes still held by the parsed records, peak bytes while parsing)
+"""
+def measure_memory(parse, pages: list, record_type: type) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    kept = parse(pages, record_type)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return held, peak
+
+"""
+Returns the best of `repeat` timings of parsing the pages, and of parsing them and laying the
+records out as stats columns
+"""
+def best_times(label: str, parse, pages: list, record_type: type, repeat: int) -> tuple:
+    parse_times = []
+    column_times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        kept = parse(pages, record_type)
+        parsed = time.perf_counter()
+        TO_COLUMNS[label, record_type](kept)
+        parse_times.append(parsed - started)
+        column_times.append(time.perf_counter() - started)
+    return min(parse_times), min(column_times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000, help="records per collection")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per approach (best is reported)")
+    args = parser.parse_args()
+
+    for name, make_record, record_type in (
+        ("sleep", sleep_record, records.SleepRecord),
+        ("workout", workout_record, records.WorkoutRecord),
+    ):
+        pages = make_pages(make_record, args.records)
+        print(f"{name}: {args.records} records in {len(pages)} pages of {sum(map(len, pages)) / 1e6:.1f} MB")
+        for label, parse in (("dicts", parse_dicts), ("compact", parse_compact)):
+            held, peak = measure_memory(parse, pages, record_type)
+            parse_seconds, column_seconds = best_times(label, parse, pages, record_type, args.repeat)
+            print(
+                f"  {label:8} {args.records / parse_seconds:>10,.0f} records/s parsed"
+                f"  {args.records / column_seconds:>10,.0f} records/s to columns"
+                f"  {held / args.records:>7,.0f} B/record held  {peak / 1e6:>7.1f} MB peak"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+pytest setup for the unit tests in this directory. The other test_*.py files are scripts that
+call the real WHOOP, Notion and Secret Manager APIs when run, so they are not collected.
+
+Run the tests from the root directory of the project inside the functions virtual environment:
+    python -m pytest testing
+"""
+
+import os
+import sys
+
+import pytest
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTING_DIR, "..", "functions"))
+sys.path.insert(0, TESTING_DIR)
+
+# main.py reads its configuration at import
+os.environ.setdefault("PIPELINE_METRICS_LOG_SPANS", "0")
+os.environ.setdefault("WHOOP_ACTIVITY_STORE_PATH", "")
+
+collect_ignore = ["test_apis.py", "test_secret_manager.py", "test_whoop_signature_check.py"]
+
+"""
+Fake WHOOP and Notion servers (see fake_servers.py) that the helpers are pointed at for one test
+"""
+@pytest.fixture
+def fake_whoop(monkeypatch):
+    import fake_servers
+    from helpers import ratelimit, whoop
+    server = fake_servers.FakeWhoopServer(days=3).start()
+    monkeypatch.setattr(whoop, "WHOOP_API_ENDPOINT", server.api_url)
+    monkeypatch.setattr(whoop, "WHOOP_TOKEN_URL", server.token_url)
+    monkeypatch.setattr(whoop, "_rate_limiter", ratelimit.TokenBucket(10000))
+    yield server
+    server.stop()
+
+@pytest.fixture
+def fake_notion(monkeypatch):
+    import fake_servers
+    from helpers import notion, ratelimit
+    server = fake_servers.FakeNotionServer().start()
+    monkeypatch.setattr(notion, "NOTION_API_ENDPOINT", server.api_url)
+    monkeypatch.setattr(notion, "NOTION_PAGES_ENDPOINT", server.api_url + "/pages")
+    monkeypatch.setattr(notion, "_rate_limiter", ratelimit.TokenBucket(10000))
+    monkeypatch.setattr(notion, "_page_index", {})
+    monkeypatch.setattr(notion, "_last_written", {})
+    yield server
+    server.stop()
@@ -0,0 +1,412 @@
+"""
+Local stand-ins for the WHOOP and Notion APIs, so the pipeline can be run and benchmarked
+offline. Each fake is a small threaded HTTP server that implements the endpoints this project
+calls, with configurable latency, error rate and 429 rate:
+
+- WHOOP: the OAuth token endpoint (refresh_token grant), the sleep and workout collections
+  (start/end filters, `limit` and `nextToken` pagination) and single records by id
+- Notion: database queries (start_cursor pagination), page creates and page updates
+
+Every request is counted per route, so a benchmark can report how many outbound calls a
+function made. Run this file directly to keep both servers up for manual testing:
+    python testing/fake_servers.py --latency-ms 50
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+WHOOP_ACCESS_TOKEN_LIFETIME_SECONDS = 3600
+WHOOP_MAX_PAGE_SIZE = 25
+
+"""
+How a fake server misbehaves. Every request first waits `latency_ms` (plus up to `jitter_ms`),
+then fails with a 500 with probability `error_rate` or with a 429 and a Retry-After of
+`retry_after_seconds` with probability `throttle_rate`.
+"""
+class Faults:
+    def __init__(self, latency_ms: float=0, jitter_ms: float=0, error_rate: float=0, throttle_rate: float=0, retry_after_seconds: float=1, seed: int=None):
+        for name, rate in (("error_rate", error_rate), ("throttle_rate", throttle_rate)):
+            if not 0 <= rate <= 1:
+                raise ValueError(f"{name} must be between 0 and 1, got {rate}")
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after_seconds = retry_after_seconds
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    """
+    Sleeps for the configured latency and returns the status to fail with, or None
+    """
+    def apply(self):
+        with self._lock:
+            delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+            draw = self._random.random()
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if draw < self.error_rate:
+            return 500
+        if draw < self.error_rate + self.throttle_rate:
+            return 429
+        return None
+
+"""
+Threaded HTTP server that dispatches requests to `route` and counts them per route
+"""
+class FakeServer:
+    def __init__(self, faults: Faults=None, port: int=0):
+        self.faults = faults or Faults()
+        self.counts = {}
+        self._counts_lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, like the real APIs
+            # headers and body go out in separate writes, which Nagle would hold back for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server._handle(self, "GET")
+
+            def do_POST(self):
+                server._handle(self, "POST")
+
+            def do_PATCH(self):
+                server._handle(self, "PATCH")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset_counts(self) -> dict:
+        with self._counts_lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    """
+    Returns (route name, status, response body) for a request. Subclasses implement this.
+    """
+    def route(self, method: str, path: str, query: dict, headers, body: bytes) -> tuple:
+        raise NotImplementedError
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str):
+        parsed = urlparse(handler.path)
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+
+        route, status, payload = self.route(method, parsed.path, dict(parse_qsl(parsed.query)), handler.headers, body)
+        headers = {}
+        fault = self.faults.apply() if status < 400 else None
+        if fault == 429:
+            status, payload = 429, {"message": "rate limited"}
+            headers["Retry-After"] = f"{self.faults.retry_after_seconds:g}"
+        elif fault == 500:
+            status, payload = 500, {"message": "injected error"}
+
+        with self._counts_lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+            self.counts[f"{route} {status}"] = self.counts.get(f"{route} {status}", 0) + 1
+
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+"""
+Fake WHOOP API holding `days` days of generated sleeps (one night and an occasional nap per
+day) and workouts. Access tokens are only accepted until they expire or are replaced by a refresh.
+Every account (see add_account) sees the same records but has its own tokens.
+"""
+class FakeWhoopServer(FakeServer):
+    def __init__(self, faults: Faults=None, days: int=30, workouts_per_day: int=1, access_token: str="whoop-access-0", refresh_token: str="whoop-refresh-0", port: int=0, seed: int=0):
+        super().__init__(faults, port)
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._token_number = 0
+        self.access_tokens = {} # access token -> expiry, of every account
+        self.refresh_tokens = {} # refresh token -> the access token issued with it
+        self.add_account(access_token, refresh_token)
+        # nights start just after local midnight, so every stat window holds whole days
+        midnight = datetime.combine(datetime.now(), datetime.min.time()).astimezone(timezone.utc)
+        self.records = {"sleep": {}, "workout": {}}
+        for day in range(days):
+            night = midnight - timedelta(days=day) + timedelta(minutes=30)
+            self._add_sleep(night, nap=False)
+            if day % 5 == 0:
+                self._add_sleep(night + timedelta(hours=13), nap=True)
+            for number in range(workouts_per_day):
+                self._add_workout(night + timedelta(hours=9 + number * 3))
+
+    @property
+    def api_url(self) -> str:
+        return self.url + "/developer"
+
+    @property
+    def token_url(self) -> str:
+        return self.url + "/oauth/oauth2/token"
+
+    """
+    Adds an account that is signed in with the given tokens
+    """
+    def add_account(self, access_token: str, refresh_token: str):
+        with self._lock:
+            self.access_tokens[access_token] = time.time() + WHOOP_ACCESS_TOKEN_LIFETIME_SECONDS
+            self.refresh_tokens[refresh_token] = access_token
+
+    """
+    Adds or rescores a record, ie before sending the webhook event for it. Returns its id.
+    """
+    def touch(self, collection: str, record_id: int=None) -> int:
+        with self._lock:
+            if record_id is None:
+                record_id = max(self.records[collection])
+            record = self.records[collection][record_id]
+            record["updated_at"] = _format_time(datetime.now(timezone.utc))
+        return record_id
+
+    def route(self, method: str, path: str, query: dict, headers, body: bytes) -> tuple:
+        if method == "POST" and path == "/oauth/oauth2/token":
+            return ("whoop token",) + self._refresh(dict(parse_qsl(body.decode())))
+
+        parts = path.strip("/").split("/")
+        if parts[:3] != ["developer", "v1", "activity"] or len(parts) not in (4, 5) or parts[3] not in self.records:
+            return "whoop unknown", 404, {"message": "not found"}
+        collection = parts[3]
+        route = f"whoop {collection}" + (" by id" if len(parts) == 5 else " list")
+
+        token = headers.get("Authorization", "").removeprefix("Bearer ")
+        with self._lock:
+            expires_at = self.access_tokens.get(token)
+        if expires_at is None or expires_at < time.time():
+            return route, 401, {"message": "invalid token"}
+
+        if len(parts) == 5:
+            with self._lock:
+                record = self.records[collection].get(int(parts[4])) if parts[4].isdigit() else None
+            return (route, 200, record) if record is not None else (route, 404, {"message": "not found"})
+        return (route,) + self._list(collection, query)
+
+    def _refresh(self, form: dict) -> tuple:
+        with self._lock:
+            if form.get("grant_type") != "refresh_token" or form.get("refresh_token") not in self.refresh_tokens:
+                return 400, {"error": "invalid_grant"}
+            # a refresh replaces both of the account's tokens
+            self.access_tokens.pop(self.refresh_tokens.pop(form["refresh_token"]), None)
+            self._token_number += 1
+            access_token = f"whoop-access-{self._token_number}"
+            refresh_token = f"whoop-refresh-{self._token_number}"
+            self.access_tokens[access_token] = time.time() + WHOOP_ACCESS_TOKEN_LIFETIME_SECONDS
+            self.refresh_tokens[refresh_token] = access_token
+            return 200, {
+                "access_token": access_token,
+                "refresh_token": refresh_token,
+                "expires_in": WHOOP_ACCESS_TOKEN_LIFETIME_SECONDS,
+                "scope": form.get("scope", ""),
+                "token_type": "bearer",
+            }
+
+    def _list(self, collection: str, query: dict) -> tuple:
+        limit = int(query.get("limit", 10))
+        if not 1 <= limit <= WHOOP_MAX_PAGE_SIZE:
+            return 400, {"message": f"limit must be between 1 and {WHOOP_MAX_PAGE_SIZE}"}
+        start = _parse_time(query["start"]) if "start" in query else None
+        end = _parse_time(query["end"]) if "end" in query else None
+        with self._lock:
+            records = sorted(self.records[collection].values(), key=lambda record: record["start"], reverse=True)
+        records = [
+            record for record in records
+            if (start is None or _parse_time(record["start"]) >= start) and (end is None or _parse_time(record["start"]) < end)
+        ]
+        offset = int(query.get("nextToken", 0))
+        page = records[offset:offset + limit]
+        next_token = str(offset + limit) if offset + limit < len(records) else None
+        return 200, {"records": page, "next_token": next_token}
+
+    def _add_sleep(self, start: datetime, nap: bool):
+        record_id = len(self.records["sleep"]) + 1
+        in_bed = self._random.randint(20, 45) * 60 * 1000 if nap else self._random.randint(6 * 60, 9 * 60) * 60 * 1000
+        self.records["sleep"][record_id] = {
+            "id": record_id,
+            "user_id": 1,
+            "created_at": _format_time(start + timedelta(milliseconds=in_bed)),
+            "updated_at": _format_time(start + timedelta(milliseconds=in_bed)),
+            "start": _format_time(start),
+            "end": _format_time(start + timedelta(milliseconds=in_bed)),
+            "timezone_offset": "+00:00",
+            "nap": nap,
+            "score_state": "SCORED",
+            "score": {
+                "stage_summary": {
+                    "total_in_bed_time_milli": in_bed,
+                    "total_awake_time_milli": in_bed // 10,
+                    "total_no_data_time_milli": 0,
+                    "total_light_sleep_time_milli": in_bed // 2,
+                    "total_slow_wave_sleep_time_milli": in_bed // 5,
+                    "total_rem_sleep_time_milli": in_bed // 5,
+                    "sleep_cycle_count": 4,
+                    "disturbance_count": 10,
+                },
+                "respiratory_rate": 15.5,
+                "sleep_performance_percentage": 90,
+                "sleep_consistency_percentage": 85,
+                "sleep_efficiency_percentage": 92.5,
+            },
+        }
+
+    def _add_workout(self, start: datetime):
+        record_id = len(self.records["workout"]) + 1
+        zones = [self._random.randint(0, 20) * 60 * 1000 for _ in range(6)]
+        self.records["workout"][record_id] = {
+            "id": record_id,
+            "user_id": 1,
+            "created_at": _format_time(start + timedelta(milliseconds=sum(zones))),
+            "updated_at": _format_time(start + timedelta(milliseconds=sum(zones))),
+            "start": _format_time(start),
+            "end": _format_time(start + timedelta(milliseconds=sum(zones))),
+            "timezone_offset": "+00:00",
+            "sport_id": 1,
+            "score_state": "SCORED",
+            "score": {
+                "strain": round(self._random.uniform(4, 18), 4),
+                "average_heart_rate": 130,
+                "max_heart_rate": 170,
+                "kilojoule": 1500.0,
+                "percent_recorded": 100,
+                "zone_duration": {
+                    f"zone_{name}_milli": milli
+                    for name, milli in zip(("zero", "one", "two", "three", "four", "five"), zones)
+                },
+            },
+        }
+
+"""
+Fake Notion API holding the pages of any number of databases. Pages start out empty, so the
+first write of each stat creates its row.
+"""
+class FakeNotionServer(FakeServer):
+    def __init__(self, faults: Faults=None, port: int=0):
+        super().__init__(faults, port)
+        self._lock = threading.Lock()
+        self.pages = {} # page id -> {"database_id", "properties", "archived"}
+
+    @property
+    def api_url(self) -> str:
+        return self.url + "/v1"
+
+    def values(self, database_id: str) -> dict:
+        with self._lock:
+            return {
+                _text(page["properties"]["Stat"]["title"]): _text(page["properties"]["Value"]["rich_text"])
+                for page in self.pages.values() if page["database_id"] == database_id and not page["archived"]
+            }
+
+    def route(self, method: str, path: str, query: dict, headers, body: bytes) -> tuple:
+        payload = json.loads(body) if body else {}
+        parts = path.strip("/").split("/")
+        if method == "POST" and len(parts) == 4 and parts[:2] == ["v1", "databases"] and parts[3] == "query":
+            return ("notion query",) + self._query(parts[2], payload)
+        if method == "POST" and parts == ["v1", "pages"]:
+            return ("notion create",) + self._create(payload)
+        if method == "PATCH" and len(parts) == 3 and parts[:2] == ["v1", "pages"]:
+            return ("notion update",) + self._update(parts[2], payload)
+        return "notion unknown", 404, {"object": "error", "code": "object_not_found"}
+
+    def _query(self, database_id: str, payload: dict) -> tuple:
+        page_size = payload.get("page_size", 100)
+        offset = int(payload.get("start_cursor") or 0)
+        with self._lock:
+            pages = [(page_id, page) for page_id, page in self.pages.items() if page["database_id"] == database_id and not page["archived"]]
+            results = [_page_json(page_id, page) for page_id, page in pages[offset:offset + page_size]]
+        has_more = offset + page_size < len(pages)
+        return 200, {"object": "list", "results": results, "has_more": has_more, "next_cursor": str(offset + page_size) if has_more else None}
+
+    def _create(self, payload: dict) -> tuple:
+        page_id = str(uuid.uuid4())
+        with self._lock:
+            self.pages[page_id] = {"database_id": payload["parent"]["database_id"], "properties": _plain_properties(payload["properties"]), "archived": False}
+            return 200, _page_json(page_id, self.pages[page_id])
+
+    def _update(self, page_id: str, payload: dict) -> tuple:
+        with self._lock:
+            page = self.pages.get(page_id)
+            if page is None:
+                return 404, {"object": "error", "code": "object_not_found"}
+            if page["archived"]:
+                return 400, {"object": "error", "code": "validation_error", "message": "Can't edit block that is archived."}
+            page["properties"].update(_plain_properties(payload.get("properties", {})))
+            return 200, _page_json(page_id, page)
+
+"""
+Starts both fakes and returns them as (whoop, notion)
+"""
+def start(whoop_faults: Faults=None, notion_faults: Faults=None, days: int=30) -> tuple:
+    return FakeWhoopServer(whoop_faults, days=days).start(), FakeNotionServer(notion_faults).start()
+
+def _format_time(value: datetime) -> str:
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.") + f"{value.microsecond // 1000:03d}Z"
+
+def _parse_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def _text(rich_text: list) -> str:
+    return "".join(part.get("plain_text", "") for part in rich_text)
+
+def _plain_properties(properties: dict) -> dict:
+    # store text the way Notion returns it, with plain_text next to the text object
+    plain = {}
+    for name, value in properties.items():
+        for kind, parts in value.items():
+            plain[name] = {kind: [dict(part, plain_text=part.get("text", {}).get("content", "")) for part in parts]}
+    return plain
+
+def _page_json(page_id: str, page: dict) -> dict:
+    return {"object": "page", "id": page_id, "archived": page["archived"], "parent": {"database_id": page["database_id"]}, "properties": page["properties"]}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--days", type=int, default=30, help="days of generated WHOOP history")
+    args = parser.parse_args()
+
+    faults = Faults(args.latency_ms, error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+    whoop, notion = start(faults, faults, args.days)
+    print(f"fake WHOOP API at {whoop.api_url} (token endpoint {whoop.token_url}, access token whoop-access-0, refresh token whoop-refresh-0)")
+    print(f"fake Notion API at {notion.api_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+This script measures what importing the Cloud Functions module costs, which is most of a cold
+start before any request is handled. It imports `functions/main.py` in fresh interpreters with
+`python -X importtime` and reports the total and the most expensive modules, both including
+their own imports (cumulative) and excluding them (self).
+
+Run it from the root directory of the project inside the functions virtual environment:
+    python testing/profile_imports.py --runs 5 --save import_times.json
+Saved reports can be compared with --compare to track cold-start cost over time.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions")
+
+"""
+Imports `module` in a fresh interpreter and returns {module name: (self us, cumulative us)}
+"""
+def import_times(module: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=FUNCTIONS_DIR, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+"""
+Imports `module` `runs` times and returns the median self and cumulative time of every module
+"""
+def profile(module: str, runs: int) -> dict:
+    samples = [import_times(module) for _ in range(runs)]
+    names = set().union(*samples)
+    return {
+        name: {
+            "self_ms": statistics.median(sample[name][0] for sample in samples if name in sample) / 1000,
+            "cumulative_ms": statistics.median(sample[name][1] for sample in samples if name in sample) / 1000,
+        }
+        for name in names
+    }
+
+def print_top(modules: dict, key: str, top: int):
+    print(f"\ntop {top} by {key.replace('_ms', '')} time:")
+    for name, times in sorted(modules.items(), key=lambda item: item[1][key], reverse=True)[:top]:
+        print(f"  {times[key]:>9.1f} ms  {name}")
+
+def compare(previous: dict, current: dict, top: int):
+    before = previous["total_ms"]
+    after = current["total_ms"]
+    print(f"\ntotal: {before:.1f} ms -> {after:.1f} ms ({after - before:+.1f} ms)")
+    changes = []
+    for name in set(previous["modules"]) | set(current["modules"]):
+        old = previous["modules"].get(name, {}).get("self_ms", 0.0)
+        new = current["modules"].get(name, {}).get("self_ms", 0.0)
+        changes.append((new - old, name, old, new))
+    print(f"largest self time changes:")
+    for delta, name, old, new in sorted(changes, key=lambda change: abs(change[0]), reverse=True)[:top]:
+        print(f"  {delta:>+9.1f} ms  {name} ({old:.1f} -> {new:.1f})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main", help="module to import from functions/ (default: main)")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to median over")
+    parser.add_argument("--top", type=int, default=15, help="modules to list")
+    parser.add_argument("--save", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="compare against a report saved earlier with --save")
+    args = parser.parse_args()
+
+    modules = profile(args.module, args.runs)
+    report = {
+        "module": args.module,
+        "python": sys.version.split()[0],
+        "measured_at": datetime.now(timezone.utc).isoformat(),
+        "runs": args.runs,
+        "total_ms": modules[args.module]["cumulative_ms"],
+        "modules": modules,
+    }
+    print(f"importing {args.module}: {report['total_ms']:.1f} ms (median of {args.runs} runs, {len(modules)} modules)")
+    print_top(modules, "cumulative_ms", args.top)
+    print_top(modules, "self_ms", args.top)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report, args.top)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"\nsaved report to {args.save}")
+
+if __name__ == "__main__":
+    main()
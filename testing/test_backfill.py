@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from helpers import backfill, tokens, whoop
+
+def stored_ids(store, collection, start):
+    return sorted(record["id"] for record in store.records_since(collection, start))
+
+def test_killed_run_resumes_from_its_checkpoints_with_a_refreshed_token(fake_whoop, tmp_path, monkeypatch):
+    store_path = str(tmp_path / "history.sqlite3")
+    start = datetime.now(timezone.utc) - timedelta(days=4)
+    shards = dict(start=start, shard_days=1, workers=1)
+
+    # the run dies right after checkpointing its fourth page
+    first = backfill.Backfill("whoop-access-0", store_path, **shards)
+    save_checkpoint = first.checkpoints.set
+    def set_then_die(key, value, ttl_seconds=None):
+        save_checkpoint(key, value, ttl_seconds)
+        if first.pages == 4:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(first.checkpoints, "set", set_then_die)
+    with pytest.raises(KeyboardInterrupt):
+        first.run()
+    done = [shard for shard in first.shards() if first._checkpoint(*shard).get("done")]
+    assert 4 <= len(done) < len(first.shards())
+
+    # by the time it is resumed the access token expired, and the token callable hands out a new one
+    fake_whoop.access_tokens["whoop-access-0"] = 0
+    refresh_token = ["whoop-refresh-0"]
+    def current_token():
+        response = whoop.request_tokens(refresh_token[0], "client-id", "client-secret")
+        refresh_token[0] = response["refresh_token"]
+        return response["access_token"]
+    resumed = backfill.Backfill(current_token, store_path, **shards)
+    assert isinstance(resumed.access_token, tokens.TokenManager)
+    fake_whoop.reset_counts()
+    summary = resumed.run()
+    assert summary["shards"] == len(resumed.shards()) - len(done)
+    assert summary["pages"] == summary["shards"]
+    assert fake_whoop.counts["whoop token"] == 1
+
+    for collection in whoop.COLLECTION_URLS:
+        expected = sorted(record["id"] for record in fake_whoop.records[collection].values() if datetime.fromisoformat(record["start"].replace("Z", "+00:00")) >= start)
+        assert stored_ids(resumed.store, collection, start) == expected
+
+def test_access_token_must_be_a_token_or_a_callable(tmp_path):
+    with pytest.raises(ValueError):
+        backfill.Backfill(42, str(tmp_path / "history.sqlite3"), datetime(2026, 1, 1))
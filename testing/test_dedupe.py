@@ -0,0 +1,28 @@
+from helpers import dedupe, kvstore
+
+def test_added_ids_are_seen_until_they_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedupe.time, "time", lambda: now[0])
+    store = dedupe.DedupeStore(ttl_seconds=60)
+    assert not store.contains("trace-1")
+    store.add("trace-1")
+    assert store.contains("trace-1")
+    now[0] += 61
+    assert not store.contains("trace-1")
+    assert store.stats() == {"hits": 1, "misses": 2, "size": 0}
+
+def test_least_recently_seen_id_is_evicted_first():
+    store = dedupe.DedupeStore(max_entries=2)
+    store.add("trace-1")
+    store.add("trace-2")
+    assert store.contains("trace-1")
+    store.add("trace-3")
+    assert store.contains("trace-1") and store.contains("trace-3")
+    assert not store.contains("trace-2")
+
+def test_ids_are_shared_through_the_backend():
+    backend = kvstore.SQLiteKV(":memory:")
+    dedupe.DedupeStore(backend=backend).add("trace-1")
+    other_instance = dedupe.DedupeStore(backend=backend)
+    assert other_instance.contains("trace-1")
+    assert not other_instance.contains("trace-2")
@@ -0,0 +1,79 @@
+from datetime import datetime, timezone
+
+import main
+from helpers import freshness, kvstore, tenants
+
+# noon, far from the window boundary at midnight UTC
+NOW = datetime(2026, 10, 14, 12, tzinfo=timezone.utc).timestamp()
+WINDOW_START = 1000.0
+
+def fresh_tracker(**kwargs):
+    tracker = freshness.FreshnessTracker(**kwargs)
+    tracker.record_compute("SLEEP", "7.5", NOW, WINDOW_START, watermark=50)
+    return tracker
+
+def test_current_stat_is_not_stale():
+    assert fresh_tracker().stale_reason("SLEEP", WINDOW_START, 50, now=NOW + 60) is None
+
+def test_stale_reasons():
+    tracker = fresh_tracker()
+    assert tracker.stale_reason("ZONE_2", WINDOW_START, 50, now=NOW) == "never computed"
+    assert tracker.stale_reason("SLEEP", WINDOW_START + 86400, 50, now=NOW) == "window moved"
+    assert tracker.stale_reason("SLEEP", WINDOW_START, 60, now=NOW) == "source changed"
+    assert tracker.stale_reason("SLEEP", WINDOW_START, 50, now=NOW + freshness.DEFAULT_MAX_AGE_SECONDS) == "max age"
+
+    tracker.mark_changed(["SLEEP"], changed_at=NOW + 1)
+    assert tracker.stale_reason("SLEEP", WINDOW_START, 50, now=NOW + 60) == "dirty"
+
+    midnight = datetime(2026, 10, 14, tzinfo=timezone.utc).timestamp()
+    tracker = freshness.FreshnessTracker()
+    tracker.record_compute("SLEEP", "7.5", midnight + 60, WINDOW_START, 50)
+    assert tracker.stale_reason("SLEEP", WINDOW_START, 50, now=midnight + 120) == "near window boundary"
+
+def test_change_marked_before_the_compute_read_its_data_is_covered():
+    tracker = freshness.FreshnessTracker()
+    tracker.mark_changed(["SLEEP"], changed_at=NOW - 1)
+    tracker.record_compute("SLEEP", "7.5", NOW, WINDOW_START, 50)
+    assert not tracker.get("SLEEP").dirty
+    # an older compute finishing late doesn't replace the newer one
+    tracker.record_compute("SLEEP", "7.0", NOW - 10, WINDOW_START, 50)
+    assert tracker.get("SLEEP").value == "7.5"
+
+def test_only_synced_computes_restart_the_max_age():
+    tracker = fresh_tracker()
+    later = NOW + freshness.DEFAULT_MAX_AGE_SECONDS - 60
+    tracker.record_compute("SLEEP", "7.6", later, WINDOW_START, 50, synced=False)
+    assert tracker.get("SLEEP").computed_at == later
+    assert tracker.stale_reason("SLEEP", WINDOW_START, 50, now=later + 120) == "max age"
+
+    unsynced = freshness.FreshnessTracker()
+    unsynced.record_compute("SLEEP", "7.5", NOW, WINDOW_START, 50, synced=False)
+    assert unsynced.stale_reason("SLEEP", WINDOW_START, 50, now=NOW + 60) == "max age"
+
+def test_entries_are_shared_through_the_backend():
+    backend = kvstore.SQLiteKV(":memory:")
+    fresh_tracker(backend=backend, key_prefix="1:")
+    other = freshness.FreshnessTracker(backend=backend, key_prefix="1:")
+    assert other.get("SLEEP").to_dict() == {"computed_at": NOW, "window_start": WINDOW_START, "watermark": 50, "value": "7.5", "changed_at": None, "synced_at": NOW}
+    assert freshness.FreshnessTracker(backend=backend, key_prefix="2:").get("SLEEP").computed_at is None
+
+def test_delta_sync_marks_changed_stats_and_confirms_the_others(monkeypatch):
+    state = tenants.TenantState(tenants.Tenant(1, "whoop-access", "whoop-refresh", "notion", "notion-db"), None, None, freshness.FreshnessTracker())
+    state.freshness.record_compute("SLEEP", "7.5", NOW, WINDOW_START, 50, synced=False)
+    monkeypatch.setattr(state, "get_activity_store", lambda: object())
+    # a workout changed without a webhook, the sleeps didn't
+    monkeypatch.setattr(main.whoop, "sync_collection", lambda access_token, store, collection, start: int(collection == "workout"))
+
+    synced_at = main._sync_sources(state)
+    assert state.freshness.get("ZONE_2").changed_at == synced_at
+    assert state.freshness.get("ZONE_5").changed_at == synced_at
+    assert state.freshness.get("SLEEP").changed_at is None
+    assert state.freshness.get("SLEEP").synced_at == synced_at
+    assert state.freshness.stale_reason("SLEEP", WINDOW_START, 50, now=synced_at + 60) is None
+
+def test_clean_sync_doesnt_confirm_a_dirty_stat():
+    tracker = fresh_tracker()
+    tracker.mark_changed(["SLEEP"], changed_at=NOW + 1)
+    tracker.mark_synced(["SLEEP", "ZONE_2"], synced_at=NOW + 2)
+    assert tracker.get("SLEEP").synced_at == NOW
+    assert tracker.get("ZONE_2").computed_at is None
@@ -0,0 +1,164 @@
+import time
+import types
+from datetime import datetime, timezone
+
+import pytest
+
+import main
+from helpers import freshness, jobs, kvstore, notion, store, tenants
+
+def sleep_job(record_id, user_id=1):
+    return {"type": "sleep.updated", "id": record_id, "trace_id": f"trace-{record_id}", "user_id": user_id}
+
+def pubsub_event(job, published_at):
+    return types.SimpleNamespace(data=types.SimpleNamespace(message=types.SimpleNamespace(json=job)), time=types.SimpleNamespace(timestamp=lambda: published_at))
+
+def test_event_published_before_a_recompute_started_is_covered():
+    coalescer = jobs.EventCoalescer(5)
+    coalescer.mark_started([sleep_job(1)], started_at=100)
+    assert coalescer.already_covered(sleep_job(1), published_at=99)
+    assert not coalescer.already_covered(sleep_job(1), published_at=101)
+    assert not coalescer.already_covered(sleep_job(1, user_id=2), published_at=99)
+
+def test_recompute_of_one_record_does_not_cover_other_records():
+    coalescer = jobs.EventCoalescer(5)
+    coalescer.mark_started([sleep_job(1)], started_at=100)
+    assert not coalescer.already_covered(sleep_job(2), published_at=99)
+
+    # a recompute that synced the whole collection saw every record
+    coalescer.mark_started([sleep_job(1)], started_at=200, synced=True)
+    assert coalescer.already_covered(sleep_job(2), published_at=199)
+    assert coalescer.already_covered(sleep_job(None), published_at=199)
+
+def test_earlier_event_for_another_record_is_processed(monkeypatch):
+    monkeypatch.setattr(main, "_coalescer", jobs.EventCoalescer(5))
+    monkeypatch.setattr(main, "_get_job_tenant_state", lambda job: object())
+    processed = []
+    def process_jobs(job_list, state):
+        processed.extend(job_list)
+        return False
+    monkeypatch.setattr(main, "_process_jobs", process_jobs)
+
+    main.process_whoop_job.__wrapped__(pubsub_event(sleep_job(1), published_at=10))
+    # delivered late, after the recompute of record 1 started, but it was never fetched
+    main.process_whoop_job.__wrapped__(pubsub_event(sleep_job(2), published_at=5))
+    main.process_whoop_job.__wrapped__(pubsub_event(sleep_job(1), published_at=5))
+    assert processed == [sleep_job(1), sleep_job(2)]
+
+def test_failed_job_is_retried_when_pubsub_redelivers_it(monkeypatch):
+    monkeypatch.setattr(main, "_coalescer", jobs.EventCoalescer(5))
+    monkeypatch.setattr(main, "_get_job_tenant_state", lambda job: object())
+    processed = []
+    def process_jobs(job_list, state):
+        if not processed:
+            processed.append(None)
+            raise RuntimeError("WHOOP is down")
+        processed.append(job_list)
+    monkeypatch.setattr(main, "_process_jobs", process_jobs)
+
+    event = pubsub_event(sleep_job(1), published_at=0)
+    with pytest.raises(RuntimeError):
+        main.process_whoop_job.__wrapped__(event)
+    # the redelivery carries the same publish time
+    main.process_whoop_job.__wrapped__(event)
+    assert processed[1] == [sleep_job(1)]
+
+def test_drain_releases_a_failed_batch_for_redelivery():
+    queue = jobs.InMemoryQueue()
+    coalescer = jobs.EventCoalescer(0)
+    queue.publish("jobs", jobs.encode_job(sleep_job(1)))
+    def fail(batch):
+        raise RuntimeError("Notion is down")
+    assert jobs.drain_coalesced(queue, "jobs", fail, coalescer, force=True) == []
+
+    handled = []
+    batches = jobs.drain_coalesced(queue, "jobs", handled.append, coalescer, force=True)
+    assert [batch.jobs for batch in batches] == [[sleep_job(1)]]
+    assert queue.pull("jobs") == []
+
+def test_burst_of_events_is_folded_into_one_batch():
+    coalescer = jobs.EventCoalescer(5)
+    for record_id, received_at in ((1, 0), (2, 3), (3, 6)):
+        coalescer.offer(sleep_job(record_id), received_at)
+    assert coalescer.ready(now=10) == []
+    batches = coalescer.ready(now=11)
+    assert [batch.folded for batch in batches] == [3]
+
+def test_debounced_webhook_jobs_are_merged_by_the_scheduled_drain(monkeypatch):
+    queue = jobs.InMemoryQueue()
+    monkeypatch.setattr(main, "WEBHOOK_MODE", "debounce")
+    monkeypatch.setattr(main, "DEBOUNCE_DRAIN_SECONDS", 0)
+    monkeypatch.setattr(main, "_job_queue", queue)
+    monkeypatch.setattr(main, "_coalescer", jobs.EventCoalescer(0))
+    monkeypatch.setattr(main, "_get_job_tenant_state", lambda job: object())
+    processed = []
+    def process_jobs(job_list, state):
+        processed.append(job_list)
+        return True
+    monkeypatch.setattr(main, "_process_jobs", process_jobs)
+
+    for record_id in (1, 2, 3):
+        queue.publish(main._get_jobs_topic(), jobs.encode_job(sleep_job(record_id)))
+    main.drain_debounced_jobs.__wrapped__(None)
+    assert processed == [[sleep_job(1), sleep_job(2), sleep_job(3)]]
+    assert queue.pull(main.WEBHOOK_DEBOUNCED_JOBS_TOPIC) == []
+
+def test_pubsub_pull_returns_no_messages_when_the_subscription_is_empty(monkeypatch):
+    from google.api_core import exceptions
+    class Subscriber:
+        def __init__(self, received_messages):
+            self.received_messages = received_messages
+        def subscription_path(self, project, subscription):
+            return f"projects/{project}/subscriptions/{subscription}"
+        def pull(self, request, timeout=None):
+            if not self.received_messages:
+                raise exceptions.DeadlineExceeded("no messages")
+            return types.SimpleNamespace(received_messages=self.received_messages)
+    message = types.SimpleNamespace(message_id="1", data=jobs.encode_job(sleep_job(1)), publish_time=datetime(2026, 10, 14, tzinfo=timezone.utc))
+    queue = main._PubSubQueue.__new__(main._PubSubQueue)
+    queue._subscriber = Subscriber([types.SimpleNamespace(ack_id="ack-1", message=message)])
+    [received] = queue.pull(main.WEBHOOK_DEBOUNCED_JOBS_TOPIC)
+    assert (received.ack_id, jobs.decode_job(received.data), received.publish_time) == ("ack-1", sleep_job(1), message.publish_time.timestamp())
+    queue._subscriber = Subscriber([])
+    assert queue.pull(main.WEBHOOK_DEBOUNCED_JOBS_TOPIC) == []
+
+def workout(record_id, zone_two_mins):
+    zone_duration = dict.fromkeys(store.ZONE_FIELDS, 0)
+    zone_duration["zone_two_milli"] = zone_two_mins * 60 * 1000
+    start = datetime.fromtimestamp(time.time() - 3600, timezone.utc).isoformat()
+    return {"id": record_id, "start": start, "updated_at": start, "score_state": "SCORED", "score": {"zone_duration": zone_duration}}
+
+def test_window_that_missed_another_instances_event_is_listed_again(monkeypatch):
+    remote = {1: workout(1, 10)}
+    monkeypatch.setattr(main.whoop, "get_record", lambda access_token, collection, record_id: remote.get(record_id))
+    monkeypatch.setattr(main.whoop, "iter_collection", lambda access_token, collection_url, start=None: iter(list(remote.values())))
+    async def iter_collection_async(access_token, collection_url, start=None):
+        for record in list(remote.values()):
+            yield record
+    monkeypatch.setattr(main.whoop, "iter_collection_async", iter_collection_async)
+    monkeypatch.setattr(main, "_get_secret", lambda secret_name: secret_name)
+    written = []
+    def update_notion_stats(stat_values, notion_integration_secret, notion_database_id, rate_limiter=None):
+        written.append(stat_values[notion.STAT_TYPE.ZONE_2])
+        return {}
+    monkeypatch.setattr(main, "_update_notion_stats", update_notion_stats)
+
+    # two instances serving the same tenant share only the freshness backend
+    tenant = tenants.Tenant(1, "whoop-access", "whoop-refresh", "notion", "notion-db")
+    backend = kvstore.SQLiteKV(":memory:")
+    first, second = (tenants.TenantState(tenant, None, None, freshness.FreshnessTracker(backend=backend)) for _ in range(2))
+    update = {"type": "workout.updated", "id": 1}
+    main._process_jobs([update], first)
+    main._process_jobs([update], second)
+    assert written == ["10", "10"]
+
+    # the event for a new workout goes to the first instance, the next one to the second
+    remote[2] = workout(2, 20)
+    main._process_jobs([{"type": "workout.updated", "id": 2}], first)
+    remote[1] = workout(1, 15)
+    assert main._process_jobs([update], second)
+    assert written[2:] == ["30", "35"]
+    # the second instance is current now, so its next event is applied without a listing
+    remote[1] = workout(1, 5)
+    assert not main._process_jobs([update], second)
+    assert written[4:] == ["25"]
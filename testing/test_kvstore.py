@@ -0,0 +1,57 @@
+from google.api_core import exceptions
+
+from helpers import kvstore
+
+class FakeBlob:
+    def __init__(self, objects, name):
+        self.objects = objects
+        self.name = name
+
+    def download_as_bytes(self):
+        if self.name not in self.objects:
+            raise exceptions.NotFound(self.name)
+        return self.objects[self.name]
+
+    def upload_from_string(self, data, content_type=None):
+        self.objects[self.name] = data.encode()
+
+    def delete(self):
+        if self.objects.pop(self.name, None) is None:
+            raise exceptions.NotFound(self.name)
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}
+
+    def blob(self, name):
+        return FakeBlob(self.objects, name)
+
+def gcs_store(location, table):
+    kv = kvstore.open_store(location, table)
+    kv._bucket = FakeBucket()
+    return kv
+
+def test_gcs_store_round_trips_values_under_its_prefix(monkeypatch):
+    kv = gcs_store("gs://state-bucket/whoop/", "freshness")
+    assert (kv.bucket, kv.prefix) == ("state-bucket", "whoop/freshness")
+    assert kv.get("freshness:SLEEP", "missing") == "missing"
+    kv.set("freshness:SLEEP", {"value": "7.5"})
+    assert kv.get("freshness:SLEEP") == {"value": "7.5"}
+    assert list(kv._bucket.objects) == ["whoop/freshness/freshness:SLEEP"]
+    kv.delete("freshness:SLEEP")
+    kv.delete("freshness:SLEEP")
+    assert kv.get("freshness:SLEEP") is None
+
+def test_gcs_store_values_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(kvstore.time, "time", lambda: now[0])
+    kv = gcs_store("gs://state-bucket", "dedupe")
+    assert kv.prefix == "dedupe"
+    kv.set("trace-1", True, ttl_seconds=60)
+    assert kv.get("trace-1")
+    now[0] += 60
+    assert kv.get("trace-1") is None
+
+def test_other_locations_open_sqlite(tmp_path):
+    kv = kvstore.open_store(str(tmp_path / "state.sqlite3"), "freshness")
+    assert isinstance(kv, kvstore.SQLiteKV) and kv.table == "freshness"
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from helpers import aio, kvstore, notion
+
+DATABASE_ID = "stats-db"
+
+def update_stats(stat_values, force=False):
+    return notion.update_stats(stat_values, "notion-secret", DATABASE_ID, force)
+
+def update_stats_async(stat_values, force=False):
+    return aio.run(notion.update_stats_async(stat_values, "notion-secret", DATABASE_ID, force))
+
+def add_row_by_hand(fake_notion, stat_string, value, target_string):
+    payload = notion._create_db_entry_payload(stat_string, value, target_string, DATABASE_ID)
+    fake_notion.route("POST", "/v1/pages", {}, {}, json.dumps(payload).encode())
+
+@pytest.mark.parametrize("update", [update_stats, update_stats_async])
+def test_cached_page_that_is_gone_is_looked_up_again(fake_notion, update):
+    assert update({notion.STAT_TYPE.SLEEP: "7.5"}) == {notion.STAT_TYPE.SLEEP: "created"}
+    [page_id] = fake_notion.pages
+
+    # the row was deleted and added again by hand, so the cached page id answers 404
+    del fake_notion.pages[page_id]
+    add_row_by_hand(fake_notion, notion.SLEEP_STAT_STRING, "7", notion.SLEEP_TARGET_STRING)
+    fake_notion.reset_counts()
+    assert update({notion.STAT_TYPE.SLEEP: "7.6"}) == {notion.STAT_TYPE.SLEEP: "updated"}
+    assert fake_notion.reset_counts() == {"notion update": 2, "notion update 404": 1, "notion update 200": 1, "notion query": 1, "notion query 200": 1}
+    assert fake_notion.values(DATABASE_ID) == {notion.SLEEP_STAT_STRING: "7.6"}
+
+    # an archived row without a replacement is created again
+    for page in fake_notion.pages.values():
+        page["archived"] = True
+    assert update({notion.STAT_TYPE.SLEEP: "7.7"}) == {notion.STAT_TYPE.SLEEP: "created"}
+    assert fake_notion.values(DATABASE_ID) == {notion.SLEEP_STAT_STRING: "7.7"}
+
+@pytest.mark.parametrize("update", [update_stats, update_stats_async])
+def test_unchanged_value_skips_the_patch_unless_forced(fake_notion, update):
+    assert update({notion.STAT_TYPE.ZONE_2: "150"}) == {notion.STAT_TYPE.ZONE_2: "created"}
+    fake_notion.reset_counts()
+    assert update({notion.STAT_TYPE.ZONE_2: "150"}) == {notion.STAT_TYPE.ZONE_2: "skipped"}
+    assert fake_notion.reset_counts() == {}
+
+    assert update({notion.STAT_TYPE.ZONE_2: "150"}, force=True) == {notion.STAT_TYPE.ZONE_2: "updated"}
+    assert fake_notion.reset_counts() == {"notion update": 1, "notion update 200": 1}
+    assert update({notion.STAT_TYPE.ZONE_2: "151"}) == {notion.STAT_TYPE.ZONE_2: "updated"}
+    assert fake_notion.values(DATABASE_ID) == {notion.ZONE_2_STAT_STRING: "151"}
+
+def test_written_values_are_shared_through_the_backend(fake_notion, monkeypatch):
+    backend = kvstore.SQLiteKV(":memory:")
+    monkeypatch.setattr(notion, "_last_written_backend", backend)
+    update_stats({notion.STAT_TYPE.ZONE_5: "16"})
+    # another instance starts without the in-memory copy
+    monkeypatch.setattr(notion, "_last_written", {})
+    fake_notion.reset_counts()
+    assert update_stats({notion.STAT_TYPE.ZONE_5: "16"}) == {notion.STAT_TYPE.ZONE_5: "skipped"}
+    assert fake_notion.reset_counts() == {}
@@ -0,0 +1,56 @@
+import threading
+import time
+
+from helpers import ratelimit
+
+def test_burst_up_to_capacity_then_waits():
+    bucket = ratelimit.TokenBucket(rate=10, capacity=3)
+    assert all(bucket.acquire(timeout=0) for _ in range(3))
+    assert not bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=1)
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+def test_waiting_callers_are_served_in_priority_order():
+    # the bucket's clock only moves when the test moves it, so no token appears while the callers queue up
+    now = [0.0]
+    bucket = ratelimit.TokenBucket(rate=1000, capacity=1, clock=lambda: now[0])
+    assert bucket.acquire()
+    served = []
+    def acquire(name, priority):
+        bucket.acquire(priority)
+        served.append(name)
+
+    # the bulk caller queues first, the interactive one still goes ahead of it
+    threads = [
+        threading.Thread(target=acquire, args=("bulk", ratelimit.PRIORITY_BULK)),
+        threading.Thread(target=acquire, args=("interactive", ratelimit.PRIORITY_INTERACTIVE)),
+    ]
+    for queued, thread in enumerate(threads, 1):
+        thread.start()
+        wait_until(lambda: bucket.waiting() == queued)
+    for expected in (["interactive"], ["interactive", "bulk"]):
+        now[0] += 1 # one token
+        wait_until(lambda: served == expected)
+    for thread in threads:
+        thread.join(timeout=5)
+
+def test_throttle_pauses_callers_and_lowers_the_rate_until_it_recovers():
+    bucket = ratelimit.TokenBucket(rate=100, capacity=5)
+    bucket.throttled(retry_after=0.2)
+    assert bucket.current_rate == 100 * ratelimit.THROTTLE_FACTOR
+    assert not bucket.acquire(timeout=0.1)
+    assert bucket.acquire(timeout=1)
+    for _ in range(10):
+        bucket.succeeded()
+    assert (bucket.current_rate, bucket.throttle_count) == (100, 1)
+
+def test_rate_never_drops_below_the_minimum():
+    bucket = ratelimit.TokenBucket(rate=10, min_rate=4)
+    for _ in range(5):
+        bucket.throttled(retry_after=0)
+    assert bucket.current_rate == 4
@@ -0,0 +1,45 @@
+import json
+import math
+
+import pytest
+
+from helpers import records
+from test_store import sleep, workout
+
+def page(record_list, next_token=None, indent=None):
+    return json.dumps({"records": record_list, "next_token": next_token}, indent=indent).encode()
+
+def fields(record):
+    # compared as bytes, since missing fields are NaN
+    return (record.id, record.start, record.updated_at, record.values.tobytes())
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_parsed_page_matches_the_records_it_holds(indent):
+    sleeps = [sleep(1, "2026-10-12T22:00:00.000Z", 100), sleep(2, "2026-10-13T13:00:00.000Z", 30, nap=True)]
+    parsed, next_token = records.parse_page(page(sleeps, "token-2", indent), records.SleepRecord)
+    assert next_token == "token-2"
+    assert [fields(record) for record in parsed] == [fields(records.SleepRecord.from_dict(record)) for record in sleeps]
+    assert [record.nap for record in parsed] == [False, True]
+
+    workouts = [workout(3, "2026-10-13T18:00:00.000Z", 60)]
+    parsed, next_token = records.parse_page(page(workouts, indent=indent), records.WorkoutRecord)
+    assert next_token is None
+    assert parsed[0].get("zone_two_milli") == 60
+    # strain isn't in the generated score, so it is missing rather than zero
+    assert math.isnan(parsed[0].get("strain"))
+
+def test_empty_pages():
+    assert records.parse_page(b"{}", records.SleepRecord) == ([], None)
+    assert records.parse_page(b'{"records": [], "next_token": null}', records.SleepRecord) == ([], None)
+
+def test_truncated_page_raises_value_error():
+    body = page([sleep(1, "2026-10-12T22:00:00.000Z", 100), sleep(2, "2026-10-13T22:00:00.000Z", 200)], "token-2", indent=1)
+    for end in range(len(body)):
+        with pytest.raises(ValueError):
+            records.parse_page(body[:end], records.SleepRecord)
+
+def test_malformed_record_raises_value_error():
+    with pytest.raises(ValueError):
+        records.parse_page(page([{"id": 1}]), records.SleepRecord)
+    with pytest.raises(ValueError):
+        records.parse_page(page([7]), records.WorkoutRecord)
@@ -0,0 +1,74 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from helpers import aio, store, whoop
+from helpers.rolling import RollingWindow
+
+def test_upsert_replaces_a_record_and_delete_removes_it():
+    window = RollingWindow(("milli",))
+    window.upsert("a", 10, {"milli": 5})
+    window.upsert("b", 20, {"milli": 7})
+    window.upsert("a", 10, {"milli": 1})
+    assert (window.sums, window.count) == ({"milli": 8}, 2)
+    assert window.delete("b")
+    assert not window.delete("b")
+    assert (window.sums, window.count) == ({"milli": 1}, 1)
+
+def test_advance_expires_records_that_fell_out_of_the_window():
+    window = RollingWindow(("milli",))
+    window.reset(0)
+    for record_id, start in (("a", 5), ("b", 15), ("c", 25)):
+        window.upsert(record_id, start, {"milli": 1})
+    window.advance(20)
+    assert "c" in window and "b" not in window
+    assert window.count == 1
+    # records starting before the window are never counted
+    window.upsert("d", 10, {"milli": 1})
+    assert window.count == 1
+    with pytest.raises(ValueError):
+        window.advance(10)
+
+def test_replace_takes_over_the_other_windows_state():
+    window = RollingWindow(("milli",))
+    window.upsert("old", 10, {"milli": 3})
+    seeded = RollingWindow(("milli",))
+    seeded.reset(5)
+    seeded.upsert("new", 10, {"milli": 4})
+    seeded.mark_seeded()
+    window.replace(seeded)
+    assert (window.window_start, window.seeded, window.sums, window.count) == (5, True, {"milli": 4}, 1)
+    assert "new" in window and "old" not in window
+    # the windows don't share records afterwards
+    seeded.delete("new")
+    assert "new" in window
+    with pytest.raises(ValueError):
+        window.replace(RollingWindow(("other",)))
+
+def test_window_keeps_its_totals_while_it_is_seeded_again(monkeypatch):
+    window = whoop.new_sleep_window()
+    window.upsert("1", 0, {"total_in_bed_time_milli": 100})
+    seen_while_listing = []
+    async def iter_collection_async(access_token, collection_url, start=None):
+        seen_while_listing.append((window.count, dict(window.sums)))
+        await asyncio.sleep(0)
+        yield {"id": 2, "start": "2026-10-10T22:00:00.000Z", "nap": False, "score": {"stage_summary": {"total_in_bed_time_milli": 500}}}
+        seen_while_listing.append((window.count, dict(window.sums)))
+    monkeypatch.setattr(whoop, "iter_collection_async", iter_collection_async)
+
+    start = datetime(2026, 10, 1, tzinfo=timezone.utc)
+    aio.run(whoop._seed_window_async(None, "sleep", start, None, window))
+    assert seen_while_listing == [(1, {"total_in_bed_time_milli": 100})] * 2
+    assert (window.count, window.sums, window.seeded) == (1, {"total_in_bed_time_milli": 500}, True)
+
+@pytest.mark.parametrize("event_type, window", [("sleep.updated", whoop.new_sleep_window()), ("workout.updated", whoop.new_workout_window())])
+def test_unscored_record_is_left_out_of_the_window(monkeypatch, event_type, window):
+    window.reset(0)
+    window.mark_seeded()
+    window.upsert("1", 10, dict.fromkeys(window.fields, 100))
+    record = {"id": 1, "start": "2026-10-10T22:00:00.000Z", "updated_at": "2026-10-11T06:00:00.000Z", "nap": False, "score_state": "PENDING_SCORE", "score": None}
+    monkeypatch.setattr(whoop, "get_record", lambda access_token, collection, record_id: record)
+    assert whoop.apply_event(None, event_type, 1, store.ActivityStore(), window)
+    # the record's earlier scored copy no longer counts either
+    assert (window.count, window.sums) == (0, dict.fromkeys(window.fields, 0))
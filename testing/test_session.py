@@ -0,0 +1,78 @@
+import types
+
+import pytest
+
+import fake_servers
+from helpers import ratelimit, session
+
+"""
+Faults that answer each request with the next status of `statuses` (None for the normal response)
+"""
+class ScriptedFaults(fake_servers.Faults):
+    def __init__(self, statuses, retry_after_seconds=1):
+        super().__init__(retry_after_seconds=retry_after_seconds)
+        self.statuses = list(statuses)
+
+    def apply(self):
+        return self.statuses.pop(0) if self.statuses else None
+
+class EchoServer(fake_servers.FakeServer):
+    def route(self, method, path, query, headers, body):
+        return "echo", 200, {"method": method}
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(session, "time", types.SimpleNamespace(sleep=slept.append, perf_counter=session.time.perf_counter))
+    return slept
+
+@pytest.fixture(scope="module")
+def echo_server():
+    server = EchoServer().start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def serve(echo_server):
+    def serve(statuses, retry_after_seconds=1):
+        echo_server.faults = ScriptedFaults(statuses, retry_after_seconds)
+        echo_server.reset_counts()
+        return echo_server
+    return serve
+
+def test_server_errors_are_retried_with_backoff(serve, sleeps):
+    server = serve([500, 500, None])
+    response = session.get(server.url + "/stats")
+    assert response.status_code == 200
+    assert server.counts["echo"] == 3
+    assert len(sleeps) == 2
+    assert all(0 <= delay <= session.BACKOFF_BASE_SECONDS * 2 ** attempt for attempt, delay in enumerate(sleeps))
+
+def test_retries_stop_after_max_retries(serve, sleeps):
+    server = serve([500] * 5)
+    response = session.get(server.url + "/stats", max_retries=2)
+    assert response.status_code == 500
+    assert (server.counts["echo"], len(sleeps)) == (3, 2)
+
+def test_retry_after_is_honoured_on_429(serve, sleeps):
+    server = serve([429, None], retry_after_seconds=1.5)
+    # a 429 is retried for any method, since the server didn't process the request
+    response = session.post(server.url + "/pages", data="{}")
+    assert response.status_code == 200
+    assert sleeps == [1.5]
+
+def test_429_with_a_rate_limiter_pauses_the_limiter_instead(serve, sleeps):
+    server = serve([429, None], retry_after_seconds=0.1)
+    rate_limiter = ratelimit.TokenBucket(10000)
+    response = session.get(server.url + "/stats", rate_limiter=rate_limiter)
+    assert response.status_code == 200
+    assert sleeps == [0]
+    assert rate_limiter.throttle_count == 1
+
+def test_non_idempotent_post_is_not_retried(serve, sleeps):
+    server = serve([500, 500, None])
+    assert session.post(server.url + "/pages", data="{}").status_code == 500
+    assert server.counts["echo"] == 1
+    assert session.post(server.url + "/query", data="{}", idempotent=True).status_code == 200
+    assert server.counts["echo"] == 3
+    assert len(sleeps) == 1
@@ -0,0 +1,79 @@
+from datetime import date, datetime, timezone
+
+from helpers import store, whoop
+
+def sleep(record_id, start, in_bed, updated_at="2026-10-14T12:00:00.000Z", nap=False, user_id=1):
+    stage_summary = {"total_in_bed_time_milli": in_bed, "total_light_sleep_time_milli": in_bed // 2, "total_slow_wave_sleep_time_milli": 0, "total_rem_sleep_time_milli": 0}
+    return {"id": record_id, "user_id": user_id, "start": start, "updated_at": updated_at, "nap": nap, "score_state": "SCORED", "score": {"stage_summary": stage_summary}}
+
+def workout(record_id, start, zone_two, updated_at="2026-10-14T12:00:00.000Z", user_id=1):
+    zone_duration = dict.fromkeys(store.ZONE_FIELDS, 0)
+    zone_duration["zone_two_milli"] = zone_two
+    return {"id": record_id, "user_id": user_id, "start": start, "updated_at": updated_at, "score_state": "SCORED", "score": {"zone_duration": zone_duration}}
+
+def rollups(activity_store):
+    return activity_store.daily_rollups(date(2026, 1, 1))
+
+def assert_matches_a_rebuild(activity_store):
+    incremental = rollups(activity_store)
+    activity_store.rebuild_rollups()
+    assert rollups(activity_store) == incremental
+
+def test_upsert_keeps_the_daily_rollups_in_step():
+    activity_store = store.ActivityStore()
+    changed = activity_store.upsert("sleep", iter([
+        sleep(1, "2026-10-12T22:00:00.000Z", 100),
+        sleep(2, "2026-10-13T13:00:00.000Z", 30, nap=True),
+    ]))
+    activity_store.upsert("workout", [workout(3, "2026-10-13T18:00:00.000Z", 60)])
+    assert changed == 2
+    totals = activity_store.rollup_totals(date(2026, 10, 12), date(2026, 10, 13))
+    assert (totals["sleeps"], totals["in_bed_milli"], totals["asleep_milli"]) == (1, 100, 50)
+    assert (totals["naps"], totals["nap_milli"], totals["workouts"], totals["zone_two_milli"]) == (1, 30, 1, 60)
+    assert activity_store.rollup_totals(date(2026, 10, 13))["sleeps"] == 0
+    assert_matches_a_rebuild(activity_store)
+
+def test_rescored_record_replaces_its_old_contribution():
+    activity_store = store.ActivityStore()
+    activity_store.upsert("sleep", [sleep(1, "2026-10-12T22:00:00.000Z", 100)])
+    # an older copy is ignored, a newer one (here also moved to the next day) replaces it
+    assert activity_store.upsert("sleep", [sleep(1, "2026-10-12T22:00:00.000Z", 500, updated_at="2026-10-13T00:00:00.000Z")]) == 0
+    assert activity_store.upsert("sleep", [sleep(1, "2026-10-13T01:00:00.000Z", 200, updated_at="2026-10-15T00:00:00.000Z")]) == 1
+    assert [(row["day"], row["sleeps"], row["in_bed_milli"]) for row in rollups(activity_store)] == [("2026-10-13", 1, 200)]
+    assert_matches_a_rebuild(activity_store)
+
+def test_delete_and_prune_remove_their_contribution():
+    activity_store = store.ActivityStore()
+    activity_store.upsert("workout", [workout(record_id, f"2026-10-1{record_id}T18:00:00.000Z", 10 * record_id) for record_id in (1, 2, 3, 4)])
+    assert activity_store.delete("workout", 1)
+    assert not activity_store.delete("workout", 1)
+    deleted = activity_store.prune("workout", datetime(2026, 10, 3, tzinfo=timezone.utc), keep_ids=[4])
+    assert sorted(deleted) == ["2", "3"]
+    assert activity_store.rollup_totals(date(2026, 10, 1))["zone_two_milli"] == 40
+    assert_matches_a_rebuild(activity_store)
+
+def test_rollup_days_are_utc_days():
+    # 23:30 in New York on the 12th is already the 13th in UTC
+    assert store.rollup_day(store.parse_time("2026-10-13T03:30:00.000Z")) == date(2026, 10, 13)
+    assert store.rollup_day(datetime(2026, 10, 12, 23, 59, tzinfo=timezone.utc).timestamp()) == date(2026, 10, 12)
+
+def test_sync_writes_each_page_and_prunes_records_gone_from_whoop(monkeypatch):
+    activity_store = store.ActivityStore()
+    activity_store.upsert("sleep", [sleep(9, "2026-10-12T22:00:00.000Z", 70)])
+    pages = [
+        [sleep(1, "2026-10-12T23:00:00.000Z", 100, updated_at="2026-10-13T08:00:00.000Z")],
+        [sleep(2, "2026-10-13T22:00:00.000Z", 200, updated_at="2026-10-14T08:00:00.000Z")],
+    ]
+    stored_between_pages = []
+    def iter_collection_pages(access_token, collection_url, start=None):
+        for page in pages:
+            yield page, None
+            stored_between_pages.append(activity_store.get("sleep", page[0]["id"]) is not None)
+    monkeypatch.setattr(whoop, "iter_collection_pages", iter_collection_pages)
+
+    deleted = []
+    changed = whoop.sync_collection(None, activity_store, "sleep", datetime(2026, 10, 10), on_delete=deleted.append)
+    assert (changed, deleted, stored_between_pages) == (3, ["9"], [True, True])
+    assert activity_store.get_sync_state("sleep") == (datetime(2026, 10, 10, tzinfo=timezone.utc), datetime(2026, 10, 14, 8, tzinfo=timezone.utc))
+    assert activity_store.rollup_totals(date(2026, 10, 12))["in_bed_milli"] == 300
+    assert_matches_a_rebuild(activity_store)
@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+from helpers import tenants
+
+BASE_NAMES = {
+    "whoop_access_token_secret": "WHOOP_ACCESS_TOKEN",
+    "whoop_refresh_token_secret": "WHOOP_REFRESH_TOKEN",
+    "notion_integration_secret": "NOTION_INTEGRATION_SECRET",
+    "notion_database_id_secret": "NOTION_DATABASE_ID",
+}
+
+def tenant(user_id):
+    return tenants.Tenant.from_dict({"user_id": user_id}, BASE_NAMES)
+
+def test_registry_entries_default_to_suffixed_secret_names():
+    registry = tenants.TenantRegistry.from_json('{"tenants": [{"user_id": 10129}, {"user_id": 7, "notion_database_id_secret": "SHARED_DB", "notion_requests_per_second": 1}]}', BASE_NAMES)
+    first, second = registry.get(10129), registry.get("7")
+    assert (first.whoop_access_token_secret, first.notion_database_id_secret) == ("WHOOP_ACCESS_TOKEN_10129", "NOTION_DATABASE_ID_10129")
+    assert (second.notion_database_id_secret, second.notion_requests_per_second) == ("SHARED_DB", 1)
+    assert registry.get(99) is None
+    assert len(registry) == 2
+
+def test_invalid_registry_entries_are_rejected():
+    with pytest.raises(ValueError):
+        tenants.TenantRegistry.from_json('[{"whoop_access_token_secret": "X"}]', BASE_NAMES)
+    with pytest.raises(ValueError):
+        tenants.TenantRegistry.from_json('[{"user_id": 1, "notion_token": "X"}]', BASE_NAMES)
+    with pytest.raises(ValueError):
+        tenants.TenantRegistry([tenant(1), tenant(1)])
+
+def test_fallback_serves_unknown_users():
+    fallback = tenants.Tenant(None, "WHOOP_ACCESS_TOKEN", "WHOOP_REFRESH_TOKEN", "NOTION_INTEGRATION_SECRET", "NOTION_DATABASE_ID")
+    registry = tenants.TenantRegistry([], fallback)
+    assert registry.get(10129) is fallback
+    assert registry.all() == [fallback]
+
+def test_activity_store_path_per_tenant():
+    assert tenants.activity_store_path("/tmp/whoop_activity.sqlite3", "10129") == "/tmp/whoop_activity.10129.sqlite3"
+    assert tenants.activity_store_path("/tmp/whoop_activity.sqlite3", None) == "/tmp/whoop_activity.sqlite3"
+    assert tenants.activity_store_path("", "10129") == ""
+
+def test_fan_out_bounds_workers_and_isolates_failures():
+    running, most_running = [0], [0]
+    lock = threading.Lock()
+    def work(tenant):
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        if tenant.user_id == "3":
+            raise RuntimeError("Notion is down")
+        return tenant.user_id
+
+    results = tenants.fan_out("test", [tenant(user_id) for user_id in range(6)], work, max_workers=2)
+    assert most_running[0] == 2
+    assert isinstance(results.pop("3"), RuntimeError)
+    assert results == {str(user_id): str(user_id) for user_id in (0, 1, 2, 4, 5)}
+    with pytest.raises(ValueError):
+        tenants.fan_out("test", [], work, max_workers=0)
@@ -0,0 +1,47 @@
+import threading
+import time
+
+from helpers import tokens, whoop
+
+def test_concurrent_callers_share_one_refresh():
+    refreshing, release = threading.Event(), threading.Event()
+    refreshed_from = []
+    def refresh(token):
+        refreshed_from.append(token)
+        refreshing.set()
+        release.wait(timeout=5)
+        return "new-token", time.time() + 3600
+    # the loaded token expires within the refresh skew, so every caller needs a new one
+    manager = tokens.TokenManager(lambda: ("old-token", time.time() + 60), refresh)
+
+    got = []
+    def get_token():
+        got.append(manager.get_token())
+    threads = [threading.Thread(target=get_token) for _ in range(8)]
+    threads[0].start()
+    assert refreshing.wait(timeout=5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert refreshed_from == ["old-token"] and manager.refresh_count == 1
+    assert got == ["new-token"] * 8
+
+def test_rejected_token_is_refreshed_and_the_request_retried(fake_whoop):
+    refresh_token = ["whoop-refresh-0"]
+    def refresh(token):
+        response = whoop.request_tokens(refresh_token[0], "client-id", "client-secret")
+        refresh_token[0] = response["refresh_token"]
+        return response["access_token"], time.time() + response["expires_in"]
+    # WHOOP revoked the token before it expired
+    manager = tokens.TokenManager(lambda: ("whoop-access-0", time.time() + 3600), refresh)
+    fake_whoop.access_tokens["whoop-access-0"] = 0
+
+    record_id = max(fake_whoop.records["sleep"])
+    assert whoop.get_record(manager, "sleep", record_id)["id"] == record_id
+    assert manager.refresh_count == 1
+    assert fake_whoop.reset_counts() == {"whoop sleep by id": 2, "whoop sleep by id 401": 1, "whoop sleep by id 200": 1, "whoop token": 1, "whoop token 200": 1}
+    # a caller still holding the rejected token doesn't refresh again
+    assert manager.token_rejected("whoop-access-0") == manager.get_token()
+    assert manager.refresh_count == 1